@@ -1,18 +1,45 @@
-from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher import AES, ChaCha20_Poly1305, PKCS1_OAEP
 from Crypto.Random import get_random_bytes
 from Crypto.Hash import SHA256
 from Crypto.Util.Padding import pad, unpad
-from Crypto.PublicKey import RSA
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Protocol.DH import import_x25519_public_key, key_agreement
+from Crypto.Protocol.KDF import HKDF
 import random
+import struct
 
 PRIME = 2**2048 - 159  # a big prime
 GENERATOR = 2
 
+# AEAD session mode (AES-GCM or ChaCha20-Poly1305): every frame is an 8-byte counter, the ciphertext and a 16-byte tag.
+# The nonce is the sender's direction prefix + that counter, so the two sides never share one
+NONCE_PREFIXES = {"server": b"\x00\x00\x00\x01", "client": b"\x00\x00\x00\x02"}
+COUNTER = struct.Struct("!Q")
+TAG_SIZE = 16
+AEAD_MODES = ("gcm", "chacha20")
+
+def message_bytes(message):
+    if isinstance(message, str):
+        return message.encode()
+    if isinstance(message, bytes):
+        return message
+    raise TypeError("Message must be a string or bytes")
+
 class DiffieHellmanChannel:
+    mode = "dh"
+
     def __init__(self):
         self.private = random.randint(2, PRIME - 2)
         self.public = pow(GENERATOR, self.private, PRIME)
         self.shared_key = None
+        self.aead_key = None  # Set once the session switches to an AEAD mode
+
+    def encode_public(self):
+        return format(self.public, "x")  # Hex on the wire
+
+    @staticmethod
+    def decode_public(text):
+        return int(text, 16)
 
     def generate_shared_key(self, other_public):
         # Compute the shared secret using the other party's public key
@@ -23,34 +50,110 @@ class DiffieHellmanChannel:
 
         print(f"Shared key generated: {self.shared_key.hex()}")  # Log shared key (in hex)
 
+    def resumption_secret(self):
+        # Matches the secret the server put in our session ticket
+        return HKDF(self.shared_key, 16, b"", SHA256, context=b"CyberHunt resumption")
+
+    def use_aead(self, role, mode="gcm"):
+        # Separate key for the AEAD session so it never shares one with the CBC frames
+        size = 16 if mode == "gcm" else 32
+        self.aead_key = HKDF(self.shared_key, size, b"", SHA256, context=f"CyberHunt {mode} session".encode())
+        self.aead_mode = mode
+        self.send_prefix = NONCE_PREFIXES[role]
+        self.recv_prefix = NONCE_PREFIXES["client" if role == "server" else "server"]
+        self.send_counter = 0
+        self.recv_counter = 0
+
+    def aead_cipher(self, nonce):
+        if self.aead_mode == "chacha20":
+            return ChaCha20_Poly1305.new(key=self.aead_key, nonce=nonce)
+        return AES.new(self.aead_key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+    def encrypt_aead(self, data):
+        self.send_counter += 1  # Never reuse a nonce
+        counter = COUNTER.pack(self.send_counter)
+        cipher = self.aead_cipher(self.send_prefix + counter)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return b"".join((counter, ciphertext, tag))
+
+    def encrypt_frames(self, messages):
+        # A batch for one peer in a single pass: one random read covers every CBC IV
+        if self.aead_key is not None:
+            return [self.encrypt_aead(message_bytes(message)) for message in messages]
+        size = AES.block_size
+        ivs = get_random_bytes(size * len(messages))
+        frames = []
+        for i, message in enumerate(messages):
+            iv = ivs[i * size:(i + 1) * size]
+            frames.append(iv + AES.new(self.shared_key, AES.MODE_CBC, iv).encrypt(pad(message_bytes(message), size)))
+        return frames
+
     def encrypt(self, message):
-        if isinstance(message, str):
-            message_bytes = message.encode()  # Convert string to bytes
-        elif isinstance(message, bytes):
-            message_bytes = message  # Message is already in bytes
-        else:
-            raise TypeError("Message must be a string or bytes")
+        data = message_bytes(message)
+        if self.aead_key is not None:
+            return self.encrypt_aead(data)
 
         # Pad the message to a 16-byte boundary
-        padded_message = pad(message_bytes, AES.block_size)  # Pad to a multiple of 16 bytes
+        padded_message = pad(data, AES.block_size)  # Pad to a multiple of 16 bytes
         iv = get_random_bytes(AES.block_size)  # Generate a random IV
         
         cipher = AES.new(self.shared_key, AES.MODE_CBC, iv)
         encrypted_message = cipher.encrypt(padded_message)  # Encrypt the padded message
         return iv + encrypted_message  # Return IV + encrypted message
 
-    def decrypt(self, encrypted_message):
+    def decrypt_bytes(self, encrypted_message):
+        if self.aead_key is not None:
+            counter, = COUNTER.unpack_from(encrypted_message)
+            if counter <= self.recv_counter:
+                raise ValueError("Replayed or reordered frame")  # Counters only ever go up
+            cipher = self.aead_cipher(self.recv_prefix + encrypted_message[:COUNTER.size])
+            data = cipher.decrypt_and_verify(encrypted_message[COUNTER.size:-TAG_SIZE], encrypted_message[-TAG_SIZE:])
+            self.recv_counter = counter
+            return data
+
         iv = encrypted_message[:AES.block_size]  # Extract the IV from the beginning
         ciphertext = encrypted_message[AES.block_size:]  # Extract the ciphertext
 
         cipher = AES.new(self.shared_key, AES.MODE_CBC, iv)
-        decrypted_message = unpad(cipher.decrypt(ciphertext), AES.block_size)  # Unpad after decryption
-        return decrypted_message.decode()  # Convert bytes back to string
+        return unpad(cipher.decrypt(ciphertext), AES.block_size)  # Unpad after decryption
 
+    def decrypt(self, encrypted_message):
+        return self.decrypt_bytes(encrypted_message).decode()  # Convert bytes back to string
+
+class X25519Channel(DiffieHellmanChannel):
+    mode = "x25519"
 
-class RSAChannel:
     def __init__(self):
-        key = RSA.generate(2048)
+        self.private = ECC.generate(curve="Curve25519")
+        self.public = self.private.public_key().export_key(format="raw")  # 32 bytes
+        self.shared_key = None
+        self.aead_key = None
+
+    def encode_public(self):
+        return self.public.hex()
+
+    @staticmethod
+    def decode_public(text):
+        return bytes.fromhex(text)
+
+    def generate_shared_key(self, other_public):
+        peer = import_x25519_public_key(other_public)
+        self.shared_key = key_agreement(static_priv=self.private, static_pub=peer,
+                                        kdf=lambda secret: SHA256.new(secret).digest()[:16])  # AES-128 key
+
+class ResumedChannel(DiffieHellmanChannel):
+    mode = "resume"
+
+    def __init__(self, resumption_secret, nonces):
+        # New session key from the ticket secret and both sides' nonces
+        self.shared_key = HKDF(resumption_secret, 16, nonces, SHA256, context=b"CyberHunt resumed session")
+        self.aead_key = None
+
+CHANNELS = {"x25519": X25519Channel, "dh": DiffieHellmanChannel}
+
+class RSAChannel:
+    def __init__(self, key=None):
+        key = key or RSA.generate(2048)  # Pass a key to skip generating one
         self.private_key = key
         self.public_key = key.publickey()
 
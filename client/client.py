@@ -27,6 +27,7 @@ def login_screen(secure):
         if response.startswith("LOGIN_SUCCESS"):
             global username
             username = u
+            remember_ticket(response, secure)
             window.destroy()
             main_menu(secure)
         else:
@@ -54,6 +55,7 @@ def register_screen(secure):
         if response.startswith("REGISTER_SUCCESS"):
             global username
             username = u
+            remember_ticket(response, secure)
             window.destroy()
             main_menu(secure)
         else:
@@ -72,6 +74,10 @@ def register_screen(secure):
     tk.Button(window, text="Back to Login", command=lambda:[window.destroy(), login_screen(secure)]).pack()
     window.mainloop()
 
+def room_capacity(command):
+    # From the players=<n>/<max> in a join or create reply
+    return int(command['args'].get('players', "0/4").split("/")[-1])
+
 def main_menu(secure):
     def join_game():
         response = send_command("JOIN", client_socket, secure)
@@ -79,24 +85,34 @@ def main_menu(secure):
         command = parse_command(response)
         if command['type'] == "ROOM_JOINED":
             menu.destroy()
-            lobby_screen(secure, room_info=command['args']['room_name'])
+            lobby_screen(secure, room_info=command['args']['room_name'], max_players=room_capacity(command))
         else:
             messagebox.showerror("Join Failed", response)
 
     def create_game():
-        response = send_command("CREATE", client_socket, secure)
+        # A name typed in the room name box names the new room, the size boxes pick the map and player cap
+        request = "CREATE"
+        for field, entry in (("room_name", room_name_entry), ("grid_size", grid_size_entry),
+                             ("max_players", max_players_entry)):
+            if entry.get():
+                request += f" {field}={entry.get()}"
+        response = send_command(request, client_socket, secure)
         debug_print(response)
         command = parse_command(response)
         if command['type'] == "ROOM_CREATED":
             menu.destroy()
-            lobby_screen(secure, room_info=command['args']['room_name'], is_host=True)
+            lobby_screen(secure, room_info=command['args']['room_name'], is_host=True,
+                         max_players=room_capacity(command))
         else:
             messagebox.showerror("Create Failed", response)
 
     def view_rooms():
-        response = send_command("VIEW", client_socket, secure)
-        debug_print(response)
-        messagebox.showinfo("Available Rooms", response)
+        open_rooms, total = fetch_room_list(client_socket, secure)
+        debug_print(open_rooms)
+        text = "\n".join(open_rooms.values()) or "No open rooms"
+        if total > len(open_rooms):
+            text += f"\n\n{len(open_rooms)} of {total} rooms"
+        messagebox.showinfo("Available Rooms", text)
 
     def bot_game():
         response = send_command("CREATE_BOT", client_socket, secure)
@@ -114,14 +130,15 @@ def main_menu(secure):
         response = send_command("LEADERBOARD", client_socket, secure)
         debug_print(response)
         if response.startswith('"LEADERBOARD'):
-            players = response.split()[1:-1]
-            leaderboard_window(players)
+            players = [entry for entry in response.strip('"').split()[1:] if "=" not in entry]
+            rank = parse_command(send_command(f"LEADERBOARD username={username}", client_socket, secure))
+            leaderboard_window(players, rank['args'])
         else:
             messagebox.showerror("Leaderboard Error", "Unable to retrieve leaderboard")
 
     menu = tk.Tk()
     menu.title("Cyber Hunt - Main Menu")
-    menu.geometry("400x400")
+    menu.geometry("400x450")
     tk.Label(menu, text=f"Welcome, {username}").pack()
 
     # Main menu buttons
@@ -144,7 +161,7 @@ def main_menu(secure):
             command = parse_command(response)
             if command['type'] == "JOIN_ROOM_NAME":
                 menu.destroy()
-                lobby_screen(secure, room_info=command['args']['room_name'])
+                lobby_screen(secure, room_info=command['args']['room_name'], max_players=room_capacity(command))
             else:
                 messagebox.showerror("Join Failed", f"Failed to join room {room_name}: {response}")
         else:
@@ -153,15 +170,27 @@ def main_menu(secure):
     join_specific_button = tk.Button(menu, text="Join Specific Room", command=join_specific_room)
     join_specific_button.pack(pady=5)
 
+    # Optional map size and player cap for Create Room, left empty the server defaults apply
+    size_frame = tk.Frame(menu)
+    size_frame.pack(pady=5)
+    tk.Label(size_frame, text="Grid size:").pack(side=tk.LEFT)
+    grid_size_entry = tk.Entry(size_frame, width=5)
+    grid_size_entry.pack(side=tk.LEFT, padx=5)
+    tk.Label(size_frame, text="Max players:").pack(side=tk.LEFT)
+    max_players_entry = tk.Entry(size_frame, width=5)
+    max_players_entry.pack(side=tk.LEFT, padx=5)
+
     menu.mainloop()
 
 
-def leaderboard_window(players):
+def leaderboard_window(players, rank=None):
     leaderboard_win = tk.Toplevel()
     leaderboard_win.title("Leaderboard")
-    leaderboard_win.geometry("300x300")
+    leaderboard_win.geometry("300x320")
 
     tk.Label(leaderboard_win, text="Leaderboard", font=("Arial", 16, "bold")).pack(pady=10)
+    if rank and 'rank' in rank:
+        tk.Label(leaderboard_win, text=f"Your rank: #{rank['rank']} of {rank['total']} ({rank['wins']} wins)").pack()
 
     leaderboard_listbox = tk.Listbox(leaderboard_win, height=10, width=30)
     leaderboard_listbox.pack(pady=10)
@@ -172,9 +201,10 @@ def leaderboard_window(players):
     leaderboard_win.mainloop()
 
 
-def lobby_screen(secure, room_info="Room Info", players=None, is_host=False):
+def lobby_screen(secure, room_info="Room Info", players=None, is_host=False, max_players=4):
     if players is None:
         players = []
+    refresh_ticket(client_socket, secure)
 
     lobby = tk.Tk()
     lobby.title("Cyber Hunt - Lobby")
@@ -192,7 +222,7 @@ def lobby_screen(secure, room_info="Room Info", players=None, is_host=False):
     players_frame = tk.Frame(lobby)
     players_frame.pack(pady=10)
 
-    players_label = tk.Label(players_frame, text=f"Players in Room: {len(players)} / 4")
+    players_label = tk.Label(players_frame, text=f"Players in Room: {len(players)} / {max_players}")
     players_label.pack()
 
     start_time = time.time()
@@ -234,7 +264,7 @@ def lobby_screen(secure, room_info="Room Info", players=None, is_host=False):
                 for player in players:
                     tk.Label(player_list_frame, text=f"• {player}").pack(anchor='w')
 
-                players_label.config(text=f"Players in Room: {len(players)} / 4")
+                players_label.config(text=f"Players in Room: {len(players)} / {max_players}")
 
                 if starting.startswith("True"):
                     lobby.destroy()
@@ -261,6 +291,7 @@ def lobby_screen(secure, room_info="Room Info", players=None, is_host=False):
     def leave_room():
         response = send_command("LEAVE",client_socket, secure)
         if response.startswith("LEAVE_SUCCESS"):
+            refresh_ticket(client_socket, secure)
             on_close()
             main_menu(secure)
         else:
@@ -290,8 +321,7 @@ def launch_game(client_socket, username, secure):
     font = pygame.font.SysFont(None, 32)
     small_font = pygame.font.SysFont(None, 24)
 
-    grid_size = 6
-    cell_size = 60
+    grid_pixels = 360  # The grid is scaled to fit this square whatever its size
     grid_origin = (50, 50)
 
     click_display_pos = None
@@ -302,6 +332,8 @@ def launch_game(client_socket, username, secure):
 
     pos = send_command("POSITION", client_socket, secure).split()
     player_pos = [int(pos[1]), int(pos[2])]
+    grid_size = int(pos[3]) if len(pos) > 3 else 6
+    cell_size = max(1, grid_pixels // grid_size)
 
     BG_COLOR = (30, 30, 30)
     GRID_COLOR = (200, 200, 200)
@@ -316,6 +348,7 @@ def launch_game(client_socket, username, secure):
     gx, gy = -1, -1
     is_alive = True
     won = False
+    room_closed = False  # The server retired the room after the game ended
     messages = []
 
     chat_input_box = pygame.Rect(500, 500, 200, 50)
@@ -344,10 +377,9 @@ def launch_game(client_socket, username, secure):
     timer_thread = threading.Thread(target=turn_timer_loop, daemon=True)
     timer_thread.start()
 
-    def check_status():
+    def apply_status(response):
         nonlocal turn_text_surface, players_text_surface, is_alive, won, turn_start_time, turn_timer_active
 
-        response = send_command("STATUS", client_socket, secure)
         if response.startswith("STATUS"):
             parts = response.split("|")
             status_part = parts[0].strip()
@@ -414,7 +446,27 @@ def launch_game(client_socket, username, secure):
                 except Exception as e:
                     pass
 
-    status_check_timer = 0
+    state_version = 0
+    state_sections = {}
+
+    def apply_state(frame):
+        # STATE frames carry only the sections that changed since the version we hold
+        nonlocal state_version
+        header, *sections = frame.split("|")
+        args = parse_command(header)['args']
+        base = int(args.get('base', state_version))
+        if base != 0 and base != state_version:
+            # A frame went missing, ask for everything again
+            post_command("STATUS since=0", client_socket, secure)
+            return
+        for section in sections:
+            state_sections[section.split(" ", 1)[0]] = section
+        state_version = int(args['version'])
+        if len(state_sections) == 4:
+            apply_status("|".join(state_sections[name] for name in ("STATUS", "TURN", "WINNER", "CHAT")))
+
+    # The server pushes a STATE frame whenever the game state changes
+    send_command("SUBSCRIBE", client_socket, secure)
 
     chat_input_text = ""
     typing_in_chat = False
@@ -431,21 +483,25 @@ def launch_game(client_socket, username, secure):
     while game_running:
         screen.fill(BG_COLOR)
 
-        for row in range(grid_size):
-            for col in range(grid_size):
-                rect = pygame.Rect(
-                    grid_origin[0] + col * cell_size,
-                    grid_origin[1] + row * cell_size,
-                    cell_size,
-                    cell_size
-                )
-                pygame.draw.rect(screen, GRID_COLOR, rect, 1)
+        if cell_size >= 6:
+            for row in range(grid_size):
+                for col in range(grid_size):
+                    rect = pygame.Rect(
+                        grid_origin[0] + col * cell_size,
+                        grid_origin[1] + row * cell_size,
+                        cell_size,
+                        cell_size
+                    )
+                    pygame.draw.rect(screen, GRID_COLOR, rect, 1)
+        else:
+            # Cells too small for their own borders, just outline the map
+            pygame.draw.rect(screen, GRID_COLOR, pygame.Rect(grid_origin, (grid_size * cell_size,) * 2), 1)
 
         player_rect = pygame.Rect(
             grid_origin[0] + player_pos[0] * cell_size,
             grid_origin[1] + player_pos[1] * cell_size,
-            cell_size,
-            cell_size
+            max(cell_size, 4),  # Still visible on large maps
+            max(cell_size, 4)
         )
         pygame.draw.rect(screen, PLAYER_COLOR, player_rect)
 
@@ -487,7 +543,7 @@ def launch_game(client_socket, username, secure):
                     typing_in_chat = True
                 else:
                     typing_in_chat = False
-                if not is_alive or won:
+                if not is_alive or won or room_closed:
                     continue
                 for rect, action in buttons:
                     if rect.collidepoint(event.pos):
@@ -496,21 +552,21 @@ def launch_game(client_socket, username, secure):
                                 if gx >= 0 and gy >= 0:
                                     response = send_command(f"{a} x={gx} y={gy}", client_socket, secure)
                                     parsed = parse_command(response)
-                                    msg = response[response.find("msg=") + 4:]
+                                    msg = response[response.find("msg=") + 4:] if "msg=" in response else response
                                     log(msg)
                             case "ENCRYPT" | "EVADE":
                                 response = send_command(action, client_socket, secure)
                                 parsed = parse_command(response)
-                                msg = response[response.find("msg=") + 4:]
+                                msg = response[response.find("msg=") + 4:] if "msg=" in response else response
                                 log(msg)
-                                if action == "EVADE" and parsed["args"]["success"].startswith("True"):
+                                if action == "EVADE" and parsed["args"].get("success", "").startswith("True"):
                                     x, y = msg.split()[-2], msg.split()[-1][:-1]
                                     player_pos[0], player_pos[1] = int(x), int(y)
 
                 x, y = event.pos
                 gx = (x - grid_origin[0]) // cell_size
                 gy = (y - grid_origin[1]) // cell_size
-                if 0 <= gx < 6 and 0 <= gy < 6:
+                if 0 <= gx < grid_size and 0 <= gy < grid_size:
                     click_display_pos = (x, y)
                     click_grid_coords = (gx, gy)
 
@@ -538,10 +594,15 @@ def launch_game(client_socket, username, secure):
                 screen.blit(line_surf, (x, y))
 
         
-        status_check_timer += 1
-        if status_check_timer >= 30:
-            check_status()
-            status_check_timer = 0
+        while not status_queue.empty():
+            frame = status_queue.get_nowait()
+            if frame.startswith("STATE"):
+                apply_state(frame)
+            elif frame.startswith("ROOM_CLOSED"):
+                room_closed = True
+                log("The room was closed.")
+            else:
+                apply_status(frame)
         
         for i, msg in enumerate(chat_message_list[-4:]):
             msg_surface = small_font.render(msg, True, (200, 200, 100))
@@ -551,15 +612,23 @@ def launch_game(client_socket, username, secure):
     
     response = send_command("LEAVE",client_socket, secure)
     time.sleep(0.1)
-    client_socket.close()
+    close_connection(client_socket)
     pygame.quit()
     sys.exit()
 
+def connect_to_server(address):
+    # Resumes the last session if we hold a ticket, otherwise a full key exchange
+    conn = Connection(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+    conn.connect(address)
+    secure, response = resume_session(conn)
+    if secure is None:
+        secure = key_exchange(conn)
+    negotiate_framing(conn, secure)
+    if SESSION_CIPHER:
+        negotiate_cipher(conn, secure, SESSION_CIPHER)
+    start_dispatcher(conn, secure, status_queue, address)
+    return conn, secure, response
+
 if __name__ == "__main__":
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect(('127.0.0.1', 5050))
-    secure = DiffieHellmanChannel()
-    server_pub = int(client_socket.recv(4096).decode())
-    client_socket.send(str(secure.public).encode())
-    secure.generate_shared_key(server_pub)
+    client_socket, secure, _ = connect_to_server(('127.0.0.1', 5050))
     login_screen(secure)
\ No newline at end of file
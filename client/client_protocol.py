@@ -1,43 +1,113 @@
+import itertools
+import os
+import queue
+import socket
+import threading
+import time
+
+from KeyExchange import CHANNELS, ResumedChannel
+from wire import FRAME_HEADER, MAX_FRAME, FrameReader, decode_binary, encode_binary
+
 DEBUG = True
 
 def debug_print(*args):
     if DEBUG:
         print("[DEBUG]", *args)
 
-def sendWithSize(message, conn, secure):
+REQUEST_TIMEOUT = 10  # Seconds to wait for a reply before giving up on it
+RECONNECT_DELAYS = (0.5, 1, 2, 4)  # Seconds before each attempt to resume a dropped session
+VIEW_MAX_PAGE = 200  # Largest VIEW page the server sends
+SESSION_CIPHER = None  # "gcm" or "chacha20" to switch to AEAD after connecting; CBC is faster per frame
+
+class Connection(FrameReader):
+    """A FrameReader that sends straight to the socket."""
+    def connect(self, address):
+        self.sock.connect(address)
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+def encode_command(cmd, request_id=0):
+    command = parse_command(cmd)
+    if command['type'] == 'CHAT':
+        command['args']['msg'] = cmd[cmd.find("msg=") + 4:]
+    return encode_binary(command['type'], command['args'], request_id)
+
+def sendWithSize(message, conn, secure, request_id=0):
     if isinstance(message, str):
-        message = message.encode()
+        if getattr(conn, "binary", False):
+            message = encode_command(message, request_id)
+        elif request_id:
+            message = f"#{request_id} {message}".encode()
+        else:
+            message = message.encode()
     elif not isinstance(message, bytes):
         raise TypeError("Message must be str or bytes")
 
     encrypted = secure.encrypt(message)
 
-    length = str(len(encrypted)).zfill(8).encode()
+    if getattr(conn, "binary", False):
+        length = FRAME_HEADER.pack(len(encrypted))
+    else:
+        length = str(len(encrypted)).zfill(8).encode()
     conn.sendall(length + encrypted)
 
+def recvExactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
 
-def recvWithSize(conn, secure):
-    length_data = conn.recv(8)
+def recvFrame(conn):
+    if isinstance(conn, Connection):
+        return conn.read_frame()
+
+    binary = getattr(conn, "binary", False)
+    length_data = recvExactly(conn, FRAME_HEADER.size if binary else 8)
     if not length_data:
         return None
-    try:
-        length = int(length_data.decode().strip())
-    except ValueError:
+    if binary:
+        length, = FRAME_HEADER.unpack(length_data)
+    else:
+        try:
+            length = int(length_data.decode().strip())
+        except ValueError:
+            return None
+    if not 0 <= length <= MAX_FRAME:
         return None
+    return recvExactly(conn, length)
 
-    encrypted_data = b""
-    while len(encrypted_data) < length:
-        chunk = conn.recv(length - len(encrypted_data))
-        if not chunk:
-            return None
-        encrypted_data += chunk
+def recvWithId(conn, secure):
+    # Returns (request ID, message); the ID is 0 for pushes and untagged replies
+    binary = getattr(conn, "binary", False)
+    encrypted_data = recvFrame(conn)
+    if encrypted_data is None:
+        return 0, None
+
+    if binary:
+        command = decode_binary(secure.decrypt_bytes(encrypted_data))
+        return command['id'], command['args'].get('text', "")
 
     decrypted = secure.decrypt(encrypted_data)
 
     if isinstance(decrypted, str):
-        return decrypted
+        msg = decrypted
     else:
-        return decrypted.decode()
+        msg = decrypted.decode()
+    if msg.startswith("#"):
+        tag, _, rest = msg.partition(" ")
+        if tag[1:].isdigit():
+            return int(tag[1:]), rest
+    return 0, msg
+
+def recvWithSize(conn, secure):
+    return recvWithId(conn, secure)[1]
 
 def parse_command(msg):
     parts = msg.strip().split()
@@ -52,8 +122,191 @@ def parse_command(msg):
     debug_print({'type': cmd_type, 'args': args})
     return {'type': cmd_type, 'args': args}
 
+class Dispatcher:
+    """Owns the socket: tags each request with an ID and hands the reply to whoever is waiting on it.
+
+    Pushed state and ROOM_CLOSED frames (and state replies nobody waits for) go to status_queue.
+    Given the server's address, a dropped connection is resumed on a new socket with the stored
+    session ticket, and callers holding the old socket keep going through the new one.
+    """
+    def __init__(self, conn, secure, status_queue, address=None):
+        self.conn = conn
+        self.secure = secure
+        self.conns = {id(conn)}  # Every socket this dispatcher has owned, the first one included
+        self.address = address
+        self.subscribed = False  # Resubscribe after a reconnect, the server forgets it
+        self.closing = False
+        self.down = False  # Between a drop and the reconnect, requests fail straight away
+        self.status_queue = status_queue
+        self.pending = {}  # request ID -> queue the reply is put on
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock()  # Frames from different threads must not interleave
+        self.request_ids = itertools.count(1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, cmd):
+        waiter = queue.Queue(maxsize=1)
+        with self.pending_lock:
+            if self.down:
+                return 'DISCONNECTED reason="Reconnecting"'
+            request_id = next(self.request_ids)
+            self.pending[request_id] = waiter
+        self.track(cmd)
+        with self.send_lock:
+            try:
+                sendWithSize(cmd, self.conn, self.secure, request_id)
+            except ValueError as e:
+                # Nothing was sent: the binary encoding can't carry the arguments
+                with self.pending_lock:
+                    self.pending.pop(request_id, None)
+                return invalid_reply(cmd, e)
+            except OSError:
+                pass  # The reader notices too; the waiter is answered when it reconnects or gives up
+        try:
+            return waiter.get(timeout=REQUEST_TIMEOUT)
+        except queue.Empty:
+            # A reply that turns up later is dropped as unmatched
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            return 'TIMEOUT reason="No reply from server"'
+
+    def post(self, cmd):
+        # Fire and forget, the untagged reply is routed like a push
+        self.track(cmd)
+        with self.send_lock:
+            try:
+                sendWithSize(cmd, self.conn, self.secure)
+            except ValueError as e:
+                debug_print(invalid_reply(cmd, e))
+            except OSError:
+                pass
+
+    def owns(self, conn):
+        return id(conn) in self.conns
+
+    def close(self):
+        # A deliberate close, not a drop to recover from
+        self.closing = True
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)  # close() alone doesn't wake a blocked recv
+        except OSError:
+            pass
+        self.conn.close()
+
+    def track(self, cmd):
+        if cmd.startswith("SUBSCRIBE"):
+            self.subscribed = True
+        elif cmd.startswith("LEAVE"):
+            self.subscribed = False
+
+    def run(self):
+        while True:
+            self.read_frames()
+            # Nothing sent on the dropped socket will be answered
+            self.fail_pending('DISCONNECTED reason="Connection lost"')
+            if not self.reconnect():
+                break
+
+    def read_frames(self):
+        try:
+            while True:
+                request_id, msg = recvWithId(self.conn, self.secure)
+                if msg is None:
+                    return
+                with self.pending_lock:
+                    waiter = self.pending.pop(request_id, None)
+                if waiter:
+                    waiter.put(msg)
+                elif msg.startswith(("STATUS", "STATE", "ROOM_CLOSED")):
+                    self.status_queue.put(msg)
+                else:
+                    debug_print(f"Unmatched frame: {msg}")
+        except (OSError, ValueError) as e:
+            debug_print(f"Dispatcher stopped: {e}")
+
+    def fail_pending(self, reply):
+        with self.pending_lock:
+            self.down = True
+            waiters, self.pending = self.pending, {}
+        for waiter in waiters.values():
+            waiter.put(reply)
+
+    def reconnect(self):
+        # Resume the session on a new socket; without a ticket, or once the server rejects it,
+        # there is nothing to resume without logging in again
+        if self.address is None or self.closing:
+            return False
+        binary = self.conn.binary
+        cipher = getattr(self.secure, "aead_mode", None)
+        for delay in RECONNECT_DELAYS:
+            time.sleep(delay)
+            if session_ticket is None or self.closing:
+                return False
+            try:
+                conn = Connection(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+                conn.connect(self.address)
+                secure, response = resume_session(conn)
+                if secure is None:
+                    conn.close()
+                    return False
+                if binary:
+                    negotiate_framing(conn, secure)
+                if cipher:
+                    negotiate_cipher(conn, secure, cipher)
+            except (OSError, ValueError) as e:
+                debug_print(f"Reconnect failed: {e}")
+                continue
+            with self.send_lock:
+                if self.closing:
+                    conn.close()
+                    return False
+                self.conn, self.secure = conn, secure
+                self.conns.add(id(conn))
+            with self.pending_lock:
+                self.down = False
+            debug_print(f"Reconnected: {response}")
+            if self.subscribed:
+                self.post("SUBSCRIBE")
+            return True
+        return False
+
+dispatcher = None
+
+def start_dispatcher(conn, secure, status_queue, address=None):
+    # Run after negotiate_framing, which still reads its reply directly
+    global dispatcher
+    dispatcher = Dispatcher(conn, secure, status_queue, address)
+    return dispatcher
+
+def close_connection(conn):
+    # Closes whichever socket the dispatcher uses now, without it trying to reconnect
+    if dispatcher is not None and dispatcher.owns(conn):
+        dispatcher.close()
+    else:
+        conn.close()
+
+def current_secure(conn, secure):
+    # The channel in use now, which is a new one once the dispatcher has reconnected
+    if dispatcher is not None and dispatcher.owns(conn):
+        return dispatcher.secure
+    return secure
+
+def invalid_reply(cmd, error):
+    # What send_command answers for a command it couldn't encode, shaped like the server's failures
+    return f'{cmd.split()[0]}_FAIL reason="{error}"'
+
 def send_command(cmd, client_socket, secure):
-    sendWithSize(cmd, client_socket, secure)
+    # A reconnect negotiates on its new socket before taking over the dispatcher
+    if dispatcher is not None and dispatcher.owns(client_socket):
+        returned = dispatcher.request(cmd)
+        debug_print(returned)
+        return returned
+
+    try:
+        sendWithSize(cmd, client_socket, secure)
+    except ValueError as e:
+        return invalid_reply(cmd, e)
     returned = recvWithSize(client_socket, secure)
     returnedP = parse_command(returned)
     cmdType = cmd.split()[0]
@@ -71,6 +324,113 @@ def send_command(cmd, client_socket, secure):
     debug_print(returned)
     return returned
 
+def post_command(cmd, client_socket, secure):
+    if dispatcher is not None and dispatcher.owns(client_socket):
+        dispatcher.post(cmd)
+    else:
+        try:
+            sendWithSize(cmd, client_socket, secure)
+        except ValueError as e:
+            debug_print(invalid_reply(cmd, e))
+
+def sendPlain(message, conn):
+    # Only the key exchange goes out unencrypted
+    data = message.encode()
+    conn.sendall(str(len(data)).zfill(8).encode() + data)
+
+def recvKeyExchange(conn, mode):
+    reply = recvFrame(conn)
+    if reply is None:
+        raise ConnectionError("Server closed the connection during key exchange")
+    command = parse_command(bytes(reply).decode())
+    if command['type'] != 'KEX' or command['args'].get('mode') != mode:
+        raise ValueError(f"Unexpected key exchange reply: {bytes(reply)[:64]!r}")
+    return command['args']
+
+def key_exchange(conn, mode="x25519"):
+    # The client speaks first and picks the mode; the server answers with its own public key
+    secure = CHANNELS[mode]()
+    sendPlain(f"KEX mode={mode} pub={secure.encode_public()}", conn)
+    reply = recvKeyExchange(conn, mode)
+    secure.generate_shared_key(secure.decode_public(reply['pub']))
+    return secure
+
+room_list = {}  # room_id -> "name(n/max)", the first VIEW_MAX_PAGE open rooms, oldest first
+room_list_version = None
+room_list_total = 0  # Open rooms on the server, which can be more than room_list holds
+
+def fetch_room_list(conn, secure):
+    # Returns (room_list, total). Deltas cover every room, so they are only merged while
+    # room_list holds all of them; a truncated list is fetched again as a fresh first page
+    global room_list_version, room_list_total
+    if room_list_version is None or room_list_total > len(room_list):
+        response = send_command(f"VIEW limit={VIEW_MAX_PAGE}", conn, secure)
+    else:
+        response = send_command(f"VIEW since={room_list_version}", conn, secure)
+    command = parse_command(response)
+    args = command['args']
+    if command['type'] == "VIEW_ROOM_LIST":
+        room_list.clear()
+        room_list_total = int(args['total'])
+    elif command['type'] == "VIEW_ROOM_DELTA":
+        for room_id in args.get('removed', "").split(","):
+            room_list.pop(room_id, None)
+    else:
+        return room_list, room_list_total
+    room_list.update((key, value) for key, value in args.items() if key.isdigit())
+    if command['type'] == "VIEW_ROOM_DELTA":
+        # New rooms come after the ones we have, like on the server, so keep the oldest
+        room_list_total = len(room_list)
+        for room_id in list(room_list)[VIEW_MAX_PAGE:]:
+            del room_list[room_id]
+    room_list_version = int(args['version'])
+    return room_list, room_list_total
+
+session_ticket = None  # (ticket, resumption secret) from the last reply that carried a ticket
+
+def remember_ticket(response, secure):
+    global session_ticket
+    ticket = parse_command(response)['args'].get('ticket')
+    if ticket:
+        session_ticket = (ticket, secure.resumption_secret())
+
+def refresh_ticket(conn, secure):
+    # After joining or leaving a room, so a resume puts us back where we are now
+    response = send_command("TICKET", conn, secure)
+    remember_ticket(response, current_secure(conn, secure))
+
+def resume_session(conn):
+    # Returns (secure, RESUME_SUCCESS reply), or (None, None) if there is no ticket or the server
+    # rejected it; the connection is then still waiting for a full key_exchange
+    if session_ticket is None:
+        return None, None
+    ticket, secret = session_ticket
+    client_nonce = os.urandom(16)
+    sendPlain(f"KEX mode=resume ticket={ticket} nonce={client_nonce.hex()}", conn)
+    reply = recvKeyExchange(conn, "resume")
+    if 'nonce' not in reply:
+        return None, None
+    secure = ResumedChannel(secret, client_nonce + bytes.fromhex(reply['nonce']))
+    response = recvWithSize(conn, secure)
+    remember_ticket(response, secure)
+    return secure, response
+
+def negotiate_framing(conn, secure, mode="binary"):
+    # Must run before start_dispatcher, the reply is still in the old framing
+    response = send_command(f"FRAMING mode={mode}", conn, secure)
+    if response.startswith("FRAMING_SUCCESS"):
+        conn.binary = mode == "binary"
+    return conn.binary
+
+def negotiate_cipher(conn, secure, mode="gcm"):
+    # Switch the session to an AEAD cipher; like framing, this happens before start_dispatcher.
+    # Opt-in through SESSION_CIPHER: PyCryptodome builds a new AEAD cipher object for every frame
+    response = send_command(f"CIPHER mode={mode}", conn, secure)
+    if response.startswith("CIPHER_SUCCESS"):
+        secure.use_aead("client", mode)
+        return True
+    return False
+
 def parse_status(response):
     parts = response.split("|")
     debug_print([parse_command(parts[0]),parse_command(parts[1]),parse_command(parts[2]) if parts[2] else ""])
@@ -0,0 +1,173 @@
+import struct
+
+# The wire format both sides speak. server/wire.py and client/wire.py are the same file, copied
+# so each side still runs on its own; tests/test_wire.py fails if they drift apart.
+
+# Binary framing: 4-byte length prefix, then an encrypted payload of opcode, argument
+# presence mask and request ID, followed by the present arguments in table order
+FRAME_HEADER = struct.Struct("!I")
+OP_HEADER = struct.Struct("!BBI")
+ARG_INT = struct.Struct("!i")
+ARG_STR_LEN = struct.Struct("!H")
+
+# opcode: (command, argument names)
+OPCODES = {
+    0: ("TEXT", ("text",)),
+    1: ("LOGIN", ("username", "password")),
+    2: ("REGISTER", ("username", "password")),
+    3: ("JOIN", ()),
+    4: ("CREATE", ("room_name", "grid_size", "max_players")),
+    5: ("VIEW", ("offset", "limit", "since")),
+    6: ("SCAN", ("x", "y")),
+    7: ("HACK", ("x", "y")),
+    8: ("EVADE", ()),
+    9: ("ENCRYPT", ()),
+    10: ("PLAYERS", ()),
+    11: ("LEAVE", ()),
+    12: ("START", ()),
+    13: ("USERNAME", ()),
+    14: ("POSITION", ()),
+    15: ("STATUS", ("since",)),
+    16: ("SUBSCRIBE", ()),
+    17: ("CHAT", ("msg",)),
+    18: ("CREATE_BOT", ()),
+    19: ("LEADERBOARD", ("offset", "limit", "username")),
+    20: ("END_TURN", ()),
+    21: ("JOIN_ROOM_NAME", ("room_name",)),
+    22: ("FRAMING", ("mode",)),
+    23: ("CIPHER", ("mode",)),
+    24: ("TICKET", ()),
+    25: ("ONLINE", ("users",)),
+}
+COMMAND_OPCODES = {name: (opcode, fields) for opcode, (name, fields) in OPCODES.items()}
+INT_ARGS = {"x", "y", "since", "offset", "limit", "grid_size", "max_players"}
+RECV_BUFFER_SIZE = 64 * 1024
+MAX_FRAME = 1024 * 1024  # Largest frame length a header may announce; anything else drops the peer
+
+# All-numeric commands unpack in one call when every argument is present
+PACKED_INTS = {
+    opcode: struct.Struct("!" + "i" * len(fields))
+    for opcode, (_, fields) in OPCODES.items()
+    if fields and all(field in INT_ARGS for field in fields)
+}
+
+def encode_binary(cmd_type, args, request_id=0):
+    opcode, fields = COMMAND_OPCODES[cmd_type]
+    parts = [b""]
+    mask = 0
+    for index, field in enumerate(fields):
+        if field not in args:
+            continue
+        mask |= 1 << index
+        if field in INT_ARGS:
+            try:
+                parts.append(ARG_INT.pack(int(args[field])))
+            except (ValueError, struct.error):
+                raise ValueError(f"Invalid number for {field}") from None
+        else:
+            data = str(args[field]).encode()
+            parts.append(ARG_STR_LEN.pack(len(data)))
+            parts.append(data)
+    parts[0] = OP_HEADER.pack(opcode, mask, request_id)
+    return b"".join(parts)
+
+def decode_binary(payload):
+    opcode, mask, request_id = OP_HEADER.unpack_from(payload)
+    if opcode not in OPCODES:
+        raise ValueError(f"Unknown opcode {opcode}")
+    cmd_type, fields = OPCODES[opcode]
+    if not mask:
+        return {'type': cmd_type, 'args': {}, 'id': request_id}
+    packed = PACKED_INTS.get(opcode)
+    if packed and mask == (1 << len(fields)) - 1:
+        return {'type': cmd_type, 'args': dict(zip(fields, packed.unpack_from(payload, OP_HEADER.size))), 'id': request_id}
+
+    offset = OP_HEADER.size
+    args = {}
+    for index, field in enumerate(fields):
+        if not mask >> index & 1:
+            continue
+        if field in INT_ARGS:
+            args[field], = ARG_INT.unpack_from(payload, offset)
+            offset += ARG_INT.size
+        else:
+            size, = ARG_STR_LEN.unpack_from(payload, offset)
+            offset += ARG_STR_LEN.size
+            args[field] = bytes(payload[offset:offset + size]).decode()
+            offset += size
+    return {'type': cmd_type, 'args': args, 'id': request_id}
+
+class FrameReader:
+    """Per-connection state kept alongside the socket: framing mode and a buffered frame reader.
+    Each side's Connection adds how it sends."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.binary = False
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First unread byte
+        self.end = 0  # One past the last received byte
+
+    def recv(self, buffer_size):
+        if self.end > self.start:
+            # Hand out anything already buffered first
+            size = min(buffer_size, self.end - self.start)
+            data = bytes(self.view[self.start:self.start + size])
+            self.start += size
+            return data
+        return self.sock.recv(buffer_size)
+
+    def reserve(self, size):
+        # Make sure `size` bytes starting at self.start fit in the buffer
+        if self.start + size <= len(self.buffer):
+            return
+        unread = self.end - self.start
+        if size > len(self.buffer):
+            # Never resize in place, a frame handed out earlier may still be viewing the old buffer
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:unread] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            # Only the partial tail is copied
+            self.buffer[:unread] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = unread
+
+    def read_frame(self):
+        """Returns the next encrypted frame as a memoryview into the buffer, valid until the next call."""
+        while True:
+            header_size = FRAME_HEADER.size if self.binary else 8
+            available = self.end - self.start
+            needed = header_size
+            if available >= header_size:
+                if self.binary:
+                    length, = FRAME_HEADER.unpack_from(self.buffer, self.start)
+                else:
+                    try:
+                        length = int(self.buffer[self.start:self.start + 8])
+                    except ValueError:
+                        return None
+                if not 0 <= length <= MAX_FRAME:
+                    return None  # Garbage or hostile, don't grow the buffer for it
+                needed = header_size + length
+                if available >= needed:
+                    frame = self.view[self.start + header_size:self.start + needed]
+                    self.start += needed
+                    if self.start == self.end:
+                        self.start = self.end = 0
+                        if len(self.buffer) > RECV_BUFFER_SIZE:
+                            # Drop back to the normal size after an oversized frame
+                            self.buffer = bytearray(RECV_BUFFER_SIZE)
+                            self.view = memoryview(self.buffer)
+                    return frame
+
+            # One syscall takes everything the kernel has, possibly several frames
+            self.reserve(max(needed, RECV_BUFFER_SIZE // 2))
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return None
+            self.end += received
+
+    def close(self):
+        self.sock.close()
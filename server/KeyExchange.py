@@ -1,51 +1,333 @@
-from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher import AES, ChaCha20_Poly1305, PKCS1_OAEP
 from Crypto.Random import get_random_bytes
 from Crypto.Hash import SHA256
 from Crypto.Util.Padding import pad, unpad
-from Crypto.PublicKey import RSA
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Protocol.DH import import_x25519_public_key, key_agreement
+from Crypto.Protocol.KDF import HKDF
+import base64
+import collections
+import json
+import os
 import random
+import struct
+import tempfile
+import threading
+import time
 
 PRIME = 2**2048 - 159  # a big prime
 GENERATOR = 2
 
+# AEAD session mode (AES-GCM or ChaCha20-Poly1305): every frame is an 8-byte counter, the ciphertext and a 16-byte tag.
+# The nonce is the sender's direction prefix + that counter, so the two sides never share one
+NONCE_PREFIXES = {"server": b"\x00\x00\x00\x01", "client": b"\x00\x00\x00\x02"}
+COUNTER = struct.Struct("!Q")
+TAG_SIZE = 16
+AEAD_MODES = ("gcm", "chacha20")
+
+def generate_dh_keypair():
+    private = random.randint(2, PRIME - 2)
+    return private, pow(GENERATOR, private, PRIME)
+
+def dh_session_key(other_public, private):
+    # Module-level so it can be sent to a worker process
+    shared_secret = pow(other_public, private, PRIME)
+    sha = SHA256.new()
+    sha.update(str(shared_secret).encode())
+    return sha.digest()[:16]
+
+def generate_x25519_keypair():
+    private = ECC.generate(curve="Curve25519")
+    return private, private.public_key().export_key(format="raw")
+
+class KeyPool:
+    """Keys generated ahead of time by background threads, so a burst of handshakes
+    doesn't pay for key generation on the connection threads."""
+    def __init__(self, generate, size=64, workers=1, executor=None):
+        self.generate = generate
+        self.size = size
+        self.workers = workers
+        self.executor = executor  # Generate in worker processes instead of holding the GIL
+        self.keys = collections.deque()
+        self.wanted = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = 0  # Keys being generated right now, counted against size
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        self.wanted.set()
+        for _ in range(self.workers):
+            threading.Thread(target=self.refill, daemon=True).start()
+        return self
+
+    def refill(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            while True:
+                # Reserve the slot first, so several workers never fill past size between them
+                with self.lock:
+                    if len(self.keys) + self.pending >= self.size:
+                        break
+                    self.pending += 1
+                try:
+                    if self.executor is not None:
+                        keypair = self.executor.submit(self.generate).result()
+                    else:
+                        keypair = self.generate()
+                finally:
+                    with self.lock:
+                        self.pending -= 1
+                with self.lock:
+                    self.keys.append(keypair)
+                    self.generated += 1
+
+    def get(self):
+        try:
+            keypair = self.keys.popleft()
+            hit = True
+        except IndexError:
+            keypair = self.executor.submit(self.generate).result() if self.executor else self.generate()
+            hit = False
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.wanted.set()
+        return keypair
+
+    def stats(self):
+        # fill_rate is keys per second generated by the workers since start()
+        taken = self.hits + self.misses
+        elapsed = time.time() - self.started if self.started else 0
+        return {"size": len(self.keys), "hits": self.hits, "misses": self.misses, "generated": self.generated,
+                "hit_rate": self.hits / taken if taken else 0.0,
+                "fill_rate": self.generated / elapsed if elapsed else 0.0}
+
+def message_bytes(message):
+    if isinstance(message, str):
+        return message.encode()
+    if isinstance(message, bytes):
+        return message
+    raise TypeError("Message must be a string or bytes")
+
 class DiffieHellmanChannel:
-    def __init__(self):
-        self.private = random.randint(2, PRIME - 2)
-        self.public = pow(GENERATOR, self.private, PRIME)
+    mode = "dh"
+
+    def __init__(self, keypair=None):
+        self.private, self.public = keypair or generate_dh_keypair()
         self.shared_key = None
+        self.aead_key = None  # Set once the session switches to an AEAD mode
+
+    def encode_public(self):
+        return format(self.public, "x")
+
+    @staticmethod
+    def decode_public(text):
+        return int(text, 16)
 
     def generate_shared_key(self, other_public):
-        shared_secret = pow(other_public, self.private, PRIME)
-        sha = SHA256.new()
-        sha.update(str(shared_secret).encode())
-        self.shared_key = sha.digest()[:16]
+        self.shared_key = dh_session_key(other_public, self.private)
+
+    def resumption_secret(self):
+        # Goes into the session ticket; never used to encrypt anything itself
+        return HKDF(self.shared_key, 16, b"", SHA256, context=b"CyberHunt resumption")
+
+    def use_aead(self, role, mode="gcm"):
+        # Separate key for the AEAD session so it never shares one with the CBC frames
+        size = 16 if mode == "gcm" else 32
+        self.aead_key = HKDF(self.shared_key, size, b"", SHA256, context=f"CyberHunt {mode} session".encode())
+        self.aead_mode = mode
+        self.send_prefix = NONCE_PREFIXES[role]
+        self.recv_prefix = NONCE_PREFIXES["client" if role == "server" else "server"]
+        self.send_counter = 0
+        self.recv_counter = 0
+
+    def aead_cipher(self, nonce):
+        if self.aead_mode == "chacha20":
+            return ChaCha20_Poly1305.new(key=self.aead_key, nonce=nonce)
+        return AES.new(self.aead_key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+    def encrypt_aead(self, data):
+        self.send_counter += 1
+        counter = COUNTER.pack(self.send_counter)
+        cipher = self.aead_cipher(self.send_prefix + counter)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return b"".join((counter, ciphertext, tag))
+
+    def encrypt_frames(self, messages):
+        # A batch for one peer in a single pass: one random read covers every CBC IV
+        if self.aead_key is not None:
+            return [self.encrypt_aead(message_bytes(message)) for message in messages]
+        size = AES.block_size
+        ivs = get_random_bytes(size * len(messages))
+        frames = []
+        for i, message in enumerate(messages):
+            iv = ivs[i * size:(i + 1) * size]
+            frames.append(iv + AES.new(self.shared_key, AES.MODE_CBC, iv).encrypt(pad(message_bytes(message), size)))
+        return frames
 
     def encrypt(self, message):
-        if isinstance(message, str):
-            message_bytes = message.encode()
-        elif isinstance(message, bytes):
-            message_bytes = message
-        else:
-            raise TypeError("Message must be a string or bytes")
-
-        padded_message = pad(message_bytes, AES.block_size)
+        data = message_bytes(message)
+        if self.aead_key is not None:
+            return self.encrypt_aead(data)
+
+        padded_message = pad(data, AES.block_size)
         iv = get_random_bytes(AES.block_size)
         
         cipher = AES.new(self.shared_key, AES.MODE_CBC, iv)
         encrypted_message = cipher.encrypt(padded_message)
         return iv + encrypted_message
 
-    def decrypt(self, encrypted_message):
+    def decrypt_bytes(self, encrypted_message):
+        if self.aead_key is not None:
+            counter, = COUNTER.unpack_from(encrypted_message)
+            if counter <= self.recv_counter:
+                raise ValueError("Replayed or reordered frame")
+            cipher = self.aead_cipher(self.recv_prefix + encrypted_message[:COUNTER.size])
+            data = cipher.decrypt_and_verify(encrypted_message[COUNTER.size:-TAG_SIZE], encrypted_message[-TAG_SIZE:])
+            self.recv_counter = counter
+            return data
+
         iv = encrypted_message[:AES.block_size]
         ciphertext = encrypted_message[AES.block_size:]
 
         cipher = AES.new(self.shared_key, AES.MODE_CBC, iv)
-        decrypted_message = unpad(cipher.decrypt(ciphertext), AES.block_size)
-        return decrypted_message.decode()
+        return unpad(cipher.decrypt(ciphertext), AES.block_size)
+
+    def decrypt(self, encrypted_message):
+        return self.decrypt_bytes(encrypted_message).decode()
+
+class X25519Channel(DiffieHellmanChannel):
+    mode = "x25519"
+
+    def __init__(self, keypair=None):
+        self.private, self.public = keypair or generate_x25519_keypair()
+        self.shared_key = None
+        self.aead_key = None
+
+    def encode_public(self):
+        return self.public.hex()
+
+    @staticmethod
+    def decode_public(text):
+        return bytes.fromhex(text)
+
+    def generate_shared_key(self, other_public):
+        peer = import_x25519_public_key(other_public)
+        self.shared_key = key_agreement(static_priv=self.private, static_pub=peer,
+                                        kdf=lambda secret: SHA256.new(secret).digest()[:16])
+
+class ResumedChannel(DiffieHellmanChannel):
+    mode = "resume"
+
+    def __init__(self, resumption_secret, nonces):
+        # Fresh nonces from both sides, so a resumed session never reuses an old key
+        self.shared_key = HKDF(resumption_secret, 16, nonces, SHA256, context=b"CyberHunt resumed session")
+        self.aead_key = None
+
+class SessionTickets:
+    """Encrypted, time-limited resumption tickets. Only the server can open them, so the
+    session state travels with the client instead of being kept here."""
+    def __init__(self, lifetime=300, key=None):
+        self.key = key or get_random_bytes(32)
+        self.lifetime = lifetime
+
+    def issue(self, secret, username, room_id):
+        state = json.dumps({"s": secret.hex(), "u": username, "r": room_id,
+                            "e": time.time() + self.lifetime}).encode()
+        nonce = get_random_bytes(12)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+        ciphertext, tag = cipher.encrypt_and_digest(state)
+        return base64.urlsafe_b64encode(nonce + ciphertext + tag).decode()
+
+    def open(self, ticket):
+        # Returns the ticket's state, or None if it is forged, corrupted or expired
+        try:
+            data = base64.urlsafe_b64decode(ticket)
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=data[:12], mac_len=TAG_SIZE)
+            state = json.loads(cipher.decrypt_and_verify(data[12:-TAG_SIZE], data[-TAG_SIZE:]))
+        except (ValueError, TypeError):
+            return None
+        if state["e"] < time.time():
+            return None
+        state["s"] = bytes.fromhex(state["s"])
+        return state
+
+CHANNELS = {"x25519": X25519Channel, "dh": DiffieHellmanChannel}
+KEYPAIR_GENERATORS = {"x25519": generate_x25519_keypair, "dh": generate_dh_keypair}
+key_pools = {}
+
+def start_key_pools(size, executor=None, dh_size=0):
+    # X25519 keypairs are cheap enough to keep a pool of by default. Finite-field DH ones cost
+    # far more and the client rarely asks for them, so that pool only exists when dh_size is set,
+    # and it is the only one worth a trip to another process
+    if size:
+        key_pools["x25519"] = KeyPool(KEYPAIR_GENERATORS["x25519"], size).start()
+    if dh_size:
+        key_pools["dh"] = KeyPool(KEYPAIR_GENERATORS["dh"], dh_size, executor=executor).start()
+
+def new_channel(mode, run=None):
+    # Takes a pregenerated keypair when the pools are running; otherwise run(generate), if given,
+    # makes the keypair, e.g. on the CPU pool
+    pool = key_pools.get(mode)
+    if pool:
+        return CHANNELS[mode](pool.get())
+    if run is not None:
+        return CHANNELS[mode](run(KEYPAIR_GENERATORS[mode]))
+    return CHANNELS[mode]()
+
+RSA_KEY_BITS = 2048
+rsa_pool = None
+server_rsa_key = None
+
+def generate_rsa_key():
+    return RSA.generate(RSA_KEY_BITS)
+
+def start_rsa_pool(size, workers=2):
+    global rsa_pool
+    rsa_pool = KeyPool(generate_rsa_key, size, workers).start()
+    return rsa_pool
+
+def load_server_key(path):
+    # Long-lived key read once at startup; created on first run
+    global server_rsa_key
+    try:
+        with open(path, "rb") as f:
+            server_rsa_key = RSA.import_key(f.read())
+    except FileNotFoundError:
+        key = generate_rsa_key()
+        # Written owner-only under a temp name, then linked into place: another server starting
+        # at the same time either finds no file or a complete one, and the first link wins
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".rsa-", suffix=".pem")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(key.export_key())
+                f.flush()
+                os.fsync(f.fileno())
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return load_server_key(path)  # Another server created it first, use theirs
+        finally:
+            os.unlink(tmp_path)
+        server_rsa_key = key
+    return server_rsa_key
+
+def rsa_key():
+    if server_rsa_key is not None:
+        return server_rsa_key
+    if rsa_pool is not None:
+        return rsa_pool.get()
+    return generate_rsa_key()
 
 class RSAChannel:
-    def __init__(self):
-        key = RSA.generate(2048)
+    def __init__(self, key=None):
+        key = key or rsa_key()
         self.private_key = key
         self.public_key = key.publickey()
 
@@ -0,0 +1,18 @@
+import argparse
+
+import protocol
+from benchmarks import crypto, framing, rooms, storage
+
+def main():
+    protocol.DEBUG = False
+
+    parser = argparse.ArgumentParser(description="Cyber Hunt server benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    for module in (framing, crypto, storage, rooms):
+        module.add_parsers(sub)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
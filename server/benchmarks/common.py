@@ -0,0 +1,81 @@
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import protocol
+from KeyExchange import CHANNELS, ResumedChannel
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Server started with debug output off so printing doesn't dominate the numbers
+SERVER_BOOTSTRAP = (
+    "import sys; sys.path.insert(0, {dir!r}); "
+    "import protocol; protocol.DEBUG = False; "
+    "import server; server.main(sys.argv[1:])"
+)
+
+def start_server(engine, port):
+    cmd = [sys.executable, "-c", SERVER_BOOTSTRAP.format(dir=SERVER_DIR),
+           "--engine", engine, "--host", "127.0.0.1", "--port", str(port)]
+    # Run in a scratch directory so benchmark accounts never touch the real users file
+    workdir = tempfile.mkdtemp(prefix="cyberhunt-bench-")
+    os.makedirs(os.path.join(workdir, "server"))
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{engine} server did not start on port {port}")
+
+def open_client(port, mode="x25519"):
+    conn = socket.create_connection(("127.0.0.1", port))
+    secure = CHANNELS[mode]()
+    protocol.sendPlain(f"KEX mode={mode} pub={secure.encode_public()}", conn)
+    reply = protocol.parse_command(protocol.recvFrame(conn).decode())
+    secure.generate_shared_key(secure.decode_public(reply['args']['pub']))
+    return conn, secure
+
+def open_resumed(port, ticket, secret):
+    conn = socket.create_connection(("127.0.0.1", port))
+    nonce = os.urandom(16)
+    protocol.sendPlain(f"KEX mode=resume ticket={ticket} nonce={nonce.hex()}", conn)
+    reply = protocol.parse_command(protocol.recvFrame(conn).decode())
+    secure = ResumedChannel(secret, nonce + bytes.fromhex(reply['args']['nonce']))
+    return conn, secure, protocol.recvWithSize(conn, secure)
+
+class NullSocket:
+    """Swallows replies, so handler benchmarks time the handler and not a socket."""
+    def sendall(self, data):
+        pass
+
+class SinkSocket:
+    """Writes replies to /dev/null: a real system call that lets go of the GIL, like a socket send."""
+    fd = None
+
+    def sendall(self, data):
+        if SinkSocket.fd is None:
+            SinkSocket.fd = os.open(os.devnull, os.O_WRONLY)
+        os.write(SinkSocket.fd, data)
+
+def rate(func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return count / (time.perf_counter() - start)
+
+def fill_rooms(rooms, count, started_share):
+    # The oldest started_share of the rooms are full games in progress (rooms fill in the
+    # order they were made), the newer ones open with 1-2 players
+    for room_id in range(count):
+        room = rooms.add(protocol.GameRoom(room_id))
+        started = room_id < count * started_share
+        for i in range(4 if started else random.randint(1, 2)):
+            room.add_player(protocol.Player(NullSocket(), None, f"r{room_id}p{i}"))
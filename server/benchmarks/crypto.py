@@ -0,0 +1,201 @@
+import os
+import tempfile
+import threading
+import time
+
+import KeyExchange
+import protocol
+import storage
+import workers
+from KeyExchange import AEAD_MODES, CHANNELS, DiffieHellmanChannel, KeyPool, RSAChannel
+from sessions import SessionIndex
+
+from benchmarks.common import open_client, open_resumed, start_server
+
+def bench_cipher(args):
+    # Same shared key both ways, so each side can decrypt what the other encrypted
+    server = DiffieHellmanChannel()
+    client = DiffieHellmanChannel()
+    server.generate_shared_key(client.public)
+    client.generate_shared_key(server.public)
+
+    for size in args.sizes:
+        message = os.urandom(size)
+        results = []
+        for name in ("cbc",) + AEAD_MODES:
+            if name != "cbc":
+                server.use_aead("server", name)
+                client.use_aead("client", name)
+            start = time.perf_counter()
+            for _ in range(args.messages):
+                client.decrypt_bytes(server.encrypt(message))
+            elapsed = time.perf_counter() - start
+            batch = [message] * args.batch
+            start = time.perf_counter()
+            for _ in range(args.messages // args.batch):
+                for frame in server.encrypt_frames(batch):
+                    client.decrypt_bytes(frame)
+            batched = time.perf_counter() - start
+            results.append(f"{name}: {args.messages / elapsed:8.0f} msgs/sec "
+                           f"{args.messages * size / elapsed / 1e6:7.1f} MB/s, "
+                           f"batched {args.messages // args.batch * args.batch / batched:8.0f}")
+        server.aead_key = client.aead_key = None
+        print(f"{size:>6} B  " + "  ".join(results))
+
+def bench_handshake(args):
+    # Client hellos are made up front so only the server's work is timed: pick a keypair,
+    # derive the shared key, build the reply
+    for mode, channel in CHANNELS.items():
+        hellos = [f"KEX mode={mode} pub={channel().encode_public()}".encode() for _ in range(args.handshakes)]
+        for pooled in (False, True):
+            KeyExchange.key_pools.clear()
+            if pooled:
+                # A full pool, as it would be when a lobby reconnects all at once
+                pool = KeyPool(KeyExchange.KEYPAIR_GENERATORS[mode], args.handshakes)
+                pool.keys.extend(pool.generate() for _ in range(args.handshakes))
+                KeyExchange.key_pools[mode] = pool
+            start = time.process_time()
+            for hello in hellos:
+                protocol.acceptKeyExchange(hello)
+            elapsed = time.process_time() - start
+            label = f"{mode}{' + pool' if pooled else ''}"
+            print(f"{label:>13}: {args.handshakes / elapsed:8.0f} handshakes/sec per core")
+    KeyExchange.key_pools.clear()
+
+def bench_resume(args):
+    proc = start_server(args.engine, args.port)
+    try:
+        tickets = []
+        for i in range(args.clients):
+            conn, secure = open_client(args.port)
+            protocol.sendWithSize(f"REGISTER username=bench{i} password=pw{i}", conn, secure)
+            reply = protocol.parse_command(protocol.recvWithSize(conn, secure))
+            tickets.append((i, reply['args']['ticket'], secure.resumption_secret()))
+            conn.close()
+        time.sleep(0.5)  # Let the server clean up before everyone comes back
+
+        start = time.perf_counter()
+        failed = 0
+        for i, _, _ in tickets:
+            conn, secure = open_client(args.port)
+            protocol.sendWithSize(f"LOGIN username=bench{i} password=pw{i}", conn, secure)
+            failed += not protocol.recvWithSize(conn, secure).startswith("LOGIN_SUCCESS")
+            conn.close()
+        full = time.perf_counter() - start
+        time.sleep(0.5)
+
+        start = time.perf_counter()
+        for _, ticket, secret in tickets:
+            conn, secure, response = open_resumed(args.port, ticket, secret)
+            failed += not response.startswith("RESUME_SUCCESS")
+            conn.close()
+        resumed = time.perf_counter() - start
+
+        for name, elapsed in (("full + LOGIN", full), ("resume", resumed)):
+            print(f"{name:>12}: {args.clients / elapsed:7.0f} reconnects/sec, "
+                  f"{elapsed / args.clients * 1000:6.2f} ms each")
+        if failed:
+            print(f"{failed} reconnects failed")
+    finally:
+        proc.kill()
+        proc.wait()
+
+def bench_rsa(args):
+    start = time.perf_counter()
+    for _ in range(args.channels):
+        RSAChannel()
+    inline = (time.perf_counter() - start) / args.channels
+    print(f"   on demand: {inline * 1000:7.1f} ms per RSAChannel")
+
+    path = os.path.join(tempfile.mkdtemp(prefix="cyberhunt-bench-"), "server_key.pem")
+    KeyExchange.load_server_key(path)  # First run writes the key
+    start = time.perf_counter()
+    KeyExchange.load_server_key(path)
+    loaded = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.channels):
+        RSAChannel()
+    print(f"    from disk: {loaded * 1000:7.1f} ms to load once, "
+          f"{(time.perf_counter() - start) / args.channels * 1e6:7.1f} us per RSAChannel")
+    KeyExchange.server_rsa_key = None
+
+    pool = KeyExchange.start_rsa_pool(args.pool, args.workers)
+    while len(pool.keys) < args.pool:
+        time.sleep(0.05)
+    print(f"  pool ready: {args.pool} keys, fill rate {pool.stats()['fill_rate']:.1f} keys/sec "
+          f"with {args.workers} workers")
+
+    # Take keys twice as fast as an on-demand generation would allow, so some requests miss
+    start = time.perf_counter()
+    for _ in range(args.pool * 2):
+        RSAChannel()
+        time.sleep(inline / 2)
+    elapsed = time.perf_counter() - start
+    stats = pool.stats()
+    print(f"       pool: {elapsed / (args.pool * 2) * 1000:7.1f} ms per RSAChannel (incl. {inline / 2 * 1000:.0f} ms pause), "
+          f"hit rate {stats['hit_rate']:.0%}, {stats['misses']} misses")
+    KeyExchange.rsa_pool = None
+
+def bench_logins(args):
+    workdir = tempfile.mkdtemp(prefix="cyberhunt-bench-")
+    protocol.user_store = storage.JsonUserStore(os.path.join(workdir, "users.json"))
+    workers.start_cpu_pool(max(args.workers))
+    for i in range(args.users):
+        protocol.savePlayer(f"user{i}", f"pw{i}")
+    workers.stop_cpu_pool()
+
+    for count in args.workers:
+        if count:
+            workers.start_cpu_pool(count)
+        done = [0] * args.clients
+        stop = threading.Event()
+
+        def client(index):
+            while not stop.is_set():
+                user = (index * 7 + done[index]) % args.users
+                assert protocol.checkPlayer(f"user{user}", f"pw{user}", SessionIndex())
+                done[index] += 1
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        workers.stop_cpu_pool()
+        label = f"{count} workers" if count else "inline"
+        print(f"{label:>10}: {sum(done) / args.duration:7.1f} scrypt logins/sec ({args.clients} clients)")
+    protocol.user_store.close()
+    protocol.user_store = None
+
+def add_parsers(sub):
+    cipher = sub.add_parser("cipher", help="encrypt+decrypt rate of the CBC and AEAD session ciphers")
+    cipher.add_argument("--messages", type=int, default=20000)
+    cipher.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 16384])
+    cipher.add_argument("--batch", type=int, default=16, help="frames per encrypt_frames call")
+    cipher.set_defaults(func=bench_cipher)
+
+    handshake = sub.add_parser("handshake", help="server key exchange rate per mode, with and without the key pool")
+    handshake.add_argument("--handshakes", type=int, default=200)
+    handshake.set_defaults(func=bench_handshake)
+
+    resume = sub.add_parser("resume", help="reconnect storm with full key exchange + LOGIN vs resumption tickets")
+    resume.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    resume.add_argument("--clients", type=int, default=200)
+    resume.add_argument("--port", type=int, default=5152)
+    resume.set_defaults(func=bench_resume)
+
+    rsa = sub.add_parser("rsa", help="RSAChannel setup cost on demand, from a disk key and from the key pool")
+    rsa.add_argument("--channels", type=int, default=5)
+    rsa.add_argument("--pool", type=int, default=8)
+    rsa.add_argument("--workers", type=int, default=2)
+    rsa.set_defaults(func=bench_rsa)
+
+    logins = sub.add_parser("logins", help="scrypt login throughput as the CPU pool grows")
+    logins.add_argument("--workers", type=int, nargs="+",
+                        default=[0] + sorted({n for n in (1, 2, 4, 8, os.cpu_count()) if n <= os.cpu_count()}))
+    logins.add_argument("--users", type=int, default=32)
+    logins.add_argument("--clients", type=int, default=16)
+    logins.add_argument("--duration", type=float, default=3.0)
+    logins.set_defaults(func=bench_logins)
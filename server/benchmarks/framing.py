@@ -0,0 +1,140 @@
+import threading
+import time
+
+import protocol
+from KeyExchange import DiffieHellmanChannel
+
+from benchmarks.common import open_client, start_server
+
+def bench_engines(args):
+    for engine in args.engines:
+        port = args.port
+        proc = start_server(engine, port)
+        try:
+            conns = []
+            start = time.perf_counter()
+            for _ in range(args.connections):
+                try:
+                    conns.append(open_client(port))
+                except OSError:
+                    break
+            connect_time = time.perf_counter() - start
+
+            held = 0
+            for conn, secure in conns:
+                protocol.sendWithSize("USERNAME", conn, secure)
+                if protocol.recvWithSize(conn, secure):
+                    held += 1
+
+            counts = [0] * args.workers
+            stop = threading.Event()
+
+            def worker(index):
+                mine = conns[index::args.workers]
+                while mine and not stop.is_set():
+                    for conn, secure in mine:
+                        protocol.sendWithSize("USERNAME", conn, secure)
+                        protocol.recvWithSize(conn, secure)
+                        counts[index] += 1
+
+            threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.workers)]
+            for t in threads:
+                t.start()
+            time.sleep(args.duration)
+            stop.set()
+            for t in threads:
+                t.join()
+
+            print(f"{engine:>8}: held {held}/{args.connections} connections "
+                  f"(connected in {connect_time:.1f}s), "
+                  f"{sum(counts) / args.duration:.0f} commands/sec")
+            for conn, _ in conns:
+                conn.close()
+        finally:
+            proc.kill()
+            proc.wait()
+
+def bench_state(args):
+    secure = DiffieHellmanChannel()
+    secure.generate_shared_key(secure.public)
+
+    room = protocol.GameRoom(0)
+    players = [protocol.Player(protocol.FakeSocket(f"P{i}"), None, f"player{i}") for i in range(4)]
+    for p in players:
+        room.add_player(p)
+
+    full_frames = []
+    delta_frames = []
+    for i in range(args.events):
+        since = room.refresh_state()
+        # Mostly turn changes, with some chat and one elimination, like a real game
+        if i % 5 == 4:
+            room.add_chat_message(players[i % 4], f"message number {i}")
+        elif i == args.events // 2:
+            players[3].is_alive = False
+        else:
+            room.end_turn()
+        full_frames.append(room.render_game_state())
+        delta_frames.append(room.render_state_delta(since))
+
+    for name, frames in (("full", full_frames), ("delta", delta_frames)):
+        start = time.perf_counter()
+        wire = sum(8 + len(secure.encrypt(f.encode())) for f in frames)
+        elapsed = time.perf_counter() - start
+        plain = sum(len(f) for f in frames)
+        print(f"{name:>6}: {plain / len(frames):6.1f} B plaintext, {wire / len(frames):6.1f} B on wire, "
+              f"{elapsed / len(frames) * 1e6:6.1f} us to encrypt per frame")
+
+CODEC_COMMANDS = [
+    ("LOGIN", {"username": "player1", "password": "hunter22"}),
+    ("SCAN", {"x": 3, "y": 4}),
+    ("HACK", {"x": 2, "y": 5}),
+    ("STATUS", {"since": 41}),
+    ("EVADE", {}),
+    ("CHAT", {"msg": "anyone near the top left?"}),
+]
+
+def encode_text(cmd, cmd_args):
+    return " ".join([cmd] + [f"{k}={v}" for k, v in cmd_args.items()]).encode()
+
+def bench_codec(args):
+    # Encoding is what a sender pays per command, decoding what the server pays once the frame is
+    # decrypted; both sides of the text format include the str/bytes conversion
+    texts = [encode_text(cmd, cmd_args) for cmd, cmd_args in CODEC_COMMANDS]
+    payloads = [protocol.encode_binary(cmd, cmd_args) for cmd, cmd_args in CODEC_COMMANDS]
+
+    def rate(func, items):
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for item in items:
+                func(*item)
+        return args.rounds * len(items) / (time.perf_counter() - start)
+
+    text_encode = rate(encode_text, CODEC_COMMANDS)
+    text_decode = rate(lambda text: protocol.parse_command(text.decode()), [(t,) for t in texts])
+    binary_encode = rate(protocol.encode_binary, CODEC_COMMANDS)
+    binary_decode = rate(protocol.decode_binary, [(p,) for p in payloads])
+
+    text_bytes = sum(len(t) + 8 for t in texts) / len(texts)
+    binary_bytes = sum(len(p) + protocol.FRAME_HEADER.size for p in payloads) / len(payloads)
+    print(f"  text: {text_encode:10.0f} commands/sec encoded, {text_decode:10.0f} decoded, "
+          f"{text_bytes:5.1f} B per frame before encryption")
+    print(f"binary: {binary_encode:10.0f} commands/sec encoded, {binary_decode:10.0f} decoded, "
+          f"{binary_bytes:5.1f} B per frame before encryption")
+
+def add_parsers(sub):
+    engines = sub.add_parser("engines", help="connections held and commands/sec per server engine")
+    engines.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    engines.add_argument("--connections", type=int, default=500)
+    engines.add_argument("--workers", type=int, default=8)
+    engines.add_argument("--duration", type=float, default=5.0)
+    engines.add_argument("--port", type=int, default=5151)
+    engines.set_defaults(func=bench_engines)
+
+    state = sub.add_parser("state", help="bytes and encryption cost of full vs delta state frames")
+    state.add_argument("--events", type=int, default=20000)
+    state.set_defaults(func=bench_state)
+
+    codec = sub.add_parser("codec", help="encode and decode rates of the text and binary command formats")
+    codec.add_argument("--rounds", type=int, default=50000)
+    codec.set_defaults(func=bench_codec)
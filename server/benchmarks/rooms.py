@@ -0,0 +1,344 @@
+import contextlib
+import random
+import threading
+import time
+import tracemalloc
+
+import protocol
+from engine import Board
+from rooms import RoomPool, RoomReaper, RoomRegistry
+from sessions import SessionIndex
+
+from benchmarks.common import NullSocket, SinkSocket, fill_rooms, rate
+
+def bench_rooms(args):
+    conn = NullSocket()
+    secure = protocol.DummySecure()
+    rooms_lock = threading.Lock()
+    for count in args.sizes:
+        rooms = RoomRegistry()
+        fill_rooms(rooms, count, args.started)
+
+        def old_join(_):
+            # What cmdJoin did: the first room that hasn't started, scanned under rooms_lock
+            player = protocol.Player(conn, None, "joiner")
+            with rooms_lock:
+                room = next((room for room in rooms.values() if not room.started), None)
+                room.add_player(player)
+            room.remove_player(player)
+
+        def join(_):
+            player = protocol.Player(conn, None, "joiner")
+            protocol.cmdJoin(player, conn, rooms, secure)
+            rooms[player.room_id].remove_player(player)
+
+        open_names = [room.name for room in rooms.values() if not room.started]
+
+        def old_join_by_name(i):
+            # What cmdJoinRoomName did: compare the name of every room
+            wanted = open_names[i % len(open_names)].upper()
+            with rooms_lock:
+                return next((room for room_id, room in rooms.items()
+                             if f"Room{room_id}".lower() == wanted.lower() and not room.started), None)
+
+        def join_by_name(i):
+            player = protocol.Player(conn, None, "joiner")
+            command = {'type': 'JOIN_ROOM_NAME', 'args': {'room_name': open_names[i % len(open_names)].upper()}}
+            protocol.cmdJoinRoomName(player, command, conn, rooms, secure)
+            rooms[player.room_id].remove_player(player)
+
+        results = {
+            "old scan": rate(old_join, args.old_joins),
+            "open-room index": rate(join, args.joins),
+            "old name scan": rate(old_join_by_name, args.old_joins),
+            "name index": rate(join_by_name, args.joins),
+        }
+        print(f"{count:>7} rooms ({len(rooms.open)} open): " +
+              ", ".join(f"{name} {value:,.0f} joins/s" for name, value in results.items()))
+
+def bench_view(args):
+    conn = NullSocket()
+    secure = protocol.DummySecure()
+    rooms_lock = threading.Lock()
+    for count in args.sizes:
+        rooms = RoomRegistry()
+        fill_rooms(rooms, count, args.started)
+        open_rooms = [room for room in rooms.values() if not room.started]
+        joiner = protocol.Player(conn, None, "joiner")
+
+        def old_view(_):
+            # What cmdView did per request: render every room under rooms_lock
+            with rooms_lock:
+                room_list = [f"{room_id}={room.name}({len(room.players)}/4)"
+                             for room_id, room in rooms.items() if not room.started]
+                response = "VIEW_ROOM_LIST " + " ".join(room_list)
+            protocol.sendWithSize(response, conn, secure)
+
+        def view(text):
+            command = protocol.parse_command(text)
+            return lambda _: protocol.cmdView(command, conn, rooms, secure)
+
+        def change(i):
+            room = open_rooms[i % len(open_rooms)]
+            if joiner in room.players:
+                room.remove_player(joiner)
+            else:
+                room.add_player(joiner)
+
+        def view_after_change(text):
+            request = view(text)
+            def run(i):
+                change(i)
+                request(i)
+            return run
+
+        def delta(i):
+            since = rooms.listing.version
+            change(i)
+            view(f"VIEW since={since}")(i)
+
+        results = {
+            "old full render": rate(old_view, args.old_views),
+            "cached first page": rate(view("VIEW"), args.views),
+            "first page after a change": rate(view_after_change("VIEW"), args.views // 10),
+            "random page": rate(lambda _: view(f"VIEW offset={random.randrange(len(open_rooms))}")(_), args.views),
+            "delta after a change": rate(delta, args.views),
+        }
+        print(f"{count:>7} rooms ({len(open_rooms)} open): " +
+              ", ".join(f"{name} {value:,.0f}/s" for name, value in results.items()))
+
+class GlobalLockRooms(RoomRegistry):
+    """The registry behind one process-wide lock, the way every handler used rooms_lock."""
+    def __init__(self):
+        super().__init__()
+        self.rooms_lock = threading.RLock()
+
+    def get(self, room_id):
+        with self.rooms_lock:
+            return super().get(room_id)
+
+def bench_contention(args):
+    secure = protocol.DummySecure()
+    for mode in args.modes:
+        rooms = GlobalLockRooms() if mode == "global-lock" else RoomRegistry()
+        # cmdJoin, cmdCreate and cmdLeave held rooms_lock throughout, pushes to the room included
+        churn_lock = rooms.rooms_lock if mode == "global-lock" else contextlib.nullcontext()
+        stop = threading.Event()
+        latencies = [[] for _ in range(args.rooms)]
+        churned = [0] * args.churners
+
+        def play(index):
+            conn = SinkSocket()
+            room = rooms.add(protocol.GameRoom(rooms.new_room_id()))
+            players = [protocol.Player(conn, None, f"g{index}p{i}") for i in range(4)]
+            for player in players:
+                room.add_player(player)
+                player.room_id = room.room_id
+            commands = [
+                lambda p: protocol.cmdStatus(p, {'args': {'since': '0'}}, conn, rooms, secure),
+                lambda p: protocol.cmdPlayers(p, conn, rooms, secure),
+                lambda p: protocol.cmdChat(p, "hi", conn, rooms, secure),
+                lambda p: protocol.cmdEndTurn(p, rooms, conn, secure),
+            ]
+            i = 0
+            while not stop.is_set():
+                start = time.perf_counter()
+                commands[i % 4](players[i % 4])
+                latencies[index].append(time.perf_counter() - start)
+                i += 1
+
+        def churn(index):
+            conn = SinkSocket()
+            while not stop.is_set():
+                players = [protocol.Player(conn, None, f"c{index}p{i}") for i in range(3)]
+                with churn_lock:
+                    protocol.cmdCreate(players[0], {'args': {}}, conn, rooms, secure)
+                for player in players[1:]:
+                    with churn_lock:
+                        protocol.cmdJoin(player, conn, rooms, secure)
+                for player in players:
+                    with churn_lock:
+                        protocol.cmdLeave(player, conn, rooms, secure)
+                churned[index] += 1
+
+        threads = [threading.Thread(target=play, args=(i,)) for i in range(args.rooms)]
+        threads += [threading.Thread(target=churn, args=(i,)) for i in range(args.churners)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        # With hundreds of busy threads the sleep overruns while waiting for the GIL, time it
+        elapsed = time.perf_counter() - start
+        for t in threads:
+            t.join()
+
+        samples = sorted(latency for room in latencies for latency in room)
+        p99 = samples[int(len(samples) * 0.99)] * 1000
+        print(f"{mode:>12}: {len(samples) / elapsed:9,.0f} game commands/s (p99 {p99:.2f} ms), "
+              f"{sum(churned) / elapsed:7,.0f} lobby cycles/s, {args.rooms} rooms")
+
+def bench_soak(args):
+    conn = NullSocket()
+    secure = protocol.DummySecure()
+    clients_lock = threading.Lock()
+    for mode in args.modes:
+        rooms = RoomRegistry()
+        protocol.room_pool = RoomPool(protocol.GameRoom, reuse_delay=0)
+        reaper = RoomReaper(rooms, protocol.room_pool, grace=0)
+        sessions = SessionIndex()
+        tracemalloc.start()
+        start = time.perf_counter()
+        for game in range(1, args.games + 1):
+            player = protocol.Player(conn, None, "soak")
+            protocol.cmdBot(player, conn, rooms, secure)
+            room = rooms[player.room_id]
+            for p in room.players[:3]:
+                p.is_alive = False  # A bot wins, so no win is stored
+            room.render_game_state()
+            protocol.cleanup_player(conn, player, rooms, {}, clients_lock, sessions, secure)
+            if mode == "reaper" and game % args.sweep_every == 0:
+                reaper.sweep()
+            if game % args.checkpoint == 0:
+                current, _ = tracemalloc.get_traced_memory()
+                print(f"{mode:>7} {game:>7} games: {current / 2**20:7.1f} MiB traced, {len(rooms):>6} rooms, "
+                      f"{protocol.room_pool.reused:>6} reused, {time.perf_counter() - start:5.1f}s")
+        tracemalloc.stop()
+    protocol.room_pool = RoomPool(protocol.GameRoom)
+
+def bench_game(args):
+    def old_scan(args, player, GRID_SIZE, players):
+        # What gameScan did: every player checked against each of the 9 cells
+        x, y = int(args['x']), int(args['y'])
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < GRID_SIZE and 0 <= ny < GRID_SIZE:
+                    for p in players:
+                        if p != player and p.is_alive and not p.encrypted and p.position[0] == nx and p.position[1] == ny:
+                            protocol.debug_print("Scan found suspicious activity nearby.")
+                            return ("Scan found suspicious activity nearby.", True)
+        protocol.debug_print("Scan revealed no threats nearby.")
+        return ("Scan revealed no threats nearby.", True)
+
+    def old_hack(args, player, players):
+        # What gameHack did, on a cell nobody is on so nobody gets eliminated
+        x, y = int(args['x']), int(args['y'])
+        msg = "Hack failed. No player at this location."
+        for p in players:
+            if p != player and p.position[0] == x and p.position[1] == y and p.is_alive:
+                p.is_alive = False
+                msg = f"Hack successful. Player {p.username} eliminated!"
+                break
+        protocol.debug_print(msg)
+        return (msg, True)
+
+    for spec in args.maps:
+        size, count = map(int, spec.split("x"))
+        room = protocol.GameRoom(0, None, size, count)
+        room.players = [protocol.Player(None, None, f"p{i}") for i in range(count)]
+        room.init_game()
+        boards = {type(room.board).__name__: room.board}
+        if not isinstance(room.board, Board):
+            # Show what a whole-map bitboard would cost at this size
+            bitboard = Board(size)
+            for p in room.players:
+                bitboard[p.position[1]][p.position[0]] = p
+            boards["Board"] = bitboard
+        for p in room.players[::2]:
+            p.encrypted = True
+            for board in boards.values():
+                board.sync(p)
+        player = room.players[0]
+        # Mostly around other players, where scans find something and hacks hit the cell next door
+        cells = [{'x': str(p.position[0] + random.choice((-1, 0, 1))), 'y': str(p.position[1] + random.choice((-1, 0, 1)))}
+                 for p in random.choices(room.players, k=1024)]
+        misses = [cell for cell in cells if room.board[int(cell['y']) % size][int(cell['x']) % size] is None][:1024]
+        misses = [misses[i % len(misses)] for i in range(1024)]
+        for cell in cells:
+            for board in boards.values():
+                assert old_scan(cell, player, size, room.players) == protocol.gameScan(cell, player, board)
+        results = {
+            "old scan": rate(lambda i: old_scan(cells[i & 1023], player, size, room.players), args.actions),
+            "old hack": rate(lambda i: old_hack(misses[i & 1023], player, room.players), args.actions),
+        }
+        for name, board in boards.items():
+            results[f"{name} scan"] = rate(lambda i: protocol.gameScan(cells[i & 1023], player, board), args.actions)
+            results[f"{name} hack"] = rate(lambda i: protocol.gameHack(misses[i & 1023], player, board), args.actions)
+        print(f"{count} players on {size}x{size}: " +
+              ", ".join(f"{name} {value:,.0f}/s" for name, value in results.items()))
+
+def bench_placement(args):
+    def old_evade(player, board):
+        # What gameEvade did: free the old cell, then retry random cells until one is empty
+        board[player.position[1]][player.position[0]] = None
+        tries = 0
+        while True:
+            tries += 1
+            x, y = random.randint(0, board.size - 1), random.randint(0, board.size - 1)
+            if not board[y][x]:
+                board[y][x] = player
+                player.position = (x, y)
+                return tries
+
+    for size in args.sizes:
+        cells = size * size
+        for fill in args.fills:
+            board = protocol.create_empty_board(size)
+            count = max(1, min(cells - 1, round(cells * fill)))  # Always one cell left to move to
+            players = [protocol.Player(None, None, f"p{i}") for i in range(count)]
+            for player in players:
+                x, y = board.random_free_cell()
+                board[y][x] = player
+                player.position = (x, y)
+            player = players[0]
+            tries = [0]
+
+            def old(_):
+                tries[0] += old_evade(player, board)
+
+            old_rate = rate(old, args.old_evades)
+            new_rate = rate(lambda _: protocol.gameEvade(player, board), args.evades)
+            print(f"{size:>4}x{size:<4} {count / cells:7.2%} full: old retry loop {old_rate:11,.0f}/s "
+                  f"({tries[0] / args.old_evades:8.1f} tries each), free-cell index {new_rate:11,.0f}/s")
+
+def add_parsers(sub):
+    matchmaking = sub.add_parser("rooms", help="quick joins and joins by name per second, scanning rooms vs the indexes")
+    matchmaking.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    matchmaking.add_argument("--started", type=float, default=0.9, help="share of rooms with a game in progress")
+    matchmaking.add_argument("--joins", type=int, default=50000)
+    matchmaking.add_argument("--old-joins", type=int, default=500)
+    matchmaking.set_defaults(func=bench_rooms)
+
+    view = sub.add_parser("view", help="VIEW requests/sec, rendering every room vs the cached listing")
+    view.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    view.add_argument("--started", type=float, default=0.5, help="share of rooms with a game in progress")
+    view.add_argument("--views", type=int, default=20000)
+    view.add_argument("--old-views", type=int, default=200)
+    view.set_defaults(func=bench_view)
+
+    contention = sub.add_parser("contention", help="hundreds of rooms in threads, global rooms_lock vs the striped registry")
+    contention.add_argument("--modes", nargs="+", choices=("global-lock", "striped"), default=["global-lock", "striped"])
+    contention.add_argument("--rooms", type=int, default=200)
+    contention.add_argument("--churners", type=int, default=8)
+    contention.add_argument("--duration", type=float, default=5.0)
+    contention.set_defaults(func=bench_contention)
+
+    soak = sub.add_parser("soak", help="memory over many finished bot games, rooms kept forever vs reaper and pool")
+    soak.add_argument("--modes", nargs="+", choices=("kept", "reaper"), default=["kept", "reaper"])
+    soak.add_argument("--games", type=int, default=100000)
+    soak.add_argument("--checkpoint", type=int, default=10000)
+    soak.add_argument("--sweep-every", type=int, default=100)
+    soak.set_defaults(func=bench_soak)
+
+    game = sub.add_parser("game", help="SCAN and HACK per second, player loops vs the board engines")
+    game.add_argument("--maps", nargs="+", default=["6x4", "32x16", "200x64"], help="SIZExPLAYERS")
+    game.add_argument("--actions", type=int, default=200000)
+    game.set_defaults(func=bench_game)
+
+    placement = sub.add_parser("placement", help="EVADE per second as boards fill, retry loop vs the free-cell index")
+    placement.add_argument("--sizes", type=int, nargs="+", default=[6, 200])
+    placement.add_argument("--fills", type=float, nargs="+", default=[0.1, 0.5, 0.9, 0.99, 1.0])
+    placement.add_argument("--evades", type=int, default=100000)
+    placement.add_argument("--old-evades", type=int, default=200)
+    placement.set_defaults(func=bench_placement)
@@ -0,0 +1,182 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import passwords
+import protocol
+import storage
+from leaderboard import Leaderboard
+from migrate_users import migrate
+from sessions import SessionIndex
+
+from benchmarks.common import NullSocket, rate
+
+def write_users_file(path, count):
+    # Records in the old sha256 format, scrypt for a million users would take hours; user<i> has password pw<i>
+    salt = "00" * 16
+    users = {f"user{i}": {"password": passwords.hash_password_sha256(f"pw{i}", salt), "salt": salt, "wins": i % 50}
+             for i in range(count)}
+    with open(path, "w") as f:
+        json.dump(users, f)
+
+def bench_users(args):
+    workdir = tempfile.mkdtemp(prefix="cyberhunt-bench-")
+    for count in args.sizes:
+        path = os.path.join(workdir, f"users_{count}.json")
+        write_users_file(path, count)
+        names = [f"user{random.randrange(count)}" for _ in range(args.logins)]
+
+        # What every login used to do: re-read and parse the whole file
+        start = time.perf_counter()
+        for name in names[:args.old_logins]:
+            with open(path) as f:
+                users = json.load(f)
+            user = users[name]
+            passwords.hash_password_sha256(f"pw{name[4:]}", user["salt"]) == user["password"]
+        old = (time.perf_counter() - start) / args.old_logins
+        del users
+
+        results = [f"reload per login {1 / old:8.1f}"]
+        for backend in args.backends:
+            store_path = path
+            if backend == "sqlite":
+                store_path = path.replace(".json", ".db")
+                migrate(path, store_path)
+            start = time.perf_counter()
+            protocol.user_store = storage.open_user_store(backend, store_path)
+            loaded = time.perf_counter() - start
+            # Lookup and verify only: checkPlayer would also rehash every sha256 record with scrypt
+            store = protocol.user_store
+            start = time.perf_counter()
+            ok = sum(passwords.verify_password(f"pw{name[4:]}", store.get(name)) for name in names)
+            elapsed = time.perf_counter() - start
+            assert ok == len(names)
+            protocol.user_store.close()
+            protocol.user_store = None
+            results.append(f"{backend} {len(names) / elapsed:8.0f} (opened in {loaded:.2f}s)")
+        print(f"{count:>8} users, logins/sec: " + " | ".join(results))
+
+def bench_wins(args):
+    # Rooms ending at the same time, each crediting its winner from its own thread
+    workdir = tempfile.mkdtemp(prefix="cyberhunt-bench-")
+    path = os.path.join(workdir, "users.json")
+    write_users_file(path, args.users)
+    migrate(path, path.replace(".json", ".db"))
+    for backend in args.backends:
+        store = storage.open_user_store(backend, path.replace(".json", ".db") if backend == "sqlite" else path)
+        before = sum(info["wins"] for _, info in store.all_users())
+
+        def room(index):
+            for i in range(args.games):
+                store.increment_wins(f"user{(index * args.games + i) % args.users}")
+
+        threads = [threading.Thread(target=room, args=(i,)) for i in range(args.rooms)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        store.flush()
+        elapsed = time.perf_counter() - start
+        lost = before + args.rooms * args.games - sum(info["wins"] for _, info in store.all_users())
+        print(f"{backend:>6}: {args.rooms * args.games / elapsed:8.0f} wins/sec durable in "
+              f"{store.flushes} writes, {lost} lost")
+        store.close()
+
+def bench_leaderboard(args):
+    conn = NullSocket()
+    secure = protocol.DummySecure()
+    for count in args.sizes:
+        users = {f"user{i}": {"wins": random.randrange(1000)} for i in range(count)}
+
+        def old_request(_):
+            # What cmdLeaderboard did per request: sort every user, send them all
+            data = sorted([{"username": u, "wins": info.get("wins", 0)} for u, info in users.items()],
+                          key=lambda x: x["wins"], reverse=True)
+            json.dumps("LEADERBOARD " + "".join(f"{d['username']}:{d['wins']} " for d in data))
+
+        start = time.perf_counter()
+        protocol.leaderboard = Leaderboard((u, info["wins"]) for u, info in users.items())
+        built = time.perf_counter() - start
+        board = protocol.leaderboard
+
+        def request(text):
+            return lambda _: protocol.cmdLeaderboard(protocol.parse_command(text), conn, secure)
+
+        results = {
+            "old full sort": rate(old_request, args.old_requests),
+            "top page": rate(request("LEADERBOARD"), args.requests),
+            "random page": rate(lambda _: protocol.cmdLeaderboard(
+                protocol.parse_command(f"LEADERBOARD offset={random.randrange(count)} limit=20"), conn, secure),
+                args.requests),
+            "rank": rate(lambda _: protocol.cmdLeaderboard(
+                protocol.parse_command(f"LEADERBOARD username=user{random.randrange(count)}"), conn, secure),
+                args.requests),
+            "record win": rate(lambda _: board.record_win(f"user{random.randrange(count)}"), args.requests),
+        }
+        protocol.leaderboard = None
+        print(f"{count:>8} users (index built in {built:.2f}s): " +
+              ", ".join(f"{name} {value:,.{0 if value >= 10 else 2}f}/s" for name, value in results.items()))
+
+def bench_sessions(args):
+    clients = {}
+    clients_lock = threading.Lock()
+    sessions = SessionIndex()
+    for i in range(args.sessions):
+        player = protocol.Player(socket=object(), address=("127.0.0.1", i), username=f"user{i}")
+        clients[player.socket] = player
+        sessions.claim(player.username, player)
+
+    def old_check(_):
+        # What checkPlayer did per login: walk every connected player looking for the name
+        username = f"user{random.randrange(args.sessions * 2)}"
+        with clients_lock:
+            return any(player.username == username for player in clients.values())
+
+    def churn(i):
+        player = protocol.Player(socket=None, address=None)
+        sessions.claim(f"new{i}", player)
+        sessions.release(f"new{i}", player)
+
+    batch = [f"user{random.randrange(args.sessions * 2)}" for _ in range(args.batch)]
+    results = {
+        "old scan": rate(old_check, args.old_lookups),
+        "duplicate check": rate(lambda _: sessions.is_online(f"user{random.randrange(args.sessions * 2)}"),
+                                args.lookups),
+        "find session": rate(lambda _: sessions.get(f"user{random.randrange(args.sessions)}"), args.lookups),
+        "login+logout": rate(churn, args.lookups),
+        f"online query ({args.batch} names)": rate(lambda _: sessions.online(batch), args.lookups // 10),
+    }
+    print(f"{args.sessions} sessions: " +
+          ", ".join(f"{name} {value:,.0f}/s" for name, value in results.items()))
+
+def add_parsers(sub):
+    users = sub.add_parser("users", help="logins/sec re-reading users.json per login vs the in-memory user store")
+    users.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    users.add_argument("--logins", type=int, default=20000)
+    users.add_argument("--old-logins", type=int, default=3)
+    users.add_argument("--backends", nargs="+", choices=sorted(storage.BACKENDS), default=["json", "sqlite"])
+    users.set_defaults(func=bench_users)
+
+    wins = sub.add_parser("wins", help="concurrent win updates per user store backend")
+    wins.add_argument("--backends", nargs="+", choices=sorted(storage.BACKENDS), default=["json", "sqlite"])
+    wins.add_argument("--users", type=int, default=10000)
+    wins.add_argument("--rooms", type=int, default=8)
+    wins.add_argument("--games", type=int, default=2000)
+    wins.set_defaults(func=bench_wins)
+
+    board = sub.add_parser("leaderboard", help="leaderboard requests/sec, full sort vs the skiplist index")
+    board.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    board.add_argument("--requests", type=int, default=20000)
+    board.add_argument("--old-requests", type=int, default=3)
+    board.set_defaults(func=bench_leaderboard)
+
+    online = sub.add_parser("sessions", help="duplicate-login checks and session lookups, clients scan vs the index")
+    online.add_argument("--sessions", type=int, default=50000)
+    online.add_argument("--lookups", type=int, default=200000)
+    online.add_argument("--old-lookups", type=int, default=200)
+    online.add_argument("--batch", type=int, default=100)
+    online.set_defaults(func=bench_sessions)
@@ -0,0 +1,279 @@
+import random
+from array import array
+
+GRID_SIZE = 6
+BITBOARD_SIZE = 32  # Larger maps use SpatialBoard, masks that wide would cost more than they save
+
+neighbourhoods = {}  # size -> [mask of the cell and its 8 neighbours, per cell]
+
+def neighbourhood(size, x, y):
+    mask = 0
+    for ny in range(y - 1, y + 2):
+        for nx in range(x - 1, x + 2):
+            if 0 <= nx < size and 0 <= ny < size:
+                mask |= 1 << (ny * size + nx)
+    return mask
+
+def neighbourhood_masks(size):
+    masks = neighbourhoods.get(size)
+    if masks is None:
+        masks = [neighbourhood(size, cell % size, cell // size) for cell in range(size * size)]
+        neighbourhoods[size] = masks
+    return masks
+
+class BoardRow:
+    """board[y][x] reads and writes, for code written against the old list-of-lists board."""
+    __slots__ = ("board", "y")
+
+    def __init__(self, board, y):
+        self.board = board
+        self.y = y
+
+    def __len__(self):
+        return self.board.size
+
+    def __getitem__(self, x):
+        return self.board.get(self.board.cell(x, self.y))
+
+    def __setitem__(self, x, player):
+        cell = self.board.cell(x, self.y)
+        if player is None:
+            self.board.clear_cell(cell)
+        else:
+            self.board.place(player, cell)
+
+class FreeCells:
+    """The empty cells of a board, for picking one at random in O(1) however full the board is.
+
+    cells[:count] are the free cells in no particular order and position[cell] is where a cell
+    sits in cells. Occupying a cell swaps it just past the free part and releasing swaps it back,
+    so sampling, occupying and releasing never search or shift anything.
+    """
+    def __init__(self, total):
+        self.cells = array("i", range(total))
+        self.position = array("i", range(total))
+        self.count = total
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, cell):
+        return self.position[cell] < self.count
+
+    def sample(self, rng=random):
+        # A uniformly random free cell, or None on a full board
+        if not self.count:
+            return None
+        return self.cells[rng.randrange(self.count)]
+
+    def occupy(self, cell):
+        index = self.position[cell]
+        if index < self.count:
+            self.count -= 1
+            self.swap(index, self.count)
+
+    def release(self, cell):
+        index = self.position[cell]
+        if index >= self.count:
+            self.swap(index, self.count)
+            self.count += 1
+
+    def swap(self, i, j):
+        a, b = self.cells[i], self.cells[j]
+        self.cells[i], self.cells[j] = b, a
+        self.position[b], self.position[a] = i, j
+
+class Grid:
+    """What both boards share: board[y][x] access, cell numbering (y * size + x) and the free cells."""
+    def __getitem__(self, y):
+        if not 0 <= y < self.size:
+            raise IndexError(y)
+        return BoardRow(self, y)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (BoardRow(self, y) for y in range(self.size))
+
+    def cell(self, x, y):
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            raise IndexError((x, y))
+        return y * self.size + x
+
+    def remove(self, player):
+        cell = self.where.get(player)
+        if cell is not None:
+            self.clear_cell(cell)
+
+    def random_free_cell(self, rng=random):
+        # (x, y) of a uniformly random empty cell, or None if the board is full
+        cell = self.free.sample(rng)
+        if cell is None:
+            return None
+        return cell % self.size, cell // self.size
+
+    def release_all(self):
+        # Only the occupied cells go back, so clearing costs the players on the board, not its size
+        for cell in self.where.values():
+            self.free.release(cell)
+
+class Board(Grid):
+    """A room's grid up to BITBOARD_SIZE wide, with who stands where kept as integer bitboards.
+
+    occupied has a bit for every cell with a player on it, dead or alive, which is what EVADE and
+    POSITION avoid. alive and visible (alive and not encrypted) are what HACK and SCAN look at, so
+    a scan is one AND with the precomputed neighbourhood mask and a hack is one bit test.
+    The masks follow Player.is_alive and Player.encrypted through sync(), which the game
+    functions call whenever they change one of them.
+    """
+    def __init__(self, size=GRID_SIZE):
+        self.size = size
+        self.around = neighbourhood_masks(size)
+        self.cells = [None] * (size * size)
+        self.where = {}  # player -> cell
+        self.free = FreeCells(size * size)
+        self.occupied = 0
+        self.alive = 0
+        self.visible = 0
+
+    def get(self, cell):
+        return self.cells[cell]
+
+    def clear(self):
+        self.release_all()
+        self.cells = [None] * (self.size * self.size)
+        self.where = {}
+        self.occupied = self.alive = self.visible = 0
+
+    def place(self, player, cell):
+        # A player is on one cell at a time: placing them again moves them
+        self.remove(player)
+        self.clear_cell(cell)
+        self.cells[cell] = player
+        self.where[player] = cell
+        self.free.occupy(cell)
+        self.occupied |= 1 << cell
+        self.sync(player)
+
+    def clear_cell(self, cell):
+        player = self.cells[cell]
+        if player is not None:
+            del self.where[player]
+            self.cells[cell] = None
+            self.free.release(cell)
+        bit = ~(1 << cell)
+        self.occupied &= bit
+        self.alive &= bit
+        self.visible &= bit
+
+    def sync(self, player):
+        # Refresh the player's alive and visible bits from the Player's flags
+        cell = self.where.get(player)
+        if cell is None:
+            return
+        bit = 1 << cell
+        if player.is_alive:
+            self.alive |= bit
+        else:
+            self.alive &= ~bit
+        if player.is_alive and not player.encrypted:
+            self.visible |= bit
+        else:
+            self.visible &= ~bit
+
+    def others(self, player, mask):
+        # mask without the player's own cell
+        cell = self.where.get(player)
+        return mask if cell is None else mask & ~(1 << cell)
+
+    def scan(self, player, x, y):
+        # True if anyone else visible is on (x, y) or next to it
+        if 0 <= x < self.size and 0 <= y < self.size:
+            around = self.around[y * self.size + x]
+        else:
+            around = neighbourhood(self.size, x, y)  # Off the grid: only its in-grid neighbours count
+        return self.others(player, self.visible & around) != 0
+
+    def hack_target(self, player, x, y):
+        # The living player on (x, y) other than player, or None
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            return None
+        cell = y * self.size + x
+        if not self.alive >> cell & 1:
+            return None
+        target = self.cells[cell]
+        return None if target is player else target
+
+class SpatialBoard(Grid):
+    """A large map's grid as a hash of the occupied cells.
+
+    A 200x200 map with 64 players is almost all empty cells, so only the occupied ones are kept,
+    with the visible ones (alive, not encrypted) in a set that sync() keeps current. A SCAN
+    intersects that set with the up to 9 cells it covers and a HACK looks up one cell, which costs
+    the same however big the map is or however many players are on it.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.offsets = tuple(dy * size + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+        self.cells = {}  # cell -> player, occupied cells only
+        self.where = {}  # player -> cell
+        self.free = FreeCells(size * size)
+        self.visible = set()
+
+    def get(self, cell):
+        return self.cells.get(cell)
+
+    def clear(self):
+        self.release_all()
+        self.cells = {}
+        self.where = {}
+        self.visible = set()
+
+    def place(self, player, cell):
+        self.remove(player)
+        self.clear_cell(cell)
+        self.cells[cell] = player
+        self.where[player] = cell
+        self.free.occupy(cell)
+        self.sync(player)
+
+    def clear_cell(self, cell):
+        player = self.cells.pop(cell, None)
+        if player is not None:
+            del self.where[player]
+            self.free.release(cell)
+        self.visible.discard(cell)
+
+    def sync(self, player):
+        cell = self.where.get(player)
+        if cell is None:
+            return
+        if player.is_alive and not player.encrypted:
+            self.visible.add(cell)
+        else:
+            self.visible.discard(cell)
+
+    def scan(self, player, x, y):
+        size = self.size
+        if 0 < x < size - 1 and 0 < y < size - 1:
+            center = y * size + x
+            found = self.visible.intersection([center + offset for offset in self.offsets])
+        else:
+            # On or past the edge, only the in-grid part of the window counts
+            found = self.visible.intersection([ny * size + nx
+                                               for ny in range(max(0, y - 1), min(size, y + 2))
+                                               for nx in range(max(0, x - 1), min(size, x + 2))])
+        found.discard(self.where.get(player))
+        return bool(found)
+
+    def hack_target(self, player, x, y):
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            return None
+        p = self.cells.get(y * self.size + x)
+        if p is None or p is player or not p.is_alive:
+            return None
+        return p
+
+def new_board(size=GRID_SIZE):
+    return Board(size) if size <= BITBOARD_SIZE else SpatialBoard(size)
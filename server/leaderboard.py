@@ -0,0 +1,158 @@
+import random
+import threading
+
+MAX_LEVELS = 24  # Plenty for tens of millions of entries
+
+class Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels  # Positions skipped by the link at each level
+
+NIL = Node(None, 0)  # Past the last entry, every link at the end of a level points here
+
+def random_level():
+    level = 1
+    while level < MAX_LEVELS and random.random() < 0.5:
+        level += 1
+    return level
+
+class IndexableSkipList:
+    """Sorted keys with O(log n) insert, remove, rank and lookup by position.
+
+    Every link remembers how many positions it skips, which is what makes rank and
+    positional access logarithmic instead of a walk along the bottom level.
+    """
+    def __init__(self, sorted_keys=()):
+        self.head = Node(None, MAX_LEVELS)
+        self.size = 0
+        # Bulk build from already sorted keys in O(n): link each level left to right
+        last = [self.head] * MAX_LEVELS
+        last_pos = [-1] * MAX_LEVELS
+        for pos, key in enumerate(sorted_keys):
+            node = Node(key, random_level())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = pos - last_pos[level]
+                last[level] = node
+                last_pos[level] = pos
+            self.size += 1
+        for level in range(MAX_LEVELS):
+            last[level].next[level] = NIL
+            last[level].width[level] = self.size - last_pos[level]
+
+    def __len__(self):
+        return self.size
+
+    def path_to(self, key):
+        # Last node before key on every level, and the position of each of those nodes
+        chain = [None] * MAX_LEVELS
+        positions = [0] * MAX_LEVELS
+        node = self.head
+        pos = -1
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not NIL and node.next[level].key < key:
+                pos += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            positions[level] = pos
+        return chain, positions
+
+    def insert(self, key):
+        chain, positions = self.path_to(key)
+        node = Node(key, random_level())
+        pos = positions[0] + 1  # Where the new key lands
+        for level in range(len(node.next)):
+            prev = chain[level]
+            node.next[level] = prev.next[level]
+            prev.next[level] = node
+            skipped = pos - positions[level]
+            node.width[level] = prev.width[level] - skipped + 1
+            prev.width[level] = skipped
+        for level in range(len(node.next), MAX_LEVELS):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain, _ = self.path_to(key)
+        node = chain[0].next[0]
+        if node is NIL or node.key != key:
+            raise KeyError(key)
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        # 0-based position of key
+        chain, positions = self.path_to(key)
+        node = chain[0].next[0]
+        if node is NIL or node.key != key:
+            raise KeyError(key)
+        return positions[0] + 1
+
+    def node_at(self, index):
+        node = self.head
+        remaining = index + 1
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not NIL and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node
+
+    def slice(self, offset, limit):
+        if offset >= self.size or limit <= 0:
+            return []
+        node = self.node_at(offset)
+        keys = []
+        while node is not NIL and len(keys) < limit:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+class Leaderboard:
+    """Users ordered by wins (then name), updated in O(log n) per win instead of re-sorted per request."""
+    def __init__(self, users):
+        # users: (username, wins) pairs
+        self.wins = dict(users)
+        self.index = IndexableSkipList(sorted((-wins, username) for username, wins in self.wins.items()))
+        self.lock = threading.Lock()
+        self.version = 0  # Bumped on every change, so rendered pages can be cached against it
+        self.cached_top = None  # (version, limit, rendered response)
+
+    def add_user(self, username, wins=0):
+        with self.lock:
+            if username in self.wins:
+                return
+            self.wins[username] = wins
+            self.index.insert((-wins, username))
+            self.version += 1
+
+    def record_win(self, username):
+        with self.lock:
+            wins = self.wins.get(username)
+            if wins is None:
+                return
+            self.index.remove((-wins, username))
+            self.wins[username] = wins + 1
+            self.index.insert((-wins - 1, username))
+            self.version += 1
+
+    def page(self, offset, limit):
+        # (version, total users, [(username, wins), ...])
+        with self.lock:
+            rows = [(username, -negative_wins) for negative_wins, username in self.index.slice(offset, limit)]
+            return self.version, len(self.index), rows
+
+    def rank(self, username):
+        # 1-based (rank, wins), or None for an unknown user
+        with self.lock:
+            wins = self.wins.get(username)
+            if wins is None:
+                return None
+            return self.index.rank((-wins, username)) + 1, wins
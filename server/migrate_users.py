@@ -0,0 +1,39 @@
+import argparse
+import json
+import sqlite3
+
+from storage import SQLiteUserStore
+
+def migrate(json_path, db_path, overwrite=False):
+    with open(json_path, "r") as f:
+        users = json.load(f)
+
+    store = SQLiteUserStore(db_path)
+    rows = [(username, info["password"], info["salt"], info.get("wins", 0), info.get("kdf", "sha256"))
+            for username, info in users.items()]
+    conflict = ("DO UPDATE SET password = excluded.password, salt = excluded.salt, wins = excluded.wins, "
+                "kdf = excluded.kdf" if overwrite else "DO NOTHING")
+    db = store.connection()
+    before = db.total_changes
+    with db:  # One transaction, a failed migration leaves the database as it was
+        db.executemany("INSERT INTO users (username, password, salt, wins, kdf) VALUES (?, ?, ?, ?, ?) "
+                       f"ON CONFLICT(username) {conflict}", rows)
+    return len(rows), db.total_changes - before
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy accounts from users.json into the SQLite user store")
+    parser.add_argument("json_path", nargs="?", default="server/users.json")
+    parser.add_argument("db_path", nargs="?", default="server/users.db")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="replace accounts that already exist in the database")
+    args = parser.parse_args()
+
+    try:
+        total, written = migrate(args.json_path, args.db_path, args.overwrite)
+    except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+        print(f"[MIGRATION ERROR] {e}")
+        exit(1)
+    print(f"Migrated {written} of {total} users from {args.json_path} to {args.db_path}")
+
+if __name__ == "__main__":
+    main()
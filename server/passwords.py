@@ -0,0 +1,26 @@
+import hashlib
+import hmac
+
+PEPPER = "my_secret_pepper_123!"
+
+# scrypt cost: 16 MiB and a few tens of milliseconds per hash. Records without a "kdf"
+# field predate it and hold a salted sha256, they are rehashed on the next good login
+KDF = "scrypt"
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+def hash_password_sha256(password, salt):
+    return hashlib.sha256((password + PEPPER + salt).encode()).hexdigest()
+
+def hash_password(password, salt):
+    return hashlib.scrypt((password + PEPPER).encode(), salt=bytes.fromhex(salt),
+                          n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32).hex()
+
+def verify_password(password, record):
+    # Runs in the CPU pool, so it takes and returns plain values only
+    if record.get("kdf", "sha256") == KDF:
+        provided = hash_password(password, record["salt"])
+    else:
+        provided = hash_password_sha256(password, record["salt"])
+    return hmac.compare_digest(provided, record["password"])
@@ -1,18 +1,52 @@
+import asyncio
+import collections
+import contextlib
+import itertools
 import json
 import os
 import random
 import threading
 import time
-import hashlib
 import base64
 import secrets
+import selectors
+import socket
+
+from KeyExchange import AEAD_MODES, CHANNELS, ResumedChannel, SessionTickets, dh_session_key, new_channel
+from engine import GRID_SIZE, new_board
+from leaderboard import Leaderboard
+from passwords import KDF, hash_password, verify_password
+from rooms import MAX_PLAYERS, RoomPool, valid_room_name, valid_room_size
+from storage import open_user_store
+from wire import FRAME_HEADER, MAX_FRAME, FrameReader, decode_binary, encode_binary
+from workers import run_cpu
 
-PEPPER = "my_secret_pepper_123!"
 USERS_FILE = "server/users.json"
 #USERS_FILE = "users.json"
+USERS_DB = "server/users.db"
+USER_BACKEND = "json"  # or "sqlite", after running migrate_users.py
+user_store = None  # Opened on first use, so USERS_FILE can still be changed before that
+user_store_lock = threading.Lock()
+leaderboard = None  # Built from the user store on first use, then kept up to date per win
+leaderboard_lock = threading.Lock()
+LEADERBOARD_PAGE = 20  # Entries per page when the client doesn't ask, also the cached top page
+LEADERBOARD_MAX_PAGE = 200
+VIEW_PAGE = 50  # Rooms per VIEW page when the client doesn't ask
+VIEW_MAX_PAGE = 200
 
 DEBUG = True
 
+# Sections of a game state frame, in wire order
+STATE_SECTIONS = ("STATUS", "TURN", "WINNER", "CHAT")
+
+# Outbound queues: bytes a peer may have waiting before the slow-consumer policy applies.
+# "drop_state" throws away queued STATE frames (the client resyncs), "disconnect" kicks the peer
+OUTBOUND_LIMIT = 256 * 1024
+SLOW_CONSUMER_POLICY = "drop_state"
+MAX_COALESCE = 64  # Frames handed to a single sendmsg call
+TICKET_LIFETIME = 300  # Seconds a resumption ticket stays valid
+session_tickets = SessionTickets(TICKET_LIFETIME)  # Key lives in memory, a restart invalidates all tickets
+
 def debug_print(*args):
     if DEBUG:
         print("[DEBUG]", *args)
@@ -29,6 +63,189 @@ class Player:
         self.encrypted = False
         self.turn_ready = False
         self.is_bot = False
+        self.secure = None
+        self.subscribed = False  # Receives pushed STATE frames instead of polling
+        self.state_version = 0  # Last room state version this player was sent
+
+class Connection(FrameReader):
+    """A FrameReader plus the outbound queue the writer thread drains."""
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.outbound = collections.deque()  # (frame, droppable)
+        self.outbound_bytes = 0
+        self.outbound_lock = threading.Lock()
+        self.send_lock = threading.RLock()  # Held from encryption until the frame is queued
+        self.in_flight = 0  # Frames at the head of the queue currently handed to sendmsg
+        self.dropped_frames = 0
+        self.closed = False
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        self.queue_frame(data)
+
+    def queue_frame(self, frame, droppable=False):
+        # Never blocks: the shared OutboundWriter does the actual socket writes
+        with self.outbound_lock:
+            if self.closed:
+                return
+            if self.outbound_bytes + len(frame) > OUTBOUND_LIMIT:
+                if SLOW_CONSUMER_POLICY == "drop_state":
+                    self.drop_stale_frames()
+                if self.outbound_bytes + len(frame) > OUTBOUND_LIMIT:
+                    if droppable and SLOW_CONSUMER_POLICY == "drop_state":
+                        self.dropped_frames += 1
+                        return
+                    debug_print(f"[SLOW CONSUMER] disconnecting, {self.outbound_bytes} bytes queued")
+                    self.shutdown()
+                    return
+            if not self.outbound and SEND_FLAGS:
+                # Nothing queued: try the socket directly, it can't block with MSG_DONTWAIT
+                try:
+                    sent = self.sock.send(frame, SEND_FLAGS)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    self.shutdown()
+                    return
+                if sent == len(frame):
+                    return
+                if sent:
+                    frame, droppable = memoryview(frame)[sent:], False
+            self.outbound.append((frame, droppable))
+            self.outbound_bytes += len(frame)
+        outbound_writer.schedule(self)
+
+    def drop_stale_frames(self):
+        # Called with outbound_lock held; frames already handed to sendmsg stay
+        kept = collections.deque(itertools.islice(self.outbound, self.in_flight))
+        for frame, droppable in itertools.islice(self.outbound, self.in_flight, None):
+            if droppable:
+                self.outbound_bytes -= len(frame)
+                self.dropped_frames += 1
+            else:
+                kept.append((frame, droppable))
+        self.outbound = kept
+
+    def flush(self):
+        # Writer thread only. Returns False if the socket would block with frames still queued
+        while True:
+            with self.outbound_lock:
+                if self.closed or not self.outbound:
+                    return True
+                frames = [frame for frame, _ in itertools.islice(self.outbound, MAX_COALESCE)]
+                self.in_flight = len(frames)
+            try:
+                if hasattr(self.sock, "sendmsg"):
+                    sent = self.sock.sendmsg(frames, [], SEND_FLAGS)
+                else:
+                    sent = self.sock.send(b"".join(frames), SEND_FLAGS)
+            except BlockingIOError:
+                with self.outbound_lock:
+                    self.in_flight = 0
+                return False
+            except OSError as e:
+                debug_print(f"[SEND ERROR] {e}")
+                with self.outbound_lock:
+                    self.shutdown()
+                return True
+
+            with self.outbound_lock:
+                self.in_flight = 0
+                if self.closed:
+                    return True
+                self.outbound_bytes -= sent
+                while sent:
+                    frame, _ = self.outbound[0]
+                    if sent >= len(frame):
+                        self.outbound.popleft()
+                        sent -= len(frame)
+                    else:
+                        # Rest of a partly written frame, must go out as-is
+                        self.outbound[0] = (memoryview(frame)[sent:], False)
+                        return False
+
+    def shutdown(self):
+        # Called with outbound_lock held. The reader side sees EOF and runs the usual cleanup
+        self.closed = True
+        self.outbound.clear()
+        self.outbound_bytes = 0
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def disconnect(self):
+        # Wakes up the thread blocked reading this connection, unlike close()
+        with self.outbound_lock:
+            self.shutdown()
+
+# Without MSG_DONTWAIT (Windows) a stalled peer can hold up the writer thread, but never a handler
+SEND_FLAGS = getattr(socket, "MSG_DONTWAIT", 0)
+
+class OutboundWriter:
+    """One thread that drains every Connection's outbound queue, coalescing frames per sendmsg."""
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ)
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self, conn):
+        with self.pending_lock:
+            self.pending.add(conn)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        try:
+            self.wake_send.send(b"\0")
+        except BlockingIOError:
+            pass  # Already woken up
+
+    def run(self):
+        waiting = set()  # Connections registered for EVENT_WRITE
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wake_recv:
+                    try:
+                        while self.wake_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    conn = key.data
+                    self.selector.unregister(conn.sock)
+                    waiting.discard(conn)
+                    with self.pending_lock:
+                        self.pending.add(conn)
+
+            with self.pending_lock:
+                ready, self.pending = self.pending, set()
+            for conn in ready:
+                if conn in waiting:
+                    continue  # Still waiting for the socket to drain
+                if not conn.flush():
+                    try:
+                        self.selector.register(conn.sock, selectors.EVENT_WRITE, conn)
+                        waiting.add(conn)
+                    except (ValueError, OSError):
+                        pass  # Socket already closed
+
+outbound_writer = OutboundWriter()
+
+# The command being handled on this thread. Replies to that connection echo its request ID,
+# text frames as a "#<id> " prefix and binary frames in the header
+request_context = threading.local()
+
+def current_request_id(conn):
+    if getattr(request_context, "conn", None) is conn:
+        return request_context.id
+    return 0
 
 class FakeSocket:
     def __init__(self, bot_name):
@@ -36,7 +253,7 @@ class FakeSocket:
         self.buffer = []
 
     def sendall(self, data):
-        print(f"[{self.bot_name}] BOT RECEIVED:", data.decode(errors='ignore'))  # Optional debug
+        debug_print(f"[{self.bot_name}] BOT RECEIVED:", data.decode(errors='ignore'))
 
     def recv(self, buffer_size):
         return b''  # Bots don’t receive data, but you can extend this to simulate input
@@ -46,48 +263,56 @@ class DummySecure:
         return data
     def decrypt(self, data):
         return data
+    def decrypt_bytes(self, data):
+        return data
+
+def target_cell(args):
+    # (x, y) from the command, or None if either is missing or not a number
+    try:
+        return int(args['x']), int(args['y'])
+    except (KeyError, ValueError):
+        return None
 
-def gameScan(args, player, GRID_SIZE, players):
-    x, y = int(args['x']), int(args['y'])
-    for dx in [-1, 0, 1]:
-        for dy in [-1, 0, 1]:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < GRID_SIZE and 0 <= ny < GRID_SIZE:
-                for p in players:
-                    if p != player and p.is_alive and not p.encrypted and p.position[0] == nx and p.position[1] == ny:
-                        debug_print("Scan found suspicious activity nearby.")
-                        return ("Scan found suspicious activity nearby.", True)
+def gameScan(args, player, board):
+    cell = target_cell(args)
+    if cell is None:
+        return ("Scan needs numeric x and y.", False)
+    x, y = cell
+    if board.scan(player, x, y):
+        debug_print("Scan found suspicious activity nearby.")
+        return ("Scan found suspicious activity nearby.", True)
     debug_print("Scan revealed no threats nearby.")
     return ("Scan revealed no threats nearby.", True)
 
-def gameHack(args, player, players):
-    x, y = int(args['x']), int(args['y'])
+def gameHack(args, player, board):
+    cell = target_cell(args)
+    if cell is None:
+        return ("Hack needs numeric x and y.", False)
+    x, y = cell
     msg = "Hack failed. No player at this location."
-    for p in players:
-        if p != player and p.position[0] == x and p.position[1] == y and p.is_alive:
-            p.is_alive = False
-            msg = f"Hack successful. Player {p.username} eliminated!"
-            break
+    p = board.hack_target(player, x, y)
+    if p is not None:
+        p.is_alive = False
+        board.sync(p)
+        msg = f"Hack successful. Player {p.username} eliminated!"
     debug_print(msg)
     return (msg, True)
 
 
-def gameEvade(player,board):
-    board[player.position[1]][player.position[0]] = None
-    while True:
-        x, y = random.randint(0, 5), random.randint(0, 5)
-        if not board[y][x]:
-            board[y][x] = player
-            player.position = (x, y)
-            break
+def gameEvade(player,board, rng=random):
+    board.remove(player)
+    x, y = board.random_free_cell(rng)  # The cell just left is free, so there always is one
+    board[y][x] = player
+    player.position = (x, y)
     msg = f"Evade successful. You moved to a new location. {x} {y}"
     success = True
 
     debug_print(msg)
     return (msg,success)
 
-def gameEncrypt(player):
+def gameEncrypt(player, board):
     player.encrypted = True
+    board.sync(player)
     msg = "Your location is encrypted for the next turn."
     success = True
 
@@ -97,6 +322,7 @@ def gameEncrypt(player):
 def bot_decide_action(bot, room):
     """Returns a command dictionary: {'type': 'SCAN', 'args': {'x': 2, 'y': 3}}"""
     grid_size = room.GRID_SIZE
+    rng = room.rng
 
     if not bot.is_alive:
         return None
@@ -108,18 +334,18 @@ def bot_decide_action(bot, room):
     scan_y = y
 
     while scan_x == x and scan_y == y:
-        scan_x = max(0, min(grid_size - 1, x + random.choice([-1, 0, 1])))
-        scan_y = max(0, min(grid_size - 1, y + random.choice([-1, 0, 1])))
+        scan_x = max(0, min(grid_size - 1, x + rng.choice([-1, 0, 1])))
+        scan_y = max(0, min(grid_size - 1, y + rng.choice([-1, 0, 1])))
 
-    if random.random() < 0.3:
+    if rng.random() < 0.3:
         debug_print({'type': 'HACK', 'args': {'x': scan_x, 'y': scan_y}})
         return {'type': 'HACK', 'args': {'x': scan_x, 'y': scan_y}}
 
-    if random.random() < 0.5:
+    if rng.random() < 0.5:
         debug_print({'type': 'SCAN', 'args': {'x': scan_x, 'y': scan_y}})
         return {'type': 'SCAN', 'args': {'x': scan_x, 'y': scan_y}}
 
-    if random.random() < 0.2:
+    if rng.random() < 0.2:
         debug_print({'type': 'ENCRYPT'})
         return {'type': 'ENCRYPT'}
 
@@ -127,20 +353,60 @@ def bot_decide_action(bot, room):
     return {'type': 'EVADE'}
 
 class GameRoom:
-    def __init__(self, room_id):
+    def __init__(self, room_id, name=None, grid_size=GRID_SIZE, max_players=MAX_PLAYERS):
+        self.board = None
+        self.lock = threading.Lock()
+        self.chat_lock = threading.Lock()  # Lock for chat messages
+        self.reset(room_id, name, grid_size, max_players)
+
+    def reset(self, room_id, name=None, grid_size=GRID_SIZE, max_players=MAX_PLAYERS):
+        # Everything a new game starts from; room_pool calls this to reuse a retired room
         self.room_id = room_id
+        self.name = name or f"Room{room_id}"
         self.players = []
-        self.board = create_empty_board()
+        self.GRID_SIZE = grid_size
+        self.max_players = max_players
+        if self.board is None or self.board.size != grid_size:
+            self.board = create_empty_board(grid_size)
+        else:
+            self.board.clear()
         self.turn_index = 0  # Keep track of whose turn it is
         self.started = False
         self.actions_log = []
-        self.lock = threading.Lock()
-        self.GRID_SIZE = 6
         self.chat_messages = []  # Store chat messages
-        self.chat_lock = threading.Lock()  # Lock for chat messages
         self.game_over = False
-    
-    def broadcast_game_state(self, client_socket, secure):
+        self.winner = None
+        self.finished_at = None  # When game_over was set
+        self.abandoned_at = None  # When the last human left a room that still has bots in it
+        self.state_version = 0  # Bumped every time any state section changes
+        self.sections = {}
+        self.section_versions = {}
+        self.last_pushed_version = 0
+        self.created = time.monotonic()
+        self.closed = False  # Set once the last player leaves, nobody can join it after that
+        self.registry = None  # The RoomRegistry holding this room, told when it opens or closes
+        self.rng = random  # Every random choice in the game; the simulator seeds one per game
+        self.bot_threads = True  # False when the caller plays the bots' turns itself, like the simulator
+
+    def retire(self):
+        # The reaper's way out: whoever is still here goes back to the lobby
+        with self.lock:
+            self.closed = True
+            for p in self.players:
+                p.room_id = None
+                p.is_alive = True
+                p.turn_ready = False
+                p.subscribed = False
+                p.state_version = 0
+                if not p.is_bot:
+                    try:
+                        sendWithSize('ROOM_CLOSED reason="Room retired"', p.socket, p.secure, droppable=True)
+                    except OSError as e:
+                        debug_print(f"[PUSH ERROR] {p.username}: {e}")
+            self.players = []
+            self.board.clear()
+
+    def render_sections(self):
         # Broadcast alive/dead status
         status_msg = "STATUS "
         status_msg += " ".join(
@@ -148,25 +414,72 @@ class GameRoom:
         )
 
         # Broadcast turn info
-        current_turn_msg = f"|TURN username={self.players[self.turn_index].username}"
+        current_turn_msg = f"TURN username={self.players[self.turn_index].username}"
 
-        # Broadcast win/loss if only one player is alive
-        alive_players = [p for p in self.players if p.is_alive]
-        winner_msg = "|WINNER "
-        if len(alive_players) == 1:
-            winner = alive_players[0]
-            winner_msg += f"username={winner.username}"
-            if not winner.is_bot and not self.game_over:
-                increment_win_count(winner.username)
-            self.game_over = True 
+        # Broadcast win/loss once check_winner has found the last player alive
+        winner_msg = "WINNER "
+        if self.winner is not None:
+            winner_msg += f"username={self.winner.username}"
 
         
         # Broadcast the chat messages every 0.5 seconds
-        chat_msg = "|CHAT "
+        chat_msg = "CHAT "
         chat_msg += " // ".join(self.chat_messages)
 
-        debug_print(f"{status_msg}{current_turn_msg}{winner_msg}{chat_msg}")
-        sendWithSize(f"{status_msg}{current_turn_msg}{winner_msg}{chat_msg}", client_socket, secure)
+        return {"STATUS": status_msg, "TURN": current_turn_msg, "WINNER": winner_msg, "CHAT": chat_msg}
+
+    def refresh_state(self):
+        sections = self.render_sections()
+        changed = [name for name in STATE_SECTIONS if sections[name] != self.sections.get(name)]
+        if changed:
+            self.state_version += 1
+            for name in changed:
+                self.section_versions[name] = self.state_version
+            self.sections = sections
+        return self.state_version
+
+    def render_game_state(self):
+        self.refresh_state()
+        state = "|".join(self.sections[name] for name in STATE_SECTIONS)
+        debug_print(state)
+        return state
+
+    def render_state_delta(self, since):
+        self.refresh_state()
+        return self.delta_frame(since)
+
+    def delta_frame(self, since):
+        # STATE version=V base=B|<changed sections>, where base is the version the client already has
+        version = self.state_version
+        if since == version:
+            return f"STATE version={version} unchanged"
+        if since > version:
+            since = 0  # Client's version belongs to an older room, send everything
+        changed = [self.sections[name] for name in STATE_SECTIONS if self.section_versions[name] > since]
+        delta = "|".join([f"STATE version={version} base={since}"] + changed)
+        debug_print(delta)
+        return delta
+
+    def broadcast_game_state(self, client_socket, secure):
+        sendWithSize(self.render_game_state(), client_socket, secure)
+
+    def push_game_state(self):
+        # Called with self.lock held whenever turn, alive status, winner or chat may have changed
+        if not self.players:
+            return
+        subscribers = [p for p in self.players if p.subscribed]
+        if not subscribers:
+            return
+        version = self.refresh_state()
+        if version == self.last_pushed_version:
+            return
+        self.last_pushed_version = version
+        for p in subscribers:
+            try:
+                sendWithSize(self.delta_frame(p.state_version), p.socket, p.secure, droppable=True)
+                p.state_version = version
+            except OSError as e:
+                debug_print(f"[PUSH ERROR] {p.username}: {e}")
 
     def add_chat_message(self,player, message):
         with self.chat_lock:
@@ -174,28 +487,78 @@ class GameRoom:
                 self.chat_messages.pop(0)
             self.chat_messages.append(f"{player.username}: {message}")
             debug_print(f"{player.username}: {message}")
+        self.push_game_state()
+
+    def check_winner(self):
+        # Called with self.lock held after a move or a player leaving. Ends the game once one
+        # player is left alive and returns the username to credit, which the caller does after
+        # releasing the lock
+        if self.game_over or not self.started:
+            return None
+        alive_players = [p for p in self.players if p.is_alive]
+        if len(alive_players) != 1:
+            return None
+        self.winner = alive_players[0]
+        self.game_over = True
+        self.finished_at = time.monotonic()
+        return None if self.winner.is_bot else self.winner.username
+
+    def changed(self):
+        # Called with self.lock held after players or started change
+        if self.registry is not None:
+            self.registry.room_changed(self)
 
     def add_player(self, player):
+        # False if the room started or filled up before the player got in
         with self.lock:
+            if self.started or self.closed or len(self.players) >= self.max_players:
+                return False
             self.players.append(player)
-            if len(self.players) == 4:
+            if len(self.players) == self.max_players:
                 self.started = True
                 self.start_turn()
                 self.init_game()
             debug_print(f"{player.username} added!")
+            self.changed()
+            self.push_game_state()
+            return True
+
+    def remove_player(self, player):
+        # True if that was the last player: the room is closed and the caller deletes it
+        with self.lock:
+            if player not in self.players:
+                return False  # Retired by the reaper, which already sent everyone back
+            self.players.remove(player)
+            self.board.remove(player)
+            player.subscribed = False
+            player.state_version = 0
+            if self.players:
+                self.turn_index %= len(self.players)
+                if all(p.is_bot for p in self.players):
+                    self.abandoned_at = time.monotonic()
+            else:
+                self.closed = True
+            won = self.check_winner()
+            self.changed()
+            self.push_game_state()
+            closed = self.closed
+        if won:
+            increment_win_count(won)
+        return closed
 
     def init_game(self):
+        # max_players never exceeds the cells, so everyone gets one
         for player in self.players:
-            while True:
-                x, y = random.randint(0, 5), random.randint(0, 5)
-                if not self.board[y][x]:
-                    self.board[y][x] = player
-                    player.position = (x, y)
-                    break
+            self.board.remove(player)
+            x, y = self.board.random_free_cell(self.rng)
+            self.board[y][x] = player
+            player.position = (x, y)
 
 
     def bot_take_turn(self, bot_player):
         time.sleep(1)  # Simulate thinking time
+        if self.closed or bot_player not in self.players:
+            return  # Retired while the bot was thinking
 
         command = bot_decide_action(bot_player, self)
         if command:
@@ -210,9 +573,10 @@ class GameRoom:
         current_player = self.players[self.turn_index]
         current_player.turn_ready = True
         debug_print(f"{current_player.username}'s turn!")
+        self.push_game_state()
 
-        # If it's a bot, give them a short delay and let them act
-        if current_player.is_bot:
+        # If it's a bot, give them a short delay and let them act. Nobody plays on after the game ends
+        if current_player.is_bot and not self.game_over and self.bot_threads:
             threading.Thread(target=self.bot_take_turn, args=(current_player,), daemon=True).start()
 
 
@@ -229,65 +593,75 @@ class GameRoom:
 
     def handle_command(self, player, command, secure):
         with self.lock:
-            # Check if it's the player's turn
-            if not player.turn_ready:
-                debug_print('ACTION_RESULT success=false msg="It\'s not your turn!"')
-                sendWithSize('ACTION_RESULT success=false msg="It\'s not your turn!"', player.socket, secure)
-                return
+            won = self.apply_command(player, command, secure)
+        if won:
+            increment_win_count(won)  # Storage and leaderboard writes, kept out of the room lock
+
+    def apply_command(self, player, command, secure):
+        # Called with self.lock held; returns the username to credit if this move won the game
+        # Check if it's the player's turn
+        if not player.turn_ready:
+            debug_print('ACTION_RESULT success=false msg="It\'s not your turn!"')
+            sendWithSize('ACTION_RESULT success=false msg="It\'s not your turn!"', player.socket, secure)
+            return None
 
-            cmd_type = command['type']
-            args = command.get('args', {})
-            msg = ""
-            success = False
+        cmd_type = command['type']
+        args = command.get('args', {})
+        msg = ""
+        success = False
 
-            if not player.is_alive:
-                debug_print('ACTION_RESULT success=false msg="You are eliminated."')
-                sendWithSize('ACTION_RESULT success=false msg="You are eliminated."', player.socket, secure)
-                return
-            
-            player.encrypted = False
-            # Handle the command based on its type
-            match cmd_type:
-                case 'SCAN':
-                    msg, success = gameScan(args, player, self.GRID_SIZE, self.players)
-                case 'HACK':
-                    msg, success = gameHack(args, player, self.players)
-                case 'EVADE':
-                    msg, success = gameEvade(player, self.board)
-                case 'ENCRYPT':
-                    msg, success = gameEncrypt(player)
-
-            debug_print(f'ACTION_RESULT success={success} msg="{msg}"')
-            sendWithSize(f'ACTION_RESULT success={success} msg="{msg}"', player.socket, secure)
-
-            if success:
-                self.end_turn()  # Move to the next turn after a successful action
+        if not player.is_alive:
+            debug_print('ACTION_RESULT success=false msg="You are eliminated."')
+            sendWithSize('ACTION_RESULT success=false msg="You are eliminated."', player.socket, secure)
+            return None
+        
+        player.encrypted = False
+        self.board.sync(player)
+        # Handle the command based on its type
+        match cmd_type:
+            case 'SCAN':
+                msg, success = gameScan(args, player, self.board)
+            case 'HACK':
+                msg, success = gameHack(args, player, self.board)
+            case 'EVADE':
+                msg, success = gameEvade(player, self.board, self.rng)
+            case 'ENCRYPT':
+                msg, success = gameEncrypt(player, self.board)
+
+        debug_print(f'ACTION_RESULT success={success} msg="{msg}"')
+        sendWithSize(f'ACTION_RESULT success={success} msg="{msg}"', player.socket, secure)
+
+        won = self.check_winner()  # Before end_turn, so no bot is started on a finished game
+        if success:
+            self.end_turn()  # Move to the next turn after a successful action
+        return won
     
     def handle_bot_turn(self, player):
         if not player.is_alive:
             return
 
-        action = random.choice(["SCAN", "HACK", "EVADE", "ENCRYPT"])
+        action = self.rng.choice(["SCAN", "HACK", "EVADE", "ENCRYPT"])
         args = {}
 
         if action in ["SCAN", "HACK"]:
             # Random coordinate
-            args['x'] = str(random.randint(0, self.GRID_SIZE - 1))
-            args['y'] = str(random.randint(0, self.GRID_SIZE - 1))
+            args['x'] = str(self.rng.randint(0, self.GRID_SIZE - 1))
+            args['y'] = str(self.rng.randint(0, self.GRID_SIZE - 1))
 
         msg = ""
         success = False
 
         player.encrypted = False  # Bots get decrypted at the start too
+        self.board.sync(player)
 
         if action == "SCAN":
-            msg, success = gameScan(args, player, self.GRID_SIZE, self.players)
+            msg, success = gameScan(args, player, self.board)
         elif action == "HACK":
-            msg, success = gameHack(args, player, self.players)
+            msg, success = gameHack(args, player, self.board)
         elif action == "EVADE":
-            msg, success = gameEvade(player, self.board)
+            msg, success = gameEvade(player, self.board, self.rng)
         elif action == "ENCRYPT":
-            msg, success = gameEncrypt(player)
+            msg, success = gameEncrypt(player, self.board)
 
         # Log the bot's action
         debug_print(f"Bot {player.username} performed {action}: {msg}")
@@ -298,33 +672,146 @@ class GameRoom:
         if success:
             self.end_turn()
 
-def sendWithSize(message, conn, secure):
+room_pool = RoomPool(GameRoom)  # Rooms retired by the reaper or emptied by their players
+
+def encodeMessage(message, conn, request_id):
     if isinstance(message, str):
-        message = message.encode()  # Convert string to bytes
+        if getattr(conn, "binary", False):
+            return encode_binary("TEXT", {"text": message}, request_id)
+        elif request_id:
+            return f"#{request_id} {message}".encode()
+        else:
+            return message.encode()  # Convert string to bytes
     elif not isinstance(message, bytes):
         raise TypeError("Message must be str or bytes")
+    return message
 
-    encrypted = secure.encrypt(message)  # Encrypt the message
+def queueEncrypted(encrypted, conn, droppable):
+    if getattr(conn, "binary", False):
+        length = FRAME_HEADER.pack(len(encrypted))
+    else:
+        length = str(len(encrypted)).zfill(8).encode()  # Send length of encrypted message
 
-    length = str(len(encrypted)).zfill(8).encode()  # Send length of encrypted message
-    conn.sendall(length + encrypted)
+    queue_frame = getattr(conn, "queue_frame", None)
+    if queue_frame:
+        queue_frame(length + encrypted, droppable)
+    else:
+        conn.sendall(length + encrypted)
+
+def sendWithSize(message, conn, secure, droppable=False):
+    # droppable marks frames the slow-consumer policy may discard (pushed game state)
+    request_id = 0 if droppable else current_request_id(conn)
+    message = encodeMessage(message, conn, request_id)
+
+    # Counter-based nonces must reach the wire in the order they were used
+    with getattr(conn, "send_lock", None) or contextlib.nullcontext():
+        encrypted = secure.encrypt(message)  # Encrypt the message
+        queueEncrypted(encrypted, conn, droppable)
+
+def sendBatchWithSize(messages, conn, secure):
+    # Several replies for the same peer, encrypted and queued under one hold of the send lock
+    request_id = current_request_id(conn)
+    messages = [encodeMessage(message, conn, request_id) for message in messages]
+
+    with getattr(conn, "send_lock", None) or contextlib.nullcontext():
+        encrypt_frames = getattr(secure, "encrypt_frames", None)
+        if encrypt_frames:
+            encrypted_frames = encrypt_frames(messages)
+        else:
+            encrypted_frames = [secure.encrypt(message) for message in messages]
+        for encrypted in encrypted_frames:
+            queueEncrypted(encrypted, conn, False)
+
+def recvExactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))  # Receive the message chunk by chunk
+        if not chunk:
+            return None
+        data += chunk
+    return data
 
+def recvFrame(conn):
+    # Returns the encrypted payload of the next frame, or None if the peer is gone
+    if isinstance(conn, Connection):
+        return conn.read_frame()
 
-def recvWithSize(conn, secure):
-    length_data = conn.recv(8)  # Receive the length of the message
+    binary = getattr(conn, "binary", False)
+    length_data = recvExactly(conn, FRAME_HEADER.size if binary else 8)  # Receive the length of the message
     if not length_data:
         return None
-    try:
-        length = int(length_data.decode().strip())
-    except ValueError:
+    if binary:
+        length, = FRAME_HEADER.unpack(length_data)
+    else:
+        try:
+            length = int(length_data.decode().strip())
+        except ValueError:
+            return None
+    if not 0 <= length <= MAX_FRAME:
         return None
+    return recvExactly(conn, length)
 
-    encrypted_data = b""
-    while len(encrypted_data) < length:
-        chunk = conn.recv(length - len(encrypted_data))  # Receive the message chunk by chunk
-        if not chunk:
-            return None
-        encrypted_data += chunk
+def decodeFrame(encrypted_data, binary, secure):
+    # Returns a parsed command dict for either framing mode
+    if binary:
+        return decode_binary(secure.decrypt_bytes(encrypted_data))
+    decrypted = secure.decrypt(encrypted_data)
+    msg = decrypted if isinstance(decrypted, str) else decrypted.decode()
+    request_id = 0
+    if msg.startswith("#"):
+        tag, _, msg = msg.partition(" ")
+        if not tag[1:].isdigit():
+            return {'type': 'MALFORMED', 'args': {}, 'id': 0}
+        request_id = int(tag[1:])
+    if not msg.strip():
+        # "#<id>" alone or an empty frame: answered with an ERROR, the connection stays up
+        return {'type': 'MALFORMED', 'args': {}, 'id': request_id}
+    command = parse_command(msg)
+    command['id'] = request_id
+    if command['type'] == 'CHAT':
+        command['args']['msg'] = msg[msg.find("msg=") + 4:]  # Keep the spaces in chat messages
+    return command
+
+def sendPlain(message, conn):
+    # Only the key exchange goes out unencrypted, always with the 8-digit text header
+    data = message.encode()
+    conn.sendall(str(len(data)).zfill(8).encode() + data)
+
+def acceptKeyExchange(hello):
+    # The client speaks first: "KEX mode=<x25519|dh> pub=<hex>" or "KEX mode=resume ticket=<t> nonce=<hex>".
+    # Returns the channel (None if the ticket was rejected), our reply and the resumed ticket state
+    command = parse_command(bytes(hello).decode())
+    mode = command['args'].get('mode')
+    if command['type'] == 'KEX' and mode == "resume":
+        state = session_tickets.open(command['args'].get('ticket', ""))
+        try:
+            client_nonce = bytes.fromhex(command['args'].get('nonce', ""))
+        except ValueError:
+            client_nonce = b""
+        if state is None or len(client_nonce) != 16:
+            return None, "KEX mode=resume status=rejected", None
+        server_nonce = secrets.token_bytes(16)
+        secure = ResumedChannel(state["s"], client_nonce + server_nonce)
+        return secure, f"KEX mode=resume nonce={server_nonce.hex()}", state
+    if command['type'] != 'KEX' or mode not in CHANNELS or 'pub' not in command['args']:
+        raise ValueError(f"Unsupported key exchange {command['type']} mode={mode}")
+    # Both 2048-bit DH modexps, keypair and shared key, go to the CPU pool
+    secure = new_channel(mode, run_cpu if mode == "dh" else None)
+    other_public = secure.decode_public(command['args']['pub'])
+    if mode == "dh":
+        secure.shared_key = run_cpu(dh_session_key, other_public, secure.private)  # 2048-bit modexp
+    else:
+        secure.generate_shared_key(other_public)
+    return secure, f"KEX mode={mode} pub={secure.encode_public()}", None
+
+def recvWithSize(conn, secure):
+    encrypted_data = recvFrame(conn)
+    if encrypted_data is None:
+        return None
+
+    if getattr(conn, "binary", False):
+        command = decode_binary(secure.decrypt_bytes(encrypted_data))
+        return command['args'].get('text', "")
 
     decrypted = secure.decrypt(encrypted_data)
 
@@ -334,76 +821,100 @@ def recvWithSize(conn, secure):
     else:
         return decrypted.decode()
 
+def recvCommand(conn, secure):
+    encrypted_data = recvFrame(conn)
+    if encrypted_data is None:
+        return None
+    return decodeFrame(encrypted_data, getattr(conn, "binary", False), secure)
+
+async def recvFrameAsync(reader, binary):
+    try:
+        if binary:
+            length, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        else:
+            length_data = await reader.readexactly(8)  # Receive the length of the message
+            length = int(length_data.decode().strip())
+        if not 0 <= length <= MAX_FRAME:
+            return None
+        return await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        return None
+
+async def recvCommandAsync(reader, conn, secure):
+    encrypted_data = await recvFrameAsync(reader, conn.binary)
+    if encrypted_data is None:
+        return None
+    return decodeFrame(encrypted_data, conn.binary, secure)
+
+def get_user_store():
+    global user_store
+    if user_store is None:
+        with user_store_lock:
+            if user_store is None:
+                user_store = open_user_store(USER_BACKEND, USERS_DB if USER_BACKEND == "sqlite" else USERS_FILE)
+                debug_print(f"Opened {USER_BACKEND} user store")
+    return user_store
+
+def get_leaderboard():
+    global leaderboard
+    if leaderboard is None:
+        with leaderboard_lock:
+            if leaderboard is None:
+                leaderboard = Leaderboard((username, info.get("wins", 0))
+                                          for username, info in get_user_store().all_users()
+                                          if not info.get("is_bot", False))  # Skip bots if you're tagging them
+    return leaderboard
+
 def increment_win_count(username):
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, "r") as f:
-            users = json.load(f)
-
-        if username in users:
-            users[username]["wins"] = users[username].get("wins", 0) + 1
-
-        with open(USERS_FILE, "w") as f:
-            json.dump(users, f, indent=4)
-
-def load_users():
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, "r") as f:
-            load = json.load(f)
-            debug_print(load)
-            return load
-    debug_print({})
-    return {}
-
-def save_users(users):
-    with open(USERS_FILE, "w") as f:
-        json.dump(users, f, indent=4)
-    debug_print("saved!")
-
-def hash_password(password, salt):
-    debug_print("hashed!")
-    return hashlib.sha256((password + PEPPER + salt).encode()).hexdigest()
-
-def checkPlayer(username, password, clients):
-    users = load_users()
-
-    if username not in users:
+    board = get_leaderboard()  # Built before the win is stored, so it is counted exactly once
+    get_user_store().increment_wins(username)
+    board.record_win(username)
+
+def checkPlayer(username, password, sessions):
+    store = get_user_store()
+    user = store.get(username)
+
+    if user is None:
         debug_print("False")
         return False
 
-    stored_salt = users[username]["salt"]
-    stored_hash = users[username]["password"]
-    provided_hash = hash_password(password, stored_salt)
+    if not run_cpu(verify_password, password, user):
+        debug_print("False")
+        return False
+
+    if user.get("kdf") != KDF:
+        # Old sha256 hash: now that we have the password, store it the current way
+        salt = secrets.token_hex(16)
+        store.update(username, dict(user, password=run_cpu(hash_password, password, salt), salt=salt, kdf=KDF))
+        debug_print(f"Upgraded {username} to {KDF}")
 
-    if stored_hash != provided_hash:
+    if sessions.is_online(username):
         debug_print("False")
         return False
 
-    for player in clients.values():
-        if player.username == username:
-            debug_print("False")
-            return False
-        
     debug_print("True")
     return True
 
 def savePlayer(username, password):
-    users = load_users()
+    store = get_user_store()
 
-    if username in users:
+    if store.get(username) is not None:
         debug_print("False")
         return False
 
     salt = secrets.token_hex(16)
-    hashed_password = hash_password(password, salt)
+    hashed_password = run_cpu(hash_password, password, salt)
 
-    users[username] = {
+    added = store.add(username, {
         "password": hashed_password,
         "salt": salt,
+        "kdf": KDF,
         "wins": 0
-    }
-    save_users(users)
-    debug_print("True")
-    return True
+    })
+    if added:
+        get_leaderboard().add_user(username)
+    debug_print(added)
+    return added
 
 def parse_command(msg):
     parts = msg.strip().split()
@@ -417,98 +928,193 @@ def parse_command(msg):
     debug_print({'type': cmd_type, 'args': args})
     return {'type': cmd_type, 'args': args}
 
-def create_empty_board():
-    size = 6
+def create_empty_board(size=GRID_SIZE):
+    # Still indexes as board[y][x]: bitboards for the usual small maps, a cell hash for large ones
     debug_print("board created!")
-    return [[None for _ in range(size)] for _ in range(size)]
+    return new_board(size)
 
-def cleanup_player(client_socket, player,rooms_lock,rooms,clients,clients_lock, secure):
+def cleanup_player(client_socket, player,rooms,clients,clients_lock,sessions, secure):
+    if player.socket is not client_socket:
+        # The session was resumed on another connection, which now owns this player
+        with clients_lock:
+            clients.pop(client_socket, None)
+        return
+    with clients_lock:
+        clients.pop(client_socket, None)
     if player.username:
+        sessions.release(player.username, player)
         if player.room_id != None:
-            with rooms_lock:
-                room = rooms.get(player.room_id)
-                if room:
-                    room.players.remove(player)
-                    room_id_to_delete = player.room_id
-                    player.room_id = None
-                    player.is_alive = True
-                    player = None
-                    if len(room.players) == 0:
-                        del rooms[room_id_to_delete]
-        with clients_lock:
-            clients.pop(client_socket)
+            room = rooms.get(player.room_id)
+            if room:
+                room_id_to_delete = player.room_id
+                player.room_id = None
+                player.is_alive = True
+                if room.remove_player(player) and rooms.remove(room_id_to_delete) is room:
+                    room_pool.release(room)
+
+def issueTicket(player, secure):
+    return session_tickets.issue(secure.resumption_secret(), player.username, player.room_id)
+
+def resumeSession(player, state, client_socket, secure, sessions, rooms):
+    # Returns the Player this connection continues as
+    username, room_id = state["u"], state["r"]
+    previous = sessions.get(username)
+    if previous is None and not sessions.claim(username, player):
+        previous = sessions.get(username)  # Another connection resumed it first
+    if previous:
+        # The old connection hasn't noticed it's gone yet: take over its player, room and board
+        # position, then drop the old socket. Its cleanup sees it no longer owns the player
+        old_socket = previous.socket
+        previous.socket, previous.secure, previous.address = client_socket, secure, player.address
+        previous.subscribed = False
+        previous.state_version = 0
+        getattr(old_socket, "disconnect", old_socket.close)()
+        return previous
+
+    player.username = username
+    if room_id is not None:
+        room = rooms.get(room_id)
+        if room and room.add_player(player):
+            player.room_id = room_id
+    return player
+
+def cmdResume(player, client_socket, secure):
+    debug_print(f"RESUME_SUCCESS username={player.username} room_id={player.room_id}")
+    sendWithSize(f"RESUME_SUCCESS username={player.username} room_id={player.room_id} "
+                 f"ticket={issueTicket(player, secure)}", client_socket, secure)
+
+def cmdTicket(player, client_socket, secure):
+    # A fresh ticket, e.g. after joining a room, so a resume lands back in it
+    if not player.username:
+        sendWithSize('TICKET_FAIL reason="Not logged in"', client_socket, secure)
+        return
+    sendWithSize(f"TICKET_SUCCESS ticket={issueTicket(player, secure)}", client_socket, secure)
 
-def cmdLogin(player,command,client_socket,clients, secure):
+def cmdLogin(player,command,client_socket,sessions, secure):
     username = command['args']['username']
     password = command['args']['password']
-    if checkPlayer(username, password,clients):
+    # The claim settles two logins racing for the same user
+    if checkPlayer(username, password, sessions) and sessions.claim(username, player):
+        if player.username and player.username != username:
+            sessions.release(player.username, player)
         player.username = username
         debug_print(f"LOGIN_SUCCESS username={username}")
-        sendWithSize(f"LOGIN_SUCCESS username={username}", client_socket, secure)
+        sendWithSize(f"LOGIN_SUCCESS username={username} ticket={issueTicket(player, secure)}", client_socket, secure)
     else:
         debug_print('LOGIN_FAIL reason="Invalid password or username"')
         sendWithSize('LOGIN_FAIL reason="Invalid password or username"', client_socket, secure)
 
-def cmdRegister(player,command,client_socket, secure):
+def cmdRegister(player,command,client_socket,sessions, secure):
     username = command['args']['username']
     password = command['args']['password']
     if savePlayer(username, password):
+        if player.username:
+            sessions.release(player.username, player)
+        sessions.claim(username, player)  # A brand new user can't be online anywhere else
         player.username = username
         debug_print(f"REGISTER_SUCCESS username={username}")
-        sendWithSize(f"REGISTER_SUCCESS username={username}", client_socket, secure)
+        sendWithSize(f"REGISTER_SUCCESS username={username} ticket={issueTicket(player, secure)}", client_socket, secure)
     else:
         debug_print('REGISTER_FAIL reason="Username already exists"')
         sendWithSize('REGISTER_FAIL reason="Username already exists"', client_socket, secure)
 
-def cmdJoin(player,client_socket,rooms_lock,rooms, secure):
-    with rooms_lock:
-        for room in rooms.values():
-            if not room.started:
-                room_id = room.room_id
-                room.add_player(player)
-                player.room_id = room_id
-                debug_print(f'ROOM_JOINED room_id={room_id} room_name=Room{room_id} players={len(room.players)}/4')
-                sendWithSize(f'ROOM_JOINED room_id={room_id} room_name=Room{room_id} players={len(room.players)}/4', client_socket, secure)
-                break
-        else:
+def cmdJoin(player,client_socket,rooms, secure):
+    # Fullest open room first, so games fill up and start
+    while True:
+        room = rooms.open.best()
+        if room is None:
             debug_print('JOIN_FAIL reason="No room found"')
             sendWithSize('JOIN_FAIL reason="No room found"', client_socket, secure)
+            return
+        if room.add_player(player):
+            break
+        rooms.open.update(room)  # Started, filled or closed before the index heard about it
+    room_id = room.room_id
+    player.room_id = room_id
+    debug_print(f'ROOM_JOINED room_id={room_id} room_name={room.name} players={len(room.players)}/{room.max_players}')
+    sendWithSize(f'ROOM_JOINED room_id={room_id} room_name={room.name} players={len(room.players)}/{room.max_players}', client_socket, secure)
+
+def cmdCreate(player,command,client_socket,rooms, secure):
+    # CREATE room_name=<name> picks a name, without one the room is named after its id
+    requested_name = command['args'].get('room_name')
+    if requested_name and not valid_room_name(requested_name):
+        debug_print(f'CREATE_FAIL reason="Invalid room name {requested_name}"')
+        sendWithSize(f'CREATE_FAIL reason="Invalid room name {requested_name}"', client_socket, secure)
+        return
+    # CREATE grid_size=<n> max_players=<n> asks for a bigger map or more players than the default
+    try:
+        grid_size = int(command['args'].get('grid_size', GRID_SIZE))
+        max_players = int(command['args'].get('max_players', MAX_PLAYERS))
+        valid = valid_room_size(grid_size, max_players)
+    except ValueError:
+        valid = False
+    if not valid:
+        debug_print('CREATE_FAIL reason="Invalid grid size or player cap"')
+        sendWithSize('CREATE_FAIL reason="Invalid grid size or player cap"', client_socket, secure)
+        return
+    # The creator is in the room before anyone can find it
+    room = room_pool.acquire(rooms.new_room_id(), requested_name, grid_size, max_players)
+    room.add_player(player)
+    if rooms.add(room) is None:
+        room_pool.release(room)
+        debug_print(f'CREATE_FAIL reason="Room {requested_name} already exists"')
+        sendWithSize(f'CREATE_FAIL reason="Room {requested_name} already exists"', client_socket, secure)
+        return
+    room_id, room_name = room.room_id, room.name
+    player.room_id = room_id
+    debug_print(f'ROOM_CREATED room_id={room_id} room_name={room_name} players=1/{max_players} grid_size={grid_size}')
+    sendWithSize(f'ROOM_CREATED room_id={room_id} room_name={room_name} players=1/{max_players} grid_size={grid_size}',
+                 client_socket, secure)
+
+def cmdView(command, client_socket, rooms, secure):
+    # Served from the registry's listing, which is kept current as rooms change
+    listing = rooms.listing
+    args = command['args']
+    try:
+        since = None if args.get('since') is None else int(args['since'])
+        offset = max(0, int(args.get('offset', 0)))
+        limit = min(VIEW_MAX_PAGE, max(1, int(args.get('limit', VIEW_PAGE))))
+    except ValueError:
+        debug_print('VIEW_FAIL reason="Invalid since, offset or limit"')
+        sendWithSize('VIEW_FAIL reason="Invalid since, offset or limit"', client_socket, secure)
+        return
 
-def cmdCreate(player,client_socket,rooms_lock,rooms, secure):
-    with rooms_lock:
-        room_id = len(rooms)
-        room_name = f'Room{room_id}'
-        rooms[room_id] = GameRoom(room_id)
-        rooms[room_id].add_player(player)
-        player.room_id = room_id
-        debug_print(f'ROOM_CREATED room_id={room_id} room_name={room_name}')
-        sendWithSize(f'ROOM_CREATED room_id={room_id} room_name={room_name}', client_socket, secure)
-
-def cmdView(client_socket,rooms_lock,rooms, secure):
-    with rooms_lock:
-        if not rooms:
-            debug_print("VIEW_ROOM_LIST")
-            sendWithSize("VIEW_ROOM_LIST", client_socket, secure)
-        else:
-            room_list = []
-            for room_id, room in rooms.items():
-                if not room.started:
-                    room_name = f"Room{room_id}"
-                    player_count = len(room.players)
-                    room_list.append(f"{room_id}={room_name}({player_count}/4)")
-            response = "VIEW_ROOM_LIST " + " ".join(room_list)
+    if since is not None:
+        delta = listing.delta(since)
+        if delta is not None:
+            # Removals first: an id can be removed and then reused by a newer room
+            version, changed, removed = delta
+            response = f"VIEW_ROOM_DELTA version={version} base={since} removed={','.join(map(str, removed))} "
+            response += " ".join(changed)
             debug_print(response)
-            sendWithSize(response, client_socket, secure)
+            sendWithSize(response.strip(), client_socket, secure)
+            return
+        # Too far behind for a delta, start over with the first page
 
-def cmdCommands(player,command,rooms_lock,rooms, secure):
-    with rooms_lock:
-        room = rooms.get(player.room_id)
+    # The first page is what the main menu asks for, render it once per change
+    cached = listing.cached_page
+    if offset == 0 and cached and cached[0] == listing.version and cached[1] == limit:
+        response = cached[2]
+    else:
+        version, total, entries = listing.page(offset, limit)
+        response = f"VIEW_ROOM_LIST version={version} offset={offset} total={total} " + " ".join(entries)
+        response = response.strip()
+        if offset == 0:
+            listing.cached_page = (version, limit, response)
+
+    debug_print(response)
+    sendWithSize(response, client_socket, secure)
+
+def cmdCommands(player,command,rooms, secure):
+    room = rooms.get(player.room_id)
     if room:
         room.handle_command(player, command, secure)
+    else:
+        debug_print('ACTION_FAIL reason="Not in a room."')
+        sendWithSize('ACTION_FAIL reason="Not in a room."', player.socket, secure)
 
-def cmdPlayers(player,client_socket,rooms_lock,rooms, secure):
-    with rooms_lock:
-        room = rooms.get(player.room_id)
+def cmdPlayers(player,client_socket,rooms, secure):
+    room = rooms.get(player.room_id)
     if room:
         usernames = [p.username for p in room.players]
         response = "PLAYERS " + " ".join(usernames) + f" {room.started}"
@@ -518,25 +1124,23 @@ def cmdPlayers(player,client_socket,rooms_lock,rooms, secure):
         debug_print("PLAYERS")
         sendWithSize("PLAYERS", client_socket, secure)
 
-def cmdLeave(player,client_socket,rooms_lock,rooms, secure):
-    with rooms_lock:
-        room = rooms.get(player.room_id)
-        if room:
-            room.players.remove(player)
-            sendWithSize("LEAVE_SUCCESS", client_socket, secure)
-            room_id_to_delete = player.room_id
-            player.room_id = None
-            player.is_alive = True
-
-            if len(room.players) == 0:
-                del rooms[room_id_to_delete]
-        else:
-            debug_print('LEAVE_FAIL reason="Not in a room."')
-            sendWithSize('LEAVE_FAIL reason="Not in a room."', client_socket, secure)
+def cmdLeave(player,client_socket,rooms, secure):
+    room = rooms.get(player.room_id)
+    if room:
+        emptied = room.remove_player(player)
+        sendWithSize("LEAVE_SUCCESS", client_socket, secure)
+        room_id_to_delete = player.room_id
+        player.room_id = None
+        player.is_alive = True
+
+        if emptied and rooms.remove(room_id_to_delete) is room:
+            room_pool.release(room)
+    else:
+        debug_print('LEAVE_FAIL reason="Not in a room."')
+        sendWithSize('LEAVE_FAIL reason="Not in a room."', client_socket, secure)
 
-def cmdStart(player,client_socket,rooms_lock,rooms, secure):
-    with rooms_lock:
-        room = rooms.get(player.room_id)
+def cmdStart(player,client_socket,rooms, secure):
+    room = rooms.get(player.room_id)
     if room:
         with room.lock:
             if room.started:
@@ -547,6 +1151,7 @@ def cmdStart(player,client_socket,rooms_lock,rooms, secure):
                 sendWithSize("START_FAIL reason='Not enough players to start the game'", client_socket, secure)
             else:
                 room.started = True
+                room.changed()
                 start_message = "The game has started!"
                 debug_print(f"STARTING msg='{start_message}'")
                 sendWithSize(f"STARTING msg='{start_message}'", client_socket, secure)
@@ -562,79 +1167,145 @@ def cmdUsername(player,client_socket, secure):
 
 def cmdPosition(player,client_socket,rooms, secure):
 
-    board = rooms[player.room_id].board
-    x = random.randint(0, 5)
-    y = random.randint(0, 5)
-
-    player.position = [x,y]
-
-    while board[player.position[1]][player.position[0]] != None:
-        player.position[1] = random.randint(0, 5)
-        player.position[0] = random.randint(0, 5)
+    room = rooms.get(player.room_id)
+    if room is None:
+        debug_print('POSITION_FAIL reason="Not in a room."')
+        sendWithSize('POSITION_FAIL reason="Not in a room."', client_socket, secure)
+        return
+    with room.lock:
+        board = room.board
+        size = board.size
+        board.remove(player)  # Give back the cell from init_game or an earlier POSITION
+        cell = board.random_free_cell()
+        if cell is None:
+            debug_print('POSITION_FAIL reason="Board is full"')
+            sendWithSize('POSITION_FAIL reason="Board is full"', client_socket, secure)
+            return
+        player.position = list(cell)
+        board[cell[1]][cell[0]] = player
 
-    board[player.position[1]][player.position[0]] = player
-    
-    debug_print(f"POSITION_SUCCESS {player.position[0]} {player.position[1]}")
-    sendWithSize(f"POSITION_SUCCESS {player.position[0]} {player.position[1]}",client_socket, secure)
+    # The grid size goes last, older clients only read the coordinates
+    debug_print(f"POSITION_SUCCESS {player.position[0]} {player.position[1]} {size}")
+    sendWithSize(f"POSITION_SUCCESS {player.position[0]} {player.position[1]} {size}",client_socket, secure)
 
 
-def cmdStatus(player, client_socket, rooms_lock, rooms, secure):
-    with rooms_lock:
-        room = rooms.get(player.room_id)
+def cmdStatus(player, command, client_socket, rooms, secure):
+    room = rooms.get(player.room_id)
     if room:
         with room.lock:
-            room.broadcast_game_state(client_socket, secure)
+            since = command['args'].get('since')
+            if since is None:
+                room.broadcast_game_state(client_socket, secure)
+            else:
+                try:
+                    since = int(since)
+                except ValueError:
+                    debug_print('STATUS_FAIL reason="Invalid since"')
+                    sendWithSize('STATUS_FAIL reason="Invalid since"', client_socket, secure)
+                    return
+                sendWithSize(room.render_state_delta(since), client_socket, secure)
+    else:
+        debug_print('STATUS_FAIL reason="Not in a room."')
+        sendWithSize('STATUS_FAIL reason="Not in a room."', client_socket, secure)
 
-def cmdChat(player,msg,client_socket, rooms_lock, rooms, secure):
-    with rooms_lock:
-        room = rooms.get(player.room_id)
+def cmdSubscribe(player, client_socket, rooms, secure):
+    room = rooms.get(player.room_id)
+    if room:
+        with room.lock:
+            player.subscribed = True
+            debug_print("SUBSCRIBE_SUCCESS")
+            sendBatchWithSize(["SUBSCRIBE_SUCCESS", room.render_state_delta(0)], client_socket, secure)
+            player.state_version = room.state_version
+    else:
+        debug_print('SUBSCRIBE_FAIL reason="Not in a room."')
+        sendWithSize('SUBSCRIBE_FAIL reason="Not in a room."', client_socket, secure)
+
+def cmdFraming(command, client_socket, secure):
+    mode = command['args'].get('mode')
+    if mode not in ("binary", "text"):
+        debug_print(f'FRAMING_FAIL reason="Unknown mode {mode}"')
+        sendWithSize(f'FRAMING_FAIL reason="Unknown mode {mode}"', client_socket, secure)
+        return
+    # Reply in the old framing, everything after it uses the new one
+    debug_print(f"FRAMING_SUCCESS mode={mode}")
+    sendWithSize(f"FRAMING_SUCCESS mode={mode}", client_socket, secure)
+    client_socket.binary = mode == "binary"
+
+def cmdCipher(command, client_socket, secure):
+    mode = command['args'].get('mode')
+    if mode not in AEAD_MODES or not hasattr(secure, "use_aead"):
+        debug_print(f'CIPHER_FAIL reason="Unsupported mode {mode}"')
+        sendWithSize(f'CIPHER_FAIL reason="Unsupported mode {mode}"', client_socket, secure)
+        return
+    # Reply under the old cipher, everything after it is authenticated
+    with getattr(client_socket, "send_lock", None) or contextlib.nullcontext():
+        debug_print(f"CIPHER_SUCCESS mode={mode}")
+        sendWithSize(f"CIPHER_SUCCESS mode={mode}", client_socket, secure)
+        secure.use_aead("server", mode)
+
+def cmdChat(player,msg,client_socket, rooms, secure):
+    room = rooms.get(player.room_id)
     if room:
         with room.lock:
             debug_print("CHAT_SUCCESS")
             sendWithSize("CHAT_SUCCESS",client_socket, secure)
             room.add_chat_message(player,msg)
+    else:
+        debug_print('CHAT_FAIL reason="Not in a room."')
+        sendWithSize('CHAT_FAIL reason="Not in a room."', client_socket, secure)
+
+def cmdBot(player,client_socket,rooms, secure):
+    bot1 = Player(FakeSocket("Bot1"), None, "BOT1")
+    bot2 = Player(FakeSocket("Bot2"), None, "BOT2")
+    bot3 = Player(FakeSocket("Bot3"), None, "BOT3")
+    bot1.is_bot = True
+    bot2.is_bot = True
+    bot3.is_bot = True
+    # Filled, and so started, before it is registered: it never shows up as an open room
+    room = room_pool.acquire(rooms.new_room_id())
+    room.add_player(player)
+    room.add_player(bot1)
+    room.add_player(bot2)
+    room.add_player(bot3)
+    rooms.add(room)
+    room_id, room_name = room.room_id, room.name
+    player.room_id = room_id
+    debug_print(f'CREATE_BOT room_id={room_id} room_name={room_name}')
+    sendWithSize(f'CREATE_BOT room_id={room_id} room_name={room_name}', client_socket, secure)
+
+def cmdLeaderboard(command, client_socket, secure):
+    try:
+        board = get_leaderboard()
+        args = command['args']
 
-def cmdBot(player,client_socket,rooms_lock,rooms, secure):
-    with rooms_lock:
-        bot1 = Player(FakeSocket("Bot1"), None, "BOT1")
-        bot2 = Player(FakeSocket("Bot2"), None, "BOT2")
-        bot3 = Player(FakeSocket("Bot3"), None, "BOT3")
-        bot1.is_bot = True
-        bot2.is_bot = True
-        bot3.is_bot = True
-        room_id = len(rooms)
-        room_name = f'Room{room_id}'
-        rooms[room_id] = GameRoom(room_id)
-        rooms[room_id].add_player(player)
-        rooms[room_id].add_player(bot1)
-        rooms[room_id].add_player(bot2)
-        rooms[room_id].add_player(bot3)
-        player.room_id = room_id
-        debug_print(f'CREATE_BOT room_id={room_id} room_name={room_name}')
-        sendWithSize(f'CREATE_BOT room_id={room_id} room_name={room_name}', client_socket, secure)
+        if args.get('username'):
+            ranked = board.rank(args['username'])
+            if ranked is None:
+                sendWithSize('LEADERBOARD_FAIL reason="Unknown user"', client_socket, secure)
+                return
+            rank, wins = ranked
+            debug_print(f"LEADERBOARD_RANK username={args['username']} rank={rank} wins={wins}")
+            sendWithSize(f"LEADERBOARD_RANK username={args['username']} rank={rank} wins={wins} total={len(board.wins)}",
+                         client_socket, secure)
+            return
 
-def cmdLeaderboard(client_socket, secure):
-    try:
-        with open(USERS_FILE, "r") as f:
-            users = json.load(f)
-
-        leaderboard_data = sorted(
-            [
-                {"username": username, "wins": info.get("wins", 0)}
-                for username, info in users.items()
-                if not info.get("is_bot", False)  # Skip bots if you're tagging them
-            ],
-            key=lambda x: x["wins"],
-            reverse=True
-        )
+        offset = max(0, int(args.get('offset', 0)))
+        limit = min(LEADERBOARD_MAX_PAGE, max(1, int(args.get('limit', LEADERBOARD_PAGE))))
 
-        response = "LEADERBOARD "
+        # The first page is what almost everyone asks for, render it once per change
+        cached = board.cached_top
+        if offset == 0 and cached and cached[0] == board.version and cached[1] == limit:
+            response = cached[2]
+        else:
+            version, total, rows = board.page(offset, limit)
+            response = f"LEADERBOARD offset={offset} total={total} "
+            response += "".join(f"{username}:{wins} " for username, wins in rows)
+            response = json.dumps(response)
+            if offset == 0:
+                board.cached_top = (version, limit, response)
 
-        for user in leaderboard_data:
-            response += f"{user['username']}:{user['wins']} "
-        
-        debug_print(json.dumps(response))
-        sendWithSize(json.dumps(response), client_socket, secure)
+        debug_print(response)
+        sendWithSize(response, client_socket, secure)
 
     except Exception as e:
         error_response = {
@@ -644,30 +1315,38 @@ def cmdLeaderboard(client_socket, secure):
         debug_print(json.dumps(error_response))
         sendWithSize(json.dumps(error_response), client_socket, secure)
 
-def cmdEndTurn(player,rooms_lock,rooms, client_socket, secure):
-    with rooms_lock:
-        room = rooms.get(player.room_id)
+def cmdOnline(command, client_socket, sessions, secure):
+    # ONLINE users=a,b,c answers which of those are online; without users, just how many are
+    users = command['args'].get('users')
+    if users:
+        online = sessions.online(users.split(","))
+        response = f"ONLINE_LIST count={len(online)} " + " ".join(online)
+    else:
+        response = f"ONLINE_LIST count={len(sessions)}"
+    debug_print(response)
+    sendWithSize(response.strip(), client_socket, secure)
+
+def cmdEndTurn(player,rooms, client_socket, secure):
+    room = rooms.get(player.room_id)
     if room:
         with room.lock:
             room.end_turn()
     debug_print(f'END_TURN')
     sendWithSize(f'END_TURN', client_socket, secure)
 
-def cmdJoinRoomName(player, command, client_socket, rooms_lock, rooms, secure):
+def cmdJoinRoomName(player, command, client_socket, rooms, secure):
     requested_name = command['args'].get('room_name')
     if not requested_name:
         debug_print('JOIN_FAIL reason="No room name provided"')
         sendWithSize('JOIN_FAIL reason="No room name provided"', client_socket, secure)
         return
 
-    with rooms_lock:
-        for room_id, room in rooms.items():
-            room_name = f"Room{room_id}"
-            if room_name.lower() == requested_name.lower() and not room.started:
-                room.add_player(player)
-                player.room_id = room_id
-                sendWithSize(f'JOIN_ROOM_NAME room_id={room_id} room_name={room_name} players={len(room.players)}/4', client_socket, secure)
-                debug_print(f'JOIN_ROOM_NAME room_id={room_id} room_name={room_name} players={len(room.players)}/4')
-                return
-        debug_print(f'JOIN_ROOM_NAME_FAILED reason="Room {requested_name} not found or already started"')
-        sendWithSize(f'JOIN_ROOM_NAME_FAILED reason="Room {requested_name} not found or already started"', client_socket, secure)
+    room = rooms.find(requested_name)
+    if room and room.add_player(player):
+        room_id, room_name = room.room_id, room.name
+        player.room_id = room_id
+        sendWithSize(f'JOIN_ROOM_NAME room_id={room_id} room_name={room_name} players={len(room.players)}/{room.max_players}', client_socket, secure)
+        debug_print(f'JOIN_ROOM_NAME room_id={room_id} room_name={room_name} players={len(room.players)}/{room.max_players}')
+        return
+    debug_print(f'JOIN_ROOM_NAME_FAILED reason="Room {requested_name} not found or already started"')
+    sendWithSize(f'JOIN_ROOM_NAME_FAILED reason="Room {requested_name} not found or already started"', client_socket, secure)
@@ -0,0 +1,317 @@
+import collections
+import heapq
+import itertools
+import re
+import threading
+import time
+
+MAX_PLAYERS = 4  # Default player cap, CREATE can ask for another
+MAX_GRID_SIZE = 256
+MAX_ROOM_PLAYERS = 256
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,24}")  # No spaces or '=', the text protocol splits on them
+DEFAULT_NAME = re.compile(r"room\d+", re.IGNORECASE)  # Kept for rooms named after their id
+SHALLOW_PAGE = 1000  # VIEW pages starting before this are read straight from the listing
+LOCK_STRIPES = 64
+
+def valid_room_name(name):
+    return bool(ROOM_NAME.fullmatch(name)) and not DEFAULT_NAME.fullmatch(name)
+
+def valid_room_size(grid_size, max_players):
+    # Everyone needs a cell of their own
+    return (2 <= grid_size <= MAX_GRID_SIZE and
+            2 <= max_players <= min(MAX_ROOM_PLAYERS, grid_size * grid_size))
+
+class RoomIdAllocator:
+    """Hands out room ids, reusing ids of deleted rooms instead of growing forever.
+
+    A released id waits reuse_delay seconds before it is handed out again, so a resumption ticket
+    that still names the old room can't drop its player into an unrelated new one.
+    """
+    def __init__(self, reuse_delay=0):
+        self.reuse_delay = reuse_delay
+        self.next_id = 0
+        self.released = collections.deque()  # (reusable after, room_id), oldest first
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            if self.released and self.released[0][0] <= time.monotonic():
+                return self.released.popleft()[1]
+            room_id = self.next_id
+            self.next_id += 1
+            return room_id
+
+    def release(self, room_id, delay=None):
+        with self.lock:
+            ready = time.monotonic() + (self.reuse_delay if delay is None else delay)
+            if delay == 0:
+                self.released.appendleft((ready, room_id))  # Never given to a room, no need to wait
+            else:
+                self.released.append((ready, room_id))
+
+class OpenRoomIndex:
+    """Rooms that can still be joined, fullest first and then oldest first.
+
+    A heap of (-players, age, stamp, room) entries. A room that changes gets a fresh entry with a
+    new stamp, so older entries go stale and are skipped when they reach the top instead of being
+    searched for and removed. The heap is rebuilt once stale entries outnumber live ones.
+    """
+    def __init__(self):
+        self.heap = []
+        self.stamps = {}  # room_id -> stamp of the room's live entry
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def update(self, room):
+        # Re-file room after players joined or left, or it started
+        with self.lock:
+            if room.started or room.closed or not 0 < len(room.players) < room.max_players:
+                self.stamps.pop(room.room_id, None)
+                return
+            stamp = next(self.counter)
+            self.stamps[room.room_id] = stamp
+            heapq.heappush(self.heap, (-len(room.players), room.created, stamp, room))
+            if len(self.heap) > 2 * len(self.stamps) + 64:
+                self.compact()
+
+    def remove(self, room_id):
+        with self.lock:
+            self.stamps.pop(room_id, None)
+
+    def best(self):
+        # The room a quick join should go to, or None
+        with self.lock:
+            heap = self.heap
+            while heap:
+                _, _, stamp, room = heap[0]
+                if self.stamps.get(room.room_id) == stamp:
+                    return room
+                heapq.heappop(heap)
+            return None
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap if self.stamps.get(entry[3].room_id) == entry[2]]
+        heapq.heapify(self.heap)
+
+class RoomListing:
+    """What VIEW shows: the rooms that haven't started, kept rendered as they change.
+
+    Every change bumps version. Rooms are listed oldest first from a snapshot taken at most once
+    per version, and a client that already has version N can be sent only the rooms changed since
+    and the ids of rooms that went away, as long as those removals are still in the history.
+    """
+    def __init__(self, history=4096):
+        self.version = 0
+        self.entries = {}  # room_id -> "id=name(n/max)", in the order rooms were listed
+        self.changes = collections.OrderedDict()  # room_id -> version, least recently changed first
+        self.removed = collections.deque()  # (version, room_id), oldest first
+        self.history = history
+        self.oldest_delta = 0  # Deltas from before this version would miss a removal
+        self.snapshot = None  # (version, [entries])
+        self.cached_page = None  # (version, limit, rendered response), for the first page
+        self.lock = threading.Lock()
+
+    def update(self, room):
+        # The room is read under the lock, like OpenRoomIndex.update, so an update that read an
+        # older player count can't land after a newer one and list the room as it was before
+        with self.lock:
+            if room.started or room.closed or not room.players:
+                self.discard(room.room_id)
+                return
+            entry = f"{room.room_id}={room.name}({len(room.players)}/{room.max_players})"
+            if self.entries.get(room.room_id) == entry:
+                return
+            self.version += 1
+            self.entries[room.room_id] = entry
+            self.changes[room.room_id] = self.version
+            self.changes.move_to_end(room.room_id)
+
+    def remove(self, room_id):
+        with self.lock:
+            self.discard(room_id)
+
+    def discard(self, room_id):
+        # Caller holds self.lock
+        if room_id not in self.entries:
+            return
+        self.version += 1
+        del self.entries[room_id]
+        del self.changes[room_id]
+        self.removed.append((self.version, room_id))
+        if len(self.removed) > self.history:
+            self.oldest_delta = self.removed.popleft()[0]
+
+    def page(self, offset, limit):
+        # (version, total rooms, [entries])
+        with self.lock:
+            if self.snapshot is None or self.snapshot[0] != self.version:
+                if offset < SHALLOW_PAGE:
+                    # Near the top it's cheaper to walk the entries than to copy all of them
+                    entries = list(itertools.islice(self.entries.values(), offset, offset + limit))
+                    return self.version, len(self.entries), entries
+                self.snapshot = (self.version, list(self.entries.values()))
+            version, entries = self.snapshot
+        return version, len(entries), entries[offset:offset + limit]
+
+    def delta(self, since):
+        # (version, [changed entries], [removed ids]) since version since, or None if that's too old
+        with self.lock:
+            if not self.oldest_delta <= since <= self.version:
+                return None
+            changed = []
+            for room_id in reversed(self.changes):
+                if self.changes[room_id] <= since:
+                    break
+                changed.append(self.entries[room_id])
+            removed = []
+            for version, room_id in reversed(self.removed):
+                if version <= since:
+                    break
+                removed.append(room_id)
+            return self.version, changed[::-1], removed[::-1]
+
+class RoomRegistry:
+    """Rooms by id and by case-insensitive name, with the open-room index kept up to date as rooms change.
+
+    Looking a room up takes no lock: single dict reads and writes are atomic, and a room is in
+    self.rooms from the moment it can be found until it is closed. Adding and removing take only
+    the lock stripe for the room's name, which is what has to stay unique, so rooms with different
+    names never wait on each other.
+    """
+    def __init__(self, id_reuse_delay=0):
+        self.rooms = {}
+        self.names = {}  # room.name.lower() -> room
+        self.ids = RoomIdAllocator(id_reuse_delay)
+        self.open = OpenRoomIndex()
+        self.listing = RoomListing()
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def __contains__(self, room_id):
+        return room_id in self.rooms
+
+    def __getitem__(self, room_id):
+        return self.rooms[room_id]
+
+    def __delitem__(self, room_id):
+        self.remove(room_id)
+
+    def get(self, room_id):
+        return self.rooms.get(room_id)
+
+    def values(self):
+        return self.rooms.values()
+
+    def items(self):
+        return self.rooms.items()
+
+    def new_room_id(self):
+        return self.ids.allocate()
+
+    def find(self, name):
+        return self.names.get(name.lower())
+
+    def lock_for(self, key):
+        return self.locks[hash(key) % LOCK_STRIPES]
+
+    def add(self, room):
+        # None if another room already has that name; its id goes straight back to the allocator
+        key = room.name.lower()
+        with self.lock_for(key):
+            if key in self.names:
+                self.ids.release(room.room_id, delay=0)
+                return None
+            self.names[key] = room
+            self.rooms[room.room_id] = room
+        room.registry = self
+        self.open.update(room)
+        self.listing.update(room)
+        return room
+
+    def remove(self, room_id):
+        room = self.rooms.pop(room_id, None)
+        if room is None:
+            return None
+        key = room.name.lower()
+        with self.lock_for(key):
+            del self.names[key]
+        room.registry = None
+        self.open.remove(room_id)
+        self.listing.remove(room_id)
+        self.ids.release(room_id)
+        return room
+
+    def room_changed(self, room):
+        if self.rooms.get(room.room_id) is room:
+            self.open.update(room)
+            self.listing.update(room)
+
+class RoomPool:
+    """Retired rooms kept for reuse, so a busy server isn't allocating a room and board per game.
+
+    Like room ids, a released room waits reuse_delay seconds before it is handed out again: a bot
+    turn or a handler that looked the room up just before it was retired is done with it by then.
+    """
+    def __init__(self, factory, size=1024, reuse_delay=5.0):
+        self.factory = factory  # factory(room_id, name, *settings) makes a new room
+        self.size = size
+        self.reuse_delay = reuse_delay
+        self.free = collections.deque()  # (reusable after, room), oldest first
+        self.lock = threading.Lock()
+        self.reused = 0
+
+    def acquire(self, room_id, name=None, *settings):
+        with self.lock:
+            room = None
+            if self.free and self.free[0][0] <= time.monotonic():
+                room = self.free.popleft()[1]
+        if room is None:
+            return self.factory(room_id, name, *settings)
+        room.reset(room_id, name, *settings)
+        self.reused += 1
+        return room
+
+    def release(self, room):
+        with self.lock:
+            if len(self.free) < self.size:
+                self.free.append((time.monotonic() + self.reuse_delay, room))
+
+class RoomReaper:
+    """Retires rooms nobody is coming back to: finished games, and games only bots are left in.
+
+    Both kinds get grace seconds first, so players can still read the result and the chat. A
+    retired room leaves the registry, its remaining players go back to the lobby, and the room
+    object goes back to the pool.
+    """
+    def __init__(self, registry, pool, grace=60.0, interval=1.0):
+        self.registry = registry
+        self.pool = pool
+        self.grace = grace
+        self.interval = interval
+        self.reaped = 0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sweep()
+
+    def sweep(self):
+        now = time.monotonic()
+        for room in list(self.registry.rooms.values()):  # One C-level copy, safe while rooms change
+            done = room.finished_at if room.finished_at is not None else room.abandoned_at
+            if done is None or now - done < self.grace:
+                continue
+            if self.registry.remove(room.room_id) is not room:
+                continue  # The last player left and removed it first
+            room.retire()
+            self.pool.release(room)
+            self.reaped += 1
@@ -1,103 +1,242 @@
+import argparse
+import asyncio
+import os
 import socket
 import threading
 
+import protocol
+import workers
 from protocol import *
-from KeyExchange import DiffieHellmanChannel, RSAChannel
+from KeyExchange import RSAChannel, load_server_key, start_key_pools, start_rsa_pool
+from rooms import RoomReaper, RoomRegistry
+from sessions import SessionIndex
 
 # Server configuration
 ADDR = ("0.0.0.0", 5050)
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 # Shared resources
-rooms = {}
+rooms = RoomRegistry(id_reuse_delay=TICKET_LIFETIME)  # Ids outlive any ticket naming the old room
 clients = {}
+sessions = SessionIndex()  # Logged-in players by username
 
 # Thread locks
-rooms_lock = threading.Lock()
 clients_lock = threading.Lock()
 
 DEBUG = False
 
+# Handlers that wait on the CPU pool; the asyncio engine runs them off the event loop
+CPU_COMMANDS = ("LOGIN", "REGISTER")
+
 def debug_print(*args):
     if DEBUG:
         print("[DEBUG]", *args)
 
-def handle_client(client_socket, addr):
-    secure = DiffieHellmanChannel()
+class StreamSocket:
+    """Socket-like wrapper around an asyncio StreamWriter so the cmd* handlers can use it."""
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.binary = False
+        self.send_lock = threading.RLock()  # Held from encryption until the frame is scheduled
+
+    def queue_frame(self, frame, droppable=False):
+        # Every frame goes through the loop's FIFO callback queue, so frames scheduled from
+        # bot threads and from the loop itself keep the order their nonces were used in
+        self.loop.call_soon_threadsafe(self.write_frame, frame, droppable)
+
+    def write_frame(self, frame, droppable):
+        transport = self.writer.transport
+        if transport.is_closing():
+            return
+        # The transport buffers unsent bytes for us, apply the same slow-consumer policy to it
+        if transport.get_write_buffer_size() + len(frame) > protocol.OUTBOUND_LIMIT:
+            if droppable and protocol.SLOW_CONSUMER_POLICY == "drop_state":
+                return
+            debug_print("[SLOW CONSUMER] disconnecting")
+            transport.abort()
+            return
+        self.writer.write(frame)
+
+    def sendall(self, data):
+        self.queue_frame(data)
 
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+def dispatch_command(player, command, client_socket, secure):
+    match command['type']:
+        case 'LOGIN':
+            cmdLogin(player, command, client_socket, sessions, secure)
+        case 'REGISTER':
+            cmdRegister(player, command, client_socket, sessions, secure)
+        case 'JOIN':
+            cmdJoin(player, client_socket, rooms, secure)
+        case 'CREATE':
+            cmdCreate(player, command, client_socket, rooms, secure)
+        case 'VIEW':
+            cmdView(command, client_socket, rooms, secure)
+        case action if action in ('SCAN', 'HACK', 'EVADE', 'ENCRYPT'):
+            cmdCommands(player, command, rooms, secure)
+        case 'PLAYERS':
+            cmdPlayers(player, client_socket, rooms, secure)
+        case 'LEAVE':
+            cmdLeave(player, client_socket, rooms, secure)
+        case 'START':
+            cmdStart(player, client_socket, rooms, secure)
+        case 'USERNAME':
+            cmdUsername(player, client_socket, secure)
+        case 'POSITION':
+            cmdPosition(player, client_socket, rooms, secure)
+        case 'STATUS':
+            cmdStatus(player, command, client_socket, rooms, secure)
+        case 'SUBSCRIBE':
+            cmdSubscribe(player, client_socket, rooms, secure)
+        case 'CHAT':
+            cmdChat(player, command['args'].get('msg', ""), client_socket, rooms, secure)
+        case 'CREATE_BOT':
+            cmdBot(player, client_socket, rooms, secure)
+        case 'LEADERBOARD':
+            cmdLeaderboard(command, client_socket, secure)
+        case 'END_TURN':
+            cmdEndTurn(player, rooms, client_socket, secure)
+        case 'JOIN_ROOM_NAME':
+            cmdJoinRoomName(player, command, client_socket, rooms, secure)
+        case 'FRAMING':
+            cmdFraming(command, client_socket, secure)
+        case 'CIPHER':
+            cmdCipher(command, client_socket, secure)
+        case 'TICKET':
+            cmdTicket(player, client_socket, secure)
+        case 'ONLINE':
+            cmdOnline(command, client_socket, sessions, secure)
+        case 'MALFORMED':
+            debug_print('ERROR reason="Malformed command"')
+            sendWithSize('ERROR reason="Malformed command"', client_socket, secure)
+
+def run_command(player, command, client_socket, secure):
+    request_context.conn, request_context.id = client_socket, command['id']
     try:
-        # Key exchange
-        client_socket.send(str(secure.public).encode())
-        client_pub = int(client_socket.recv(4096).decode())
-        secure.generate_shared_key(client_pub)
-        debug_print("Key exchange completed!")
+        dispatch_command(player, command, client_socket, secure)
+    finally:
+        request_context.conn = None
+
+def handle_client(client_socket, addr):
+    try:
+        # Key exchange, the client falls back to a full one if its ticket is rejected
+        secure = None
+        while secure is None:
+            hello = recvFrame(client_socket)
+            if hello is None:
+                client_socket.close()
+                return
+            secure, reply, resumed = acceptKeyExchange(hello)
+            sendPlain(reply, client_socket)
+        debug_print(f"Key exchange completed! ({secure.mode})")
 
-    except (ValueError, UnicodeDecodeError, TypeError) as e:
+    except (ValueError, UnicodeDecodeError, TypeError, IndexError, KeyError) as e:
         print(f"[KEY EXCHANGE ERROR] {e}")
         debug_print(f"[KEY EXCHANGE ERROR] {e}")
         client_socket.close()
         return
 
     player = Player(address=addr, socket=client_socket)
+    player.secure = secure
+    if resumed:
+        player = resumeSession(player, resumed, client_socket, secure, sessions, rooms)
 
     with clients_lock:
         clients[client_socket] = player
+    if resumed:
+        cmdResume(player, client_socket, secure)
 
     try:
         while True:
-            msg = recvWithSize(client_socket, secure)
-            if msg is None:
+            command = recvCommand(client_socket, secure)
+            if command is None:
                 print(f"[DISCONNECT] {addr} disconnected unexpectedly.")
                 debug_print(f"[DISCONNECT] {addr} disconnected unexpectedly.")
-                cleanup_player(client_socket, player, rooms_lock, rooms, clients, clients_lock, secure)
+                cleanup_player(client_socket, player, rooms, clients, clients_lock, sessions, secure)
                 break
 
-            command = parse_command(msg)
             debug_print(command)
+            run_command(player, command, client_socket, secure)
+
+    except Exception as e:
+        print(f"[DISCONNECT] {addr} disconnected.")
+        debug_print(f"[DISCONNECT] {addr} disconnected due to error: {e}")
+        cleanup_player(client_socket, player, rooms, clients, clients_lock, sessions, secure)
+
+async def handle_client_async(reader, writer):
+    addr = writer.get_extra_info("peername")
+    loop = asyncio.get_running_loop()
+    client_socket = StreamSocket(writer, loop)
+
+    try:
+        # Key exchange
+        secure = None
+        while secure is None:
+            hello = await recvFrameAsync(reader, False)
+            if hello is None:
+                writer.close()
+                return
+            # The DH math may wait on the CPU pool, keep that off the event loop
+            secure, reply, resumed = await loop.run_in_executor(None, acceptKeyExchange, hello)
+            sendPlain(reply, client_socket)
+        debug_print(f"Key exchange completed! ({secure.mode})")
+
+    except (ValueError, UnicodeDecodeError, TypeError, IndexError, KeyError) as e:
+        print(f"[KEY EXCHANGE ERROR] {e}")
+        debug_print(f"[KEY EXCHANGE ERROR] {e}")
+        writer.close()
+        return
+
+    player = Player(address=addr, socket=client_socket)
+    player.secure = secure
+    if resumed:
+        player = resumeSession(player, resumed, client_socket, secure, sessions, rooms)
+
+    with clients_lock:
+        clients[client_socket] = player
+    if resumed:
+        cmdResume(player, client_socket, secure)
+
+    try:
+        while True:
+            command = await recvCommandAsync(reader, client_socket, secure)
+            if command is None:
+                print(f"[DISCONNECT] {addr} disconnected unexpectedly.")
+                debug_print(f"[DISCONNECT] {addr} disconnected unexpectedly.")
+                cleanup_player(client_socket, player, rooms, clients, clients_lock, sessions, secure)
+                break
 
-            match command['type']:
-                case 'LOGIN':
-                    cmdLogin(player, command, client_socket, clients, secure)
-                case 'REGISTER':
-                    cmdRegister(player, command, client_socket, secure)
-                case 'JOIN':
-                    cmdJoin(player, client_socket, rooms_lock, rooms, secure)
-                case 'CREATE':
-                    cmdCreate(player, client_socket, rooms_lock, rooms, secure)
-                case 'VIEW':
-                    cmdView(client_socket, rooms_lock, rooms, secure)
-                case action if action in ('SCAN', 'HACK', 'EVADE', 'ENCRYPT'):
-                    cmdCommands(player, command, rooms_lock, rooms, secure)
-                case 'PLAYERS':
-                    cmdPlayers(player, client_socket, rooms_lock, rooms, secure)
-                case 'LEAVE':
-                    cmdLeave(player, client_socket, rooms_lock, rooms, secure)
-                case 'START':
-                    cmdStart(player, client_socket, rooms_lock, rooms, secure)
-                case 'USERNAME':
-                    cmdUsername(player, client_socket, secure)
-                case 'POSITION':
-                    cmdPosition(player, client_socket, rooms, secure)
-                case 'STATUS':
-                    cmdStatus(player, client_socket, rooms_lock, rooms, secure)
-                case 'CHAT':
-                    msg_content = msg[msg.find("msg=") + 4:]
-                    cmdChat(player, msg_content, client_socket, rooms_lock, rooms, secure)
-                case 'CREATE_BOT':
-                    cmdBot(player, client_socket, rooms_lock, rooms, secure)
-                case 'LEADERBOARD':
-                    cmdLeaderboard(client_socket, secure)
-                case 'END_TURN':
-                    cmdEndTurn(player, rooms_lock, rooms, client_socket, secure)
-                case 'JOIN_ROOM_NAME':
-                    cmdJoinRoomName(player, command, client_socket, rooms_lock, rooms, secure)
+            debug_print(command)
+            if command['type'] in CPU_COMMANDS:
+                # Later commands from this client wait, other clients don't
+                await loop.run_in_executor(None, run_command, player, command, client_socket, secure)
+            else:
+                run_command(player, command, client_socket, secure)
+            # Replies reach the transport through call_soon_threadsafe; yield once so they are
+            # written, then drain stops reading from a client that isn't reading its replies
+            await asyncio.sleep(0)
+            await writer.drain()
 
     except Exception as e:
         print(f"[DISCONNECT] {addr} disconnected.")
         debug_print(f"[DISCONNECT] {addr} disconnected due to error: {e}")
-        cleanup_player(client_socket, player, rooms_lock, rooms, clients, clients_lock, secure)
+        cleanup_player(client_socket, player, rooms, clients, clients_lock, sessions, secure)
 
-def main():
+    writer.close()
+
+async def serve_async():
+    server = await asyncio.start_server(handle_client_async, ADDR[0], ADDR[1])
+    print("SERVER IS RUNNING (asyncio)")
+    debug_print("SERVER IS RUNNING (asyncio)")
+    async with server:
+        await server.serve_forever()
+
+def serve_threaded():
     try:
         server_socket.bind(ADDR)
         server_socket.listen()
@@ -112,7 +251,57 @@ def main():
     while True:
         conn, addr = server_socket.accept()
         debug_print(f"New connection: {addr}")
-        threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        threading.Thread(target=handle_client, args=(Connection(conn), addr), daemon=True).start()
+
+def main(argv=None):
+    global ADDR
+
+    parser = argparse.ArgumentParser(description="Cyber Hunt server")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded",
+                        help="thread-per-connection or single event loop")
+    parser.add_argument("--host", default=ADDR[0])
+    parser.add_argument("--port", type=int, default=ADDR[1])
+    parser.add_argument("--slow-consumer", choices=("drop_state", "disconnect"), default=protocol.SLOW_CONSUMER_POLICY,
+                        help="what to do when a client stops reading its frames")
+    parser.add_argument("--key-pool", type=int, default=64,
+                        help="X25519 keypairs generated ahead for key exchanges (0 disables)")
+    parser.add_argument("--dh-key-pool", type=int, default=0,
+                        help="finite-field DH keypairs generated ahead (0 generates on demand)")
+    parser.add_argument("--rsa-pool", type=int, default=0,
+                        help="RSA keypairs generated ahead for RSAChannel (0 generates on demand)")
+    parser.add_argument("--rsa-workers", type=int, default=2)
+    parser.add_argument("--rsa-key", help="PEM file with a long-lived server RSA key, created if missing")
+    parser.add_argument("--user-store", choices=("json", "sqlite"), default=protocol.USER_BACKEND,
+                        help="where accounts and wins are kept (migrate_users.py moves them to sqlite)")
+    parser.add_argument("--users-db", default=protocol.USERS_DB)
+    parser.add_argument("--cpu-workers", type=int, default=os.cpu_count(),
+                        help="processes for password hashing and DH math (0 runs them inline)")
+    parser.add_argument("--room-grace", type=float, default=60.0,
+                        help="seconds a finished or bots-only room stays up before it is retired")
+    args = parser.parse_args(argv)
+    ADDR = (args.host, args.port)
+    protocol.SLOW_CONSUMER_POLICY = args.slow_consumer
+    protocol.USER_BACKEND = args.user_store
+    protocol.USERS_DB = args.users_db
+    if args.cpu_workers:
+        workers.start_cpu_pool(args.cpu_workers)
+    if args.key_pool or args.dh_key_pool:
+        start_key_pools(args.key_pool, workers.executor, args.dh_key_pool)
+    if args.rsa_key:
+        load_server_key(args.rsa_key)
+    elif args.rsa_pool:
+        start_rsa_pool(args.rsa_pool, args.rsa_workers)
+    RoomReaper(rooms, protocol.room_pool, args.room_grace).start()
+
+    if args.engine == "asyncio":
+        try:
+            asyncio.run(serve_async())
+        except OSError as e:
+            print(f"[SOCKET ERROR] {e}")
+            debug_print(f"[SOCKET ERROR] {e}")
+            exit(1)
+    else:
+        serve_threaded()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,43 @@
+import threading
+
+class SessionIndex:
+    """Logged-in players by username, next to the socket-keyed clients dict.
+
+    Claiming a username is a single check-and-set under the lock, so two connections logging in
+    as the same user at once can't both get through, and finding a user's session never walks
+    every connected client.
+    """
+    def __init__(self):
+        self.players = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.players)
+
+    def claim(self, username, player):
+        # False if someone else is already online as username
+        with self.lock:
+            current = self.players.get(username)
+            if current is not None and current is not player:
+                return False
+            self.players[username] = player
+            return True
+
+    def release(self, username, player):
+        # Only the session that holds the name can give it up
+        with self.lock:
+            if self.players.get(username) is player:
+                del self.players[username]
+
+    def get(self, username):
+        return self.players.get(username)
+
+    def is_online(self, username):
+        return username in self.players
+
+    def online(self, usernames=None):
+        # Which of usernames are online, or everyone online when none are given
+        if usernames is None:
+            return list(self.players)
+        players = self.players
+        return [username for username in usernames if username in players]
@@ -0,0 +1,136 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import os
+import random
+import time
+
+import protocol
+import workers
+from engine import GRID_SIZE
+from rooms import MAX_PLAYERS, valid_room_size
+
+# Bot games played straight through GameRoom, bot_decide_action and the game* functions: no
+# sockets, no bot threads, no sleeps. Every game draws from its own random.Random seeded from
+# the run's seed and the game's number, so a game plays out the same on any worker and in any
+# batch, and the outcome digest for a seed only changes when the engine or the bots do.
+
+class NullSocket:
+    """Where the simulated players' replies go."""
+    def sendall(self, data):
+        pass
+
+def game_rng(seed, game):
+    return random.Random(seed * 2**32 + game)
+
+def game_digest(game, winner, turns):
+    # Summed over all games, so the total doesn't depend on how games were split into batches
+    return int.from_bytes(hashlib.blake2b(f"{game}:{winner}:{turns}".encode(), digest_size=8).digest(), "big")
+
+def play_game(rng, grid_size, max_players, max_turns, latencies):
+    # One game from an empty room to its winner; (winning seat or -1 if unfinished, turns).
+    # Always a new room: a reused one's free-cell order depends on the game played in it before
+    room = protocol.GameRoom(0, None, grid_size, max_players)
+    room.rng = rng
+    room.bot_threads = False
+    conn = NullSocket()
+    secure = protocol.DummySecure()
+    for seat in range(max_players):
+        bot = protocol.Player(conn, None, f"SIM{seat}")
+        bot.is_bot = True
+        room.add_player(bot)  # The last one in starts the game and places everyone
+
+    turns = 0
+    while not room.game_over and turns < max_turns:
+        player = room.players[room.turn_index]
+        start = time.perf_counter_ns()
+        room.handle_command(player, protocol.bot_decide_action(player, room), secure)
+        latencies[(time.perf_counter_ns() - start) // 100] += 1  # 0.1us buckets
+        turns += 1
+
+    if not room.game_over:
+        return -1, turns
+    return next(seat for seat, p in enumerate(room.players) if p.is_alive), turns
+
+def run_batch(seed, first, count, grid_size, max_players, max_turns):
+    # Games first..first+count-1, summed up so only a small result crosses the process boundary
+    protocol.DEBUG = False
+    latencies = collections.Counter()
+    wins = [0] * max_players
+    digest = turns = unfinished = 0
+    for game in range(first, first + count):
+        winner, played = play_game(game_rng(seed, game), grid_size, max_players, max_turns, latencies)
+        turns += played
+        if winner < 0:
+            unfinished += 1
+        else:
+            wins[winner] += 1
+        digest = (digest + game_digest(game, winner, played)) % 2**64
+    return turns, unfinished, wins, latencies, digest
+
+def percentile(latencies, share):
+    # From a Counter of 0.1us buckets, in microseconds
+    wanted = share * sum(latencies.values())
+    seen = 0
+    for bucket in sorted(latencies):
+        seen += latencies[bucket]
+        if seen >= wanted:
+            return bucket / 10
+    return 0.0
+
+def simulate(games, seed=0, grid_size=GRID_SIZE, max_players=MAX_PLAYERS, max_turns=10000, batch=500, processes=None):
+    batches = [(seed, first, min(batch, games - first), grid_size, max_players, max_turns)
+               for first in range(0, games, batch)]
+    start = time.perf_counter()
+    if processes == 0:
+        results = [run_batch(*job) for job in batches]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes or os.cpu_count(),
+                                                    initializer=workers.watch_parent,
+                                                    initargs=(os.getpid(),)) as pool:
+            results = list(pool.map(run_batch, *zip(*batches)))
+    elapsed = time.perf_counter() - start
+
+    latencies = collections.Counter()
+    wins = [0] * max_players
+    digest = turns = unfinished = 0
+    for batch_turns, batch_unfinished, batch_wins, batch_latencies, batch_digest in results:
+        turns += batch_turns
+        unfinished += batch_unfinished
+        wins = [a + b for a, b in zip(wins, batch_wins)]
+        latencies.update(batch_latencies)
+        digest = (digest + batch_digest) % 2**64
+    return {"games": games, "elapsed": elapsed, "turns": turns, "unfinished": unfinished, "wins": wins,
+            "latencies": latencies, "digest": f"{digest:016x}"}
+
+def main():
+    parser = argparse.ArgumentParser(description="Cyber Hunt headless bot game simulator")
+    parser.add_argument("--games", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--grid-size", type=int, default=GRID_SIZE)
+    parser.add_argument("--players", type=int, default=MAX_PLAYERS)
+    parser.add_argument("--max-turns", type=int, default=10000, help="turns before a game counts as unfinished")
+    parser.add_argument("--batch", type=int, default=500, help="games per task handed to a worker")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes (0 plays inline)")
+    args = parser.parse_args()
+    if not valid_room_size(args.grid_size, args.players):
+        parser.error(f"no room holds {args.players} players on {args.grid_size}x{args.grid_size}")
+
+    result = simulate(args.games, args.seed, args.grid_size, args.players, args.max_turns, args.batch, args.workers)
+    games, elapsed, turns, latencies = result["games"], result["elapsed"], result["turns"], result["latencies"]
+    label = f"{args.workers} workers" if args.workers else "inline"
+    print(f"{games:,} games ({args.players} players on {args.grid_size}x{args.grid_size}, seed {args.seed}) "
+          f"in {elapsed:.2f}s, {label}: {games / elapsed:,.0f} games/s, {turns / elapsed:,.0f} turns/s")
+    print(f"turns per game: {turns / games:.1f} mean, {result['unfinished']} unfinished")
+    print(f"turn resolution: p50 {percentile(latencies, 0.5):.1f}us, p99 {percentile(latencies, 0.99):.1f}us, "
+          f"max {max(latencies) / 10:.1f}us")
+    shares = [wins / games for wins in result["wins"]]
+    if len(shares) <= 8:
+        print("wins by seat: " + " ".join(f"{share:.1%}" for share in shares))
+    else:
+        print(f"wins by seat: {min(shares):.1%} to {max(shares):.1%}")
+    print(f"outcome digest: {result['digest']}")
+
+if __name__ == "__main__":
+    main()
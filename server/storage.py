@@ -0,0 +1,222 @@
+import atexit
+import collections
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+LOCK_STRIPES = 64
+
+class JsonUserStore:
+    """Every account kept in memory, loaded from the JSON file once.
+
+    Lookups read the dict directly. Changes take the lock stripe for that username and mark the
+    store dirty; a background flusher writes the whole file at most once per flush_delay, through
+    a temp file and os.replace so a crash never leaves a half-written users file behind.
+    """
+    def __init__(self, path, flush_delay=1.0):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.users = self.load()
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.flush_lock = threading.Lock()  # One writer of the file at a time
+        self.changed = threading.Event()
+        self.closed = False
+        self.flushes = 0
+        threading.Thread(target=self.flusher, daemon=True).start()
+        atexit.register(self.close)
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                return json.load(f)
+        return {}
+
+    def lock_for(self, username):
+        return self.locks[hash(username) % LOCK_STRIPES]
+
+    def get(self, username):
+        return self.users.get(username)
+
+    def add(self, username, record):
+        # False if the username is taken
+        with self.lock_for(username):
+            if username in self.users:
+                return False
+            self.users[username] = record
+        self.changed.set()
+        return True
+
+    def update(self, username, record):
+        with self.lock_for(username):
+            if username not in self.users:
+                return
+            # Keep wins that landed since the caller read the record
+            self.users[username] = dict(record, wins=self.users[username].get("wins", 0))
+        self.changed.set()
+
+    def increment_wins(self, username):
+        with self.lock_for(username):
+            record = self.users.get(username)
+            if record is None:
+                return
+            self.users[username] = dict(record, wins=record.get("wins", 0) + 1)
+        self.changed.set()
+
+    def all_users(self):
+        # Snapshot of (username, record) pairs
+        return list(self.users.items())
+
+    def flusher(self):
+        while not self.closed:
+            self.changed.wait()
+            # Debounce: everything that changes while we wait goes out in the same write
+            time.sleep(self.flush_delay)
+            try:
+                self.flush()
+            except OSError as e:
+                # Full disk, permissions: the store is still marked changed, try again next round
+                print(f"Couldn't write {self.path}: {e}", file=sys.stderr)
+
+    def flush(self):
+        with self.flush_lock:
+            if not self.changed.is_set():
+                return
+            self.changed.clear()
+            try:
+                self.write()
+            except BaseException:
+                self.changed.set()
+                raise
+            self.flushes += 1
+
+    def write(self):
+        snapshot = dict(self.users)  # Records are replaced, never mutated, so this is consistent
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".users-", suffix=".json")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            # mkstemp creates the file owner-only, keep the mode the users file already had
+            mode = os.stat(self.path).st_mode if os.path.exists(self.path) else 0o644
+            os.chmod(tmp_path, mode & 0o777)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def close(self):
+        self.closed = True
+        self.flush()
+
+class SQLiteUserStore:
+    """Accounts in a SQLite database in WAL mode, looked up through the username primary key.
+
+    Registrations are written straight away, since the caller needs to know if the name was
+    taken. Wins are queued and a background writer applies everything queued, from any number
+    of rooms, as one transaction of "wins = wins + 1" updates, so concurrent games never lose one.
+    """
+    def __init__(self, path, flush_delay=0.2):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.local = threading.local()  # sqlite3 connections can't be shared between threads
+        self.pending_wins = collections.deque()
+        self.changed = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.closed = False
+        self.flushes = 0
+        db = self.connection()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS users ("
+                   "username TEXT PRIMARY KEY, password TEXT NOT NULL, salt TEXT NOT NULL, "
+                   "wins INTEGER NOT NULL DEFAULT 0, kdf TEXT NOT NULL DEFAULT 'sha256')")
+        if "kdf" not in [column[1] for column in db.execute("PRAGMA table_info(users)")]:
+            db.execute("ALTER TABLE users ADD COLUMN kdf TEXT NOT NULL DEFAULT 'sha256'")
+        db.commit()
+        threading.Thread(target=self.flusher, daemon=True).start()
+        atexit.register(self.close)
+
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, and no fsync per commit
+            self.local.db = db
+        return db
+
+    def get(self, username):
+        row = self.connection().execute(
+            "SELECT password, salt, wins, kdf FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        return {"password": row[0], "salt": row[1], "wins": row[2], "kdf": row[3]}
+
+    def add(self, username, record):
+        db = self.connection()
+        try:
+            with db:
+                db.execute("INSERT INTO users (username, password, salt, wins, kdf) VALUES (?, ?, ?, ?, ?)",
+                           (username, record["password"], record["salt"], record.get("wins", 0),
+                            record.get("kdf", "sha256")))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def update(self, username, record):
+        # Credentials only; wins are only ever changed by increment_wins
+        db = self.connection()
+        with db:
+            db.execute("UPDATE users SET password = ?, salt = ?, kdf = ? WHERE username = ?",
+                       (record["password"], record["salt"], record.get("kdf", "sha256"), username))
+
+    def increment_wins(self, username):
+        self.pending_wins.append(username)
+        self.changed.set()
+
+    def all_users(self):
+        rows = self.connection().execute("SELECT username, password, salt, wins, kdf FROM users")
+        return [(username, {"password": password, "salt": salt, "wins": wins, "kdf": kdf})
+                for username, password, salt, wins, kdf in rows]
+
+    def flusher(self):
+        while not self.closed:
+            self.changed.wait()
+            time.sleep(self.flush_delay)  # Let other rooms finishing around now join the batch
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                # Locked or unwritable database: the wins are queued again, try again next round
+                print(f"Couldn't write wins to {self.path}: {e}", file=sys.stderr)
+
+    def flush(self):
+        with self.flush_lock:
+            self.changed.clear()
+            batch = []
+            while self.pending_wins:
+                batch.append((self.pending_wins.popleft(),))
+            if not batch:
+                return
+            db = self.connection()
+            try:
+                with db:
+                    db.executemany("UPDATE users SET wins = wins + 1 WHERE username = ?", batch)
+            except BaseException:
+                # Rolled back, so put the batch back in front of anything queued since
+                self.pending_wins.extendleft(username for username, in reversed(batch))
+                self.changed.set()
+                raise
+            self.flushes += 1
+
+    def close(self):
+        self.closed = True
+        self.flush()
+
+BACKENDS = {"json": JsonUserStore, "sqlite": SQLiteUserStore}
+
+def open_user_store(backend, path):
+    return BACKENDS[backend](path)
@@ -0,0 +1,36 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+# CPU-heavy work (password hashing, DH math) runs in these processes so it neither holds the
+# GIL nor stalls the event loop. With no pool started everything runs inline, as before
+executor = None
+
+def watch_parent(parent_pid):
+    # Pool processes outlive a server that was killed outright, leave once it is gone
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+def start_cpu_pool(workers=None):
+    global executor
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                                          initializer=watch_parent, initargs=(os.getpid(),))
+    # Start the worker processes now, before the server has any other threads
+    executor.submit(int).result()
+    return executor
+
+def stop_cpu_pool():
+    global executor
+    if executor is not None:
+        executor.shutdown()
+        executor = None
+
+def run_cpu(func, *args):
+    # Blocks only the calling thread; other clients keep being served while the pool works
+    if executor is None:
+        return func(*args)
+    return executor.submit(func, *args).result()
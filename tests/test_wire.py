@@ -0,0 +1,41 @@
+import importlib.util
+import pathlib
+import unittest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+def load_wire(side):
+    spec = importlib.util.spec_from_file_location(f"{side}_wire", ROOT / side / "wire.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class WireFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.server = load_wire("server")
+        self.client = load_wire("client")
+
+    def test_copies_identical(self):
+        server = (ROOT / "server" / "wire.py").read_bytes()
+        client = (ROOT / "client" / "wire.py").read_bytes()
+        self.assertEqual(server, client, "server/wire.py and client/wire.py have drifted, copy one over the other")
+
+    def test_tables_match(self):
+        self.assertEqual(self.server.OPCODES, self.client.OPCODES)
+        self.assertEqual(self.server.INT_ARGS, self.client.INT_ARGS)
+        for name in ("FRAME_HEADER", "OP_HEADER", "ARG_INT", "ARG_STR_LEN"):
+            self.assertEqual(getattr(self.server, name).format, getattr(self.client, name).format, name)
+
+    def test_round_trip(self):
+        # Whatever one side encodes the other decodes, for every command
+        for cmd_type, fields in self.client.OPCODES.values():
+            args = {field: 7 if field in self.client.INT_ARGS else "abc" for field in fields}
+            payload = self.client.encode_binary(cmd_type, args, 42)
+            self.assertEqual(self.server.decode_binary(payload), {'type': cmd_type, 'args': args, 'id': 42})
+
+    def test_rejects_non_numeric(self):
+        with self.assertRaises(ValueError):
+            self.client.encode_binary("SCAN", {"x": "a", "y": 1})
+
+if __name__ == "__main__":
+    unittest.main()